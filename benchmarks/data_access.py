@@ -0,0 +1,141 @@
+# Time the bot's hot data-access functions, through the same Database layer the
+# bot uses, against seeded databases of realistic sizes.
+#
+#   python -m benchmarks.data_access --users 10000 100000 1000000 --output results.json
+#   python -m benchmarks.data_access --check benchmarks/baseline.json --threshold 0.5
+#   python -m benchmarks.data_access --users 10000 100000 --update-baseline benchmarks/baseline.json
+#
+# --check exits with status 1 if any function's median is more than
+# `threshold` slower than the baseline for the same database size (and by more
+# than --min-delta-ms, so sub-millisecond jitter doesn't fail the run).
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import telegram_bot
+from benchmarks.indexes import BASE_VERSION
+from benchmarks.seed import seed
+from telegram_bot import Database, migrate
+
+NEW_USER_BASE = 10 ** 9  # IDs for users created by the save_user benchmark
+
+
+def _random_user(rng, users):
+    return rng.randint(1, users)
+
+
+def _random_referrer(rng, users):
+    return rng.randint(1, max(1, users // 10))
+
+
+# name -> fn(rng, users, i) returning the coroutine to time
+BENCHMARKS = {
+    'save_user': lambda rng, users, i: telegram_bot.save_user(NEW_USER_BASE + i, f'new{i}', _random_referrer(rng, users)),
+    'get_user': lambda rng, users, i: telegram_bot.get_user(_random_user(rng, users)),
+    'add_bonus': lambda rng, users, i: telegram_bot.add_bonus(_random_user(rng, users), 5),
+    'deduct_balance': lambda rng, users, i: telegram_bot.deduct_balance(_random_user(rng, users), 1),
+    'get_referrals': lambda rng, users, i: telegram_bot.get_referrals(_random_referrer(rng, users)),
+    'get_completed_tasks': lambda rng, users, i: telegram_bot.get_completed_tasks(_random_user(rng, users)),
+    'get_pending_withdrawals': lambda rng, users, i: telegram_bot.get_pending_withdrawals(telegram_bot.PENDING_WITHDRAWALS_SHOWN),
+    'get_withdrawal_history': lambda rng, users, i: telegram_bot.get_withdrawal_history(_random_user(rng, users)),
+}
+
+
+async def time_benchmark(fn, users, repeat):
+    rng = random.Random(7)
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        await fn(rng, users, i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 4),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+    }
+
+
+async def run_size(path, users, repeat):
+    telegram_bot.db = Database(path)
+    await telegram_bot.db.start()
+    try:
+        return {name: await time_benchmark(fn, users, repeat) for name, fn in BENCHMARKS.items()}
+    finally:
+        await telegram_bot.db.close()
+
+
+def run(users, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        conn = sqlite3.connect(path, isolation_level=None)
+        # Seed the base schema and migrate it, so the backfills (ledger opening
+        # balances, stats, referral index) run over the data like in production
+        migrate(conn, target=BASE_VERSION)
+        started = time.perf_counter()
+        seed(conn, users)
+        migrate(conn)
+        conn.execute('ANALYZE')
+        conn.close()
+        print(f"{users:,} users seeded and migrated in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return asyncio.run(run_size(path, users, repeat))
+
+
+# Returns a list of (size, name, baseline_ms, current_ms) for medians over the threshold
+def regressions(results, baseline, threshold, min_delta_ms):
+    found = []
+    for size, timings in results.items():
+        for name, timing in timings.items():
+            expected = baseline.get(size, {}).get(name)
+            if not expected:
+                continue
+            current = timing['median_ms']
+            if current > expected['median_ms'] * (1 + threshold) and current - expected['median_ms'] > min_delta_ms:
+                found.append((size, name, expected['median_ms'], current))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data-access functions')
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', help='write results as JSON to this file instead of stdout')
+    parser.add_argument('--check', metavar='BASELINE', help='compare against a baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed slowdown, 0.5 = 50%%')
+    parser.add_argument('--min-delta-ms', type=float, default=0.1, help='ignore slowdowns smaller than this')
+    parser.add_argument('--update-baseline', metavar='BASELINE', help='store these results as the baseline')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {str(users): run(users, args.repeat) for users in args.users}
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.update_baseline:
+        with open(args.update_baseline, 'w') as f:
+            f.write(report + '\n')
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold, args.min_delta_ms)
+        for size, name, expected, current in found:
+            print(f"REGRESSION {name} at {int(size):,} users: {current:.3f} ms vs baseline {expected:.3f} ms",
+                  file=sys.stderr)
+        if found:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.check}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Local stand-in for the Telegram Bot API, for load tests without network access.
+# Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>/bot
+#
+#   python -m benchmarks.fake_bot_api --port 8081 --latency 0.05 --flood-rate 0.01
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Methods that count against Telegram's flood limits and may get a 429
+FLOOD_METHODS = {'sendMessage', 'editMessageText', 'sendDocument'}
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, member_rate: float = 1.0, rng_seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.member_rate = member_rate
+        self.rng = random.Random(rng_seed)
+        self.calls = Counter()
+        self.floods = Counter()
+        self.listeners = []  # fn(method, params) called for every successful call
+        self.message_ids = itertools.count(1)
+        self.webhook_set = asyncio.Event()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081):
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        if method in FLOOD_METHODS and self.rng.random() < self.flood_rate:
+            self.floods[method] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        self.calls[method] += 1
+        if method == 'setWebhook':
+            self.webhook_set.set()
+        for listener in self.listeners:
+            listener(method, params)
+        return web.json_response({'ok': True, 'result': self.result(method, params)})
+
+    async def stats(self, request):
+        return web.json_response({'calls': dict(self.calls), 'floods': dict(self.floods)})
+
+    # PTB sends form fields with JSON-encoded values (multipart when uploading files)
+    async def _params(self, request):
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        if method == 'getChatMember':
+            status = 'member' if self.rng.random() < self.member_rate else 'left'
+            return {'status': status, 'user': {'id': params.get('user_id'), 'is_bot': False, 'first_name': 'user'}}
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            return {
+                'message_id': params.get('message_id') or next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id'), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds per call')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--member-rate', type=float, default=1.0, help='share of users reported as channel members')
+    args = parser.parse_args()
+    api = FakeBotAPI(args.latency, args.jitter, args.flood_rate, args.retry_after, args.member_rate)
+    web.run_app(api.app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
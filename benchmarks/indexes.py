@@ -0,0 +1,105 @@
+# Compare the hot queries before and after the index migration.
+#
+#   python -m benchmarks.indexes --users 100000 1000000
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from benchmarks.seed import seed
+from telegram_bot import migrate
+
+BASE_VERSION = 1  # Schema version before the hot path indexes
+
+QUERIES = {
+    'get_referrals': (
+        'SELECT user_id, username FROM users WHERE referrer_id = ?',
+        lambda rng, users: (rng.randint(1, max(1, users // 10)),),
+    ),
+    'get_pending_tasks': (
+        '''
+        SELECT t.task_id, t.title, t.description, t.payment_price
+        FROM tasks t
+        JOIN user_tasks ut ON t.task_id = ut.task_id
+        WHERE ut.user_id = ? AND ut.pending = 1
+        ''',
+        lambda rng, users: (rng.randint(1, users),),
+    ),
+    'get_completed_tasks': (
+        '''
+        SELECT t.task_id, t.title, t.description, t.payment_price
+        FROM tasks t
+        JOIN user_tasks ut ON t.task_id = ut.task_id
+        WHERE ut.user_id = ? AND ut.completed = 1
+        ''',
+        lambda rng, users: (rng.randint(1, users),),
+    ),
+    'get_withdrawal_history': (
+        '''
+        SELECT withdrawal_id, amount, upi_id, status, timestamp
+        FROM withdrawals WHERE user_id = ? ORDER BY timestamp DESC
+        ''',
+        lambda rng, users: (rng.randint(1, users),),
+    ),
+    'get_pending_withdrawals': (
+        '''
+        SELECT w.withdrawal_id, w.user_id, w.amount, w.upi_id, w.timestamp, u.username
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.user_id
+        WHERE w.status = 'pending' ORDER BY w.timestamp DESC
+        ''',
+        lambda rng, users: (),
+    ),
+}
+
+
+# Median milliseconds per call
+def time_query(conn, sql, params, users, repeat):
+    rng = random.Random(7)
+    timings = []
+    for _ in range(repeat):
+        args = params(rng, users)
+        started = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def query_plan(conn, sql, params, users):
+    rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params(random.Random(7), users)).fetchall()
+    return '; '.join(row[3] for row in rows)
+
+
+def run(users, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'), isolation_level=None)
+        migrate(conn, target=BASE_VERSION)
+        started = time.perf_counter()
+        seed(conn, users)
+        print(f"\n{users:,} users (seeded in {time.perf_counter() - started:.1f}s)")
+        scans = {name: time_query(conn, sql, params, users, repeat) for name, (sql, params) in QUERIES.items()}
+        started = time.perf_counter()
+        migrate(conn)
+        print(f"indexes built in {time.perf_counter() - started:.1f}s")
+        print(f"{'query':<26}{'scan ms':>12}{'index ms':>12}{'speedup':>10}  plan")
+        for name, (sql, params) in QUERIES.items():
+            indexed = time_query(conn, sql, params, users, repeat)
+            print(f"{name:<26}{scans[name]:>12.3f}{indexed:>12.3f}{scans[name] / indexed:>9.0f}x  "
+                  f"{query_plan(conn, sql, params, users)}")
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    for users in args.users:
+        run(users, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# Offline load test: runs telegram_bot.py against the fake Bot API and posts
+# synthetic updates to its webhook at a target rate.
+#
+#   python -m benchmarks.loadtest --rate 200 --duration 30 --api-latency 0.05
+#
+# Reports webhook ack latency (time to enqueue) and end-to-end latency (time
+# until the bot's reply reaches the fake API), plus sustained throughput.
+# Updates the per-user throttle turned away (a "slow down" answer instead of a
+# reply) are counted on their own, not as answered or timed out.
+import argparse
+import asyncio
+import logging
+import os
+import random
+import secrets
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.seed import TASKS, seed
+from benchmarks.updates import UpdateFactory, user_session
+from telegram_bot import MESSAGE_THROTTLED_TEXT, THROTTLED_TEXT, TokenBucket, migrate
+
+FIRST_SESSION_USER = 10 ** 9  # Session users never collide with seeded users
+REPLY_METHODS = {'sendMessage', 'editMessageText'}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotAPI(args.api_latency, args.api_jitter, args.flood_rate)
+        self.api.listeners.append(self.on_api_call)
+        self.waiting = {}  # chat_id -> future resolved by the bot's next reply, None if throttled
+        self.queries = {}  # callback_query_id -> chat_id of the callback being waited on
+        self.ack_latencies = []
+        self.e2e_latencies = []
+        self.errors = 0
+        self.timeouts = 0
+        self.throttled = 0
+        self.rate = TokenBucket(args.rate)
+
+    def on_api_call(self, method, params):
+        if method in REPLY_METHODS:
+            throttled = params.get('text') == MESSAGE_THROTTLED_TEXT
+            self._resolve(params.get('chat_id'), None if throttled else time.perf_counter())
+        elif method == 'answerCallbackQuery':
+            chat_id = self.queries.pop(str(params.get('callback_query_id')), None)
+            if params.get('text') == THROTTLED_TEXT:
+                self._resolve(chat_id, None)
+
+    def _resolve(self, chat_id, replied_at):
+        future = self.waiting.pop(chat_id, None)
+        if future and not future.done():
+            future.set_result(replied_at)
+
+    async def post(self, session, url, secret, update, user_id):
+        await self.rate.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[user_id] = future
+        if 'callback_query' in update:
+            self.queries[update['callback_query']['id']] = user_id
+        started = time.perf_counter()
+        try:
+            async with session.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+                await response.read()
+                self.ack_latencies.append(time.perf_counter() - started)
+                if response.status != 200:
+                    self.errors += 1
+                    self.waiting.pop(user_id, None)
+                    return
+        except aiohttp.ClientError:
+            self.errors += 1
+            self.waiting.pop(user_id, None)
+            return
+        try:
+            replied = await asyncio.wait_for(future, self.args.reply_timeout)
+            if replied is None:
+                self.throttled += 1
+            else:
+                self.e2e_latencies.append(replied - started)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.waiting.pop(user_id, None)
+
+    # Each user sends its next update only after the previous one was answered
+    async def run_user(self, session, url, secret, updates, user_id, deadline):
+        for update in updates:
+            if time.perf_counter() > deadline:
+                return
+            await self.post(session, url, secret, update, user_id)
+
+    async def run(self):
+        args = self.args
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'loadtest.db')
+            conn = sqlite3.connect(db_path, isolation_level=None)
+            migrate(conn)
+            seed(conn, args.referrers)
+            conn.close()
+
+            api_runner = await self.api.start(port=args.api_port)
+            secret = secrets.token_hex(16)
+            env = dict(
+                os.environ,
+                BOT_TOKEN='123456:LOADTEST',
+                TELEGRAM_API_URL=f'http://127.0.0.1:{args.api_port}/bot',
+                WEBHOOK_URL=f'http://127.0.0.1:{args.bot_port}',
+                WEBHOOK_SECRET=secret,
+                PORT=str(args.bot_port),
+                DB_PATH=db_path,
+                TELEGRAM_RATE_LIMIT=str(args.telegram_rate),
+                WEBHOOK_WORKERS=str(args.workers),
+            )
+            log = open(os.path.join(tmp, 'bot.log'), 'w')
+            bot = subprocess.Popen([sys.executable, 'telegram_bot.py'], env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                await asyncio.wait_for(self.api.webhook_set.wait(), 30)
+                await asyncio.sleep(0.5)  # setWebhook is sent just before the web server starts
+                await self.drive(secret)
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f'http://127.0.0.1:{args.bot_port}/queue') as response:
+                        queue_stats = await response.json()
+            except asyncio.TimeoutError:
+                log.flush()
+                with open(log.name) as f:
+                    print(f.read()[-2000:])
+                raise SystemExit('bot did not start')
+            finally:
+                bot.send_signal(signal.SIGINT)
+                try:
+                    bot.wait(10)
+                except subprocess.TimeoutExpired:
+                    bot.kill()
+                log.close()
+                await api_runner.cleanup()
+            self.report(queue_stats)
+
+    async def drive(self, secret):
+        args = self.args
+        url = f'http://127.0.0.1:{args.bot_port}/webhook'
+        factory = UpdateFactory()
+        rng = random.Random(7)
+        referrers = range(1, args.referrers + 1)
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        self.started = time.perf_counter()
+        deadline = self.started + args.duration
+        async with aiohttp.ClientSession(connector=connector) as session:
+            users = []
+            for i in range(args.concurrency):
+                user_id = FIRST_SESSION_USER + i
+                updates = user_session(factory, rng, user_id, referrers, TASKS)
+                users.append(self.run_user(session, url, secret, updates, user_id, deadline))
+            await asyncio.gather(*users)
+        self.elapsed = time.perf_counter() - self.started
+
+    def report(self, queue_stats):
+        completed = len(self.e2e_latencies)
+        print(f"updates acked:      {len(self.ack_latencies)} ({self.errors} errors)")
+        print(f"updates answered:   {completed} ({self.timeouts} timed out, {self.throttled} throttled)")
+        print(f"throughput:         {completed / self.elapsed:.1f} updates/s over {self.elapsed:.1f}s")
+        for name, values in (('webhook ack', self.ack_latencies), ('end-to-end', self.e2e_latencies)):
+            ms = [v * 1000 for v in values]
+            print(f"{name + ' ms':<20}p50 {percentile(ms, 50):8.1f}  p95 {percentile(ms, 95):8.1f}  "
+                  f"p99 {percentile(ms, 99):8.1f}  mean {statistics.fmean(ms) if ms else 0:8.1f}")
+        print(f"bot API calls:      {dict(self.api.calls)}")
+        print(f"429s injected:      {dict(self.api.floods)}")
+        print(f"bot update queue:   {queue_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for telegram_bot.py')
+    parser.add_argument('--rate', type=float, default=100, help='target updates per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to send updates for')
+    parser.add_argument('--concurrency', type=int, default=500, help='users with a session in progress')
+    parser.add_argument('--referrers', type=int, default=1000, help='existing users new users are referred by')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='fake Bot API seconds per call')
+    parser.add_argument('--api-jitter', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--telegram-rate', type=float, default=1000, help='TELEGRAM_RATE_LIMIT for the bot')
+    parser.add_argument('--workers', type=int, default=1, help='WEBHOOK_WORKERS for the bot')
+    parser.add_argument('--reply-timeout', type=float, default=10)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--bot-port', type=int, default=8443)
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(LoadTest(parser.parse_args()).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Seed a bot database with synthetic data for benchmarks
+import random
+from datetime import datetime, timedelta
+
+TASKS = 50
+TASKS_PER_USER = 2
+USERS_PER_WITHDRAWAL = 10
+REFERRED_SHARE = 0.6
+PENDING_WITHDRAWAL_SHARE = 0.02  # Most withdrawals have already been processed
+
+
+def _timestamp(start: datetime, seconds: int):
+    return (start + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Fill an already migrated database with `users` users and proportional tasks,
+# submissions and withdrawals. Referrers are skewed towards early users so a
+# few accounts end up with large downlines, like in production.
+def seed(conn, users: int, rng_seed: int = 42):
+    rng = random.Random(rng_seed)
+    start = datetime(2024, 1, 1)
+    conn.execute('BEGIN')
+    conn.executemany(
+        'INSERT INTO tasks (title, description, payment_price, question) VALUES (?, ?, ?, ?)',
+        ((f'Task {i}', f'Description of task {i}', rng.randint(1, 20), f'Question {i}?') for i in range(1, TASKS + 1))
+    )
+
+    columns = ['user_id', 'username', 'joined_channel', 'balance', 'referrer_id', 'upi_id']
+    has_joined_at = any(row[1] == 'joined_at' for row in conn.execute('PRAGMA table_info(users)'))
+    if has_joined_at:
+        columns.append('joined_at')
+
+    def user_rows():
+        for user_id in range(1, users + 1):
+            referrer_id = None
+            if user_id > 1 and rng.random() < REFERRED_SHARE:
+                referrer_id = rng.randint(1, max(1, user_id // 10))
+            row = (user_id, f'user{user_id}', 1, rng.randint(0, 500), referrer_id, f'user{user_id}@upi')
+            yield row + (_timestamp(start, user_id * 60),) if has_joined_at else row
+
+    conn.executemany(
+        f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        user_rows()
+    )
+
+    submissions = []
+    for user_id in range(1, users + 1):
+        for task_id in rng.sample(range(1, TASKS + 1), TASKS_PER_USER):
+            completed = rng.random() < 0.7
+            submissions.append((user_id, task_id, int(completed), int(not completed)))
+        if len(submissions) >= 100000:
+            _insert_submissions(conn, submissions)
+            submissions = []
+    _insert_submissions(conn, submissions)
+
+    conn.executemany(
+        'INSERT INTO withdrawals (user_id, amount, upi_id, status, timestamp) VALUES (?, ?, ?, ?, ?)',
+        ((user_id, 15, f'user{user_id}@upi', _withdrawal_status(rng), _timestamp(start, i * 37))
+         for i, user_id in enumerate(rng.randint(1, users) for _ in range(max(1, users // USERS_PER_WITHDRAWAL))))
+    )
+    conn.execute('COMMIT')
+
+
+def _withdrawal_status(rng):
+    if rng.random() < PENDING_WITHDRAWAL_SHARE:
+        return 'pending'
+    return 'approved' if rng.random() < 0.9 else 'declined'
+
+
+def _insert_submissions(conn, submissions):
+    conn.executemany('INSERT INTO user_tasks (user_id, task_id, completed, pending) VALUES (?, ?, ?, ?)', submissions)
+    conn.executemany(
+        'INSERT INTO task_responses (user_id, task_id, response) VALUES (?, ?, ?)',
+        ((user_id, task_id, f'answer from {user_id}') for user_id, task_id, _, _ in submissions)
+    )
@@ -0,0 +1,78 @@
+# Synthetic webhook updates shaped like the ones Telegram sends the bot
+import itertools
+import random
+
+from telegram_bot import router
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+
+
+class UpdateFactory:
+    def __init__(self, date: int = 1700000000):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.date = date
+
+    def _user(self, user_id: int):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id: int, text: str):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': self.date,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def command(self, user_id: int, command: str, *args):
+        return self.message(user_id, ' '.join((f'/{command}',) + tuple(str(arg) for arg in args)))
+
+    def callback(self, user_id: int, data: str):
+        update_id = next(self.update_ids)
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': self.date,
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': BOT_USER,
+                    'text': 'menu',
+                },
+            },
+        }
+
+
+# One user's visit: /start (sometimes via a referral link), a walk through the
+# menus, a task submission and a withdrawal attempt. Every update gets a reply
+# (sendMessage or editMessageText) addressed to the user.
+def user_session(factory: UpdateFactory, rng: random.Random, user_id: int, referrers: range,
+                 tasks: int, referral_share: float = 0.5):
+    updates = []
+    if referrers and rng.random() < referral_share:
+        updates.append(factory.command(user_id, 'start', rng.choice(referrers)))
+    else:
+        updates.append(factory.command(user_id, 'start'))
+    task_id = rng.randint(1, tasks)
+    updates += [
+        factory.callback(user_id, 'tasks'),
+        factory.callback(user_id, router.data('t', task_id)),
+        factory.callback(user_id, router.data('c', task_id)),
+        factory.message(user_id, f'answer from {user_id}'),
+    ]
+    for data in rng.sample(['insights', 'account', 'pending_completed', 'announcements', 'about'], 2):
+        updates.append(factory.callback(user_id, data))
+    updates += [
+        factory.callback(user_id, 'withdraw'),
+        factory.callback(user_id, 'request_withdrawal'),
+        factory.callback(user_id, 'back'),
+    ]
+    return updates
@@ -1,18 +1,41 @@
 import sqlite3
+import bisect
+import functools
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import queue
+import re
+import resource
+import sys
+import threading
+import signal
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
+    BasePersistence,
+    BaseRateLimiter,
+    PersistenceInput,
     filters,
     ContextTypes,
 )
-from telegram.error import TelegramError
-from datetime import datetime
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
+from datetime import datetime, timezone
 import asyncio
+import csv
+import tempfile
+import aiohttp
 from aiohttp import web
 
 # Set up logging
@@ -25,17 +48,591 @@ logger = logging.getLogger(__name__)
 # Bot configuration
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Set in Koyeb environment variables
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Set in Koyeb environment variables
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # Override to use a local Bot API server
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@Powerbank_Earning_Websites")  # Replace with your channel username
 ADMIN_IDS = [6972264549]  # Replace with your Telegram ID
 PORT = int(os.getenv("PORT", 8443))  # Default port for Koyeb
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_READERS = int(os.getenv("DB_READERS", 4))  # Reader threads for SQLite queries
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")  # Storage backend: sqlite or postgres
+DATABASE_URL = os.getenv("DATABASE_URL")  # PostgreSQL DSN, used with DB_BACKEND=postgres
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))  # PostgreSQL connections per process
+DB_SERIALIZATION_RETRIES = 5  # PostgreSQL write transactions retried after a serialization failure
+POSTGRES_CURSOR_BATCH = 1000  # Rows fetched per round trip when a PostgreSQL query result is iterated
+DB_LOCK_RETRIES = 4  # SQLite write batches retried (with backoff) when another process holds the write lock
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", 30))  # Global Bot API messages per second
+BROADCAST_RATE_SHARE = float(os.getenv("BROADCAST_RATE_SHARE", 0.75))  # Share of the global limit lent to worker 0 while it broadcasts
+BROADCAST_BATCH_SIZE = 200  # Users per persisted progress checkpoint
+SEND_MAX_ATTEMPTS = 5  # Delivery attempts per queued outbound message
+PER_CHAT_RATE_LIMIT = 1.0  # Messages per second to a single chat
+PER_CHAT_BURST = 3  # Messages a single chat can receive back to back
+PER_CHAT_TRACKED = 100000  # Chats whose send budget is kept in memory
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 32))  # Concurrent deliveries of queued messages
+PRIORITY_INTERACTIVE = 0  # Replies and edits for the user who just acted
+PRIORITY_NOTIFICATION = 1  # Notifications about someone else's action
+PRIORITY_BROADCAST = 2  # Broadcasts and background checks
+RATE_LIMITED_ENDPOINTS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument', 'sendPhoto', 'copyMessage', 'forwardMessage'}
+USER_THROTTLE_BUDGETS = {  # Per-user (actions per second, burst) by route cost
+    'cheap': (3.0, 10),
+    'expensive': (1.0, 4),  # Routes that move money
+    'notice': (0.1, 1),  # "Slow down" replies to throttled messages
+}
+USER_THROTTLE_TRACKED = 100000  # Per-user buckets kept in memory
+USER_THROTTLE_IDLE = 300  # Seconds after which an untouched user bucket is dropped
+PER_CHAT_ENDPOINTS = {'sendMessage', 'sendDocument', 'sendPhoto', 'copyMessage', 'forwardMessage'}  # Edits don't add to a chat's budget
+USER_PAGE_SIZE = 20  # Users per admin directory page
+REFERRAL_LIST_LIMIT = 30  # Referrals listed on the Insights screen
+REFERRER_SHARE = 0.5  # Share of a task reward paid to the referrer
+REFERRAL_LEVELS = 10  # Levels of each user's downline kept in the referral index
+REFERRAL_TOP_SIZE = 10  # Referrers listed by /referrals
+EARNING_KINDS = ('task_reward', 'referral_bonus', 'bonus')  # Ledger entries counted as earnings on the leaderboard
+LEADERBOARD_SIZE = 10  # Users listed per leaderboard
+LEADERBOARD_REFRESH = float(os.getenv("LEADERBOARD_REFRESH", 60))  # Seconds a leaderboard snapshot is served
+IDEMPOTENCY_KEY_TTL = 7 * 86400  # Seconds a money-moving action's key is kept to reject duplicates
+IDEMPOTENCY_PRUNE_INTERVAL = 3600  # Seconds between sweeps of expired idempotency keys
+PAYOUT_BATCH_LIMIT = int(os.getenv("PAYOUT_BATCH_LIMIT", 5000))  # Withdrawals approved per bulk approval
+PENDING_WITHDRAWALS_SHOWN = 10  # Withdrawals listed on the admin withdrawal screen
+ADMIN_DIGEST_SECONDS = float(os.getenv("ADMIN_DIGEST_SECONDS", 60))  # Admin notification digest window, 0 sends every event
+URGENT_WITHDRAWAL_AMOUNT = int(os.getenv("URGENT_WITHDRAWAL_AMOUNT", 100))  # Withdrawals this large skip the digest
+ADMIN_DIGEST_PREVIEWS = 3  # Events quoted per kind in a digest
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Optional secret_token Telegram sends with every webhook call
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))  # Parallel update workers, sharded by user
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 2000))  # Updates buffered across all workers
+UPDATE_ENQUEUE_TIMEOUT = 5  # Seconds the webhook waits for queue space before asking Telegram to retry
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))  # Worker processes behind a front process, 1 runs everything in one process
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", tempfile.gettempdir())  # Where the worker processes' unix sockets live
+WORKER_START_TIMEOUT = 60  # Seconds the front process waits for its workers to come up
+CATALOG_CHECK_INTERVAL = 5  # Seconds between checks for task changes made by other processes
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 30))  # Seconds between user_data/bot_data flushes
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", 600))  # Seconds a channel membership lookup is trusted
+MEMBERSHIP_CACHE_SIZE = 100000  # Membership lookups kept in memory
+MEMBERSHIP_RECHECK_INTERVAL = float(os.getenv("MEMBERSHIP_RECHECK_INTERVAL", 30))  # Seconds between re-check rounds
+MEMBERSHIP_RECHECK_BATCH = int(os.getenv("MEMBERSHIP_RECHECK_BATCH", 100))  # Users re-checked per round
+MEMBERSHIP_RECHECK_ATTEMPTS = 5  # Re-checks (with backoff) before we stop watching a user
 
-# Database setup
-def init_db():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    
+# Minimal Prometheus text-format metrics. Values are also updated from the
+# database threads, so every metric guards its samples with a lock.
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    def __init__(self, name: str, help_text: str, kind: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def label_text(self, values: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{_label_value(value)}"' for key, value in pairs) + '}'
+
+class Counter(Metric):
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        super().__init__(name, help_text, 'counter', labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{self.label_text(labels)} {value}" for labels, value in values]
+
+# Value read from a callback at scrape time; kind='counter' for totals kept elsewhere
+class Gauge(Metric):
+    def __init__(self, name: str, help_text: str, fn, kind: str = 'gauge'):
+        super().__init__(name, help_text, kind)
+        self.fn = fn
+
+    def render(self):
+        return self.header() + [f"{self.name} {self.fn()}"]
+
+class Histogram(Metric):
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labels)
+        self.buckets = buckets
+        self.series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, seconds: float, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self.series.items())
+        lines = self.header()
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self.label_text(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{self.label_text(labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{self.label_text(labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = ()):
+        return self.register(Histogram(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, fn, kind: str = 'gauge'):
+        return self.register(Gauge(name, help_text, fn, kind))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+# Resident memory of this process in bytes
+def process_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', 'Update handler latency', ('handler',))
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Update handlers that raised', ('handler',))
+CALLBACK_ROUTE_SECONDS = metrics.histogram('bot_callback_route_seconds', 'Callback route latency', ('route',))
+DB_QUERY_SECONDS = metrics.histogram('bot_db_query_seconds', 'Database time per data function', ('function', 'mode'))
+DB_COMMIT_SECONDS = metrics.histogram('bot_db_commit_seconds', 'SQLite group commit latency')
+TELEGRAM_API_SECONDS = metrics.histogram('bot_telegram_api_seconds', 'Bot API request latency', ('method',))
+TELEGRAM_API_RESPONSES = metrics.counter('bot_telegram_api_responses_total', 'Bot API responses by status', ('method', 'status'))
+USER_THROTTLED = metrics.counter('bot_user_throttled_total', 'Callbacks and messages shed by the per-user throttle', ('reason',))
+IDEMPOTENT_DUPLICATES = metrics.counter('bot_idempotent_duplicates_total', 'Money-moving callbacks dropped as duplicates', ('action',))
+TELEGRAM_FLOOD_WAITS = metrics.counter('bot_telegram_flood_waits_total', 'Bot API 429 (RetryAfter) responses', ('method',))
+metrics.gauge('bot_process_resident_memory_bytes', 'Resident memory of the bot process', process_rss_bytes)
+
+# Persistent SQLite access layer: one writer thread, a small reader pool, WAL mode.
+# Writes queued while a transaction is running are committed together (group commit),
+# each in its own savepoint so one failing statement doesn't roll back its neighbours.
+class Database:
+    errors = (sqlite3.Error,)  # What a failed query raises
+
+    def __init__(self, path: str, readers: int = 4, write_batch: int = 64):
+        self.path = path
+        self.readers = readers
+        self.write_batch = write_batch
+        self._writes = queue.SimpleQueue()
+        self._writer = None
+        self._reader_pool = None
+        self._reader_conns = []
+        self._local = threading.local()
+
+    def _connect(self):
+        # cached_statements keeps compiled statements per connection, keyed by SQL text
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+
+    async def start(self):
+        self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer.start()
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=self.readers, thread_name_prefix='db-reader', initializer=self._open_reader
+        )
+
+    async def close(self):
+        self._writes.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._reader_pool.shutdown(wait=True)
+        for conn in self._reader_conns:
+            conn.close()
+
+    # Apply pending schema migrations, returns the resulting schema version
+    async def migrate(self):
+        return await self.write(migrate)
+
+    def _open_reader(self):
+        self._local.conn = self._connect()
+        self._reader_conns.append(self._local.conn)
+
+    def _run_read(self, fn, args, name):
+        started = time.perf_counter()
+        try:
+            return fn(self._local.conn, *args)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'read')
+
+    # Run fn(conn, *args) on a reader connection. Timings are recorded under
+    # name, by default the function's name without its leading underscore.
+    async def read(self, fn, *args, name: str = None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader_pool, self._run_read, fn, args, name or fn.__name__.lstrip('_'))
+
+    # Run fn(conn, *args) inside a write transaction and wait for the commit
+    async def write(self, fn, *args, name: str = None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((fn, args, name or fn.__name__.lstrip('_'), loop, future))
+        return await future
+
+    # Run callback(*args) on the event loop once the current write job has committed.
+    # Dropped if the job rolls back; outside a write job it runs straight away.
+    def after_commit(self, callback, *args):
+        hooks = getattr(self._local, 'hooks', None)
+        if hooks is None:
+            callback(*args)
+        else:
+            hooks.append((callback, args))
+
+    # The helpers below are timed under the data function that called them
+    async def fetchone(self, sql: str, params=()):
+        return await self.read(_fetchone, sql, params, name=sys._getframe(1).f_code.co_name)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.read(_fetchall, sql, params, name=sys._getframe(1).f_code.co_name)
+
+    # Execute a single write statement and return the number of affected rows
+    async def execute(self, sql: str, params=()):
+        return await self.write(_execute, sql, params, name=sys._getframe(1).f_code.co_name)
+
+    def _writer_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._writes.get()]
+            while len(batch) < self.write_batch:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+            if batch:
+                try:
+                    self._commit_batch(conn, batch)
+                except Exception as e:
+                    # A failing SAVEPOINT, RELEASE or ROLLBACK TO (disk full, I/O error)
+                    # fails the batch; the writer keeps serving later ones
+                    logger.error(f"Database write batch failed: {e}")
+                    self._local.hooks = None
+                    try:
+                        if conn.in_transaction:
+                            conn.rollback()
+                    except sqlite3.Error as rollback_error:
+                        logger.error(f"Database rollback failed: {rollback_error}")
+                    for _, _, _, loop, future in batch:
+                        loop.call_soon_threadsafe(_resolve_future, future, None, e)
+        conn.close()
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        # Worker processes share the database file, so the write lock may stay
+        # busy past busy_timeout; back off and try again before failing the batch
+        for attempt in itertools.count():
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                break
+            except sqlite3.OperationalError as e:
+                if e.sqlite_errorcode not in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) or attempt >= DB_LOCK_RETRIES:
+                    logger.error(f"Database write lock unavailable: {e}")
+                    for _, _, _, loop, future in batch:
+                        loop.call_soon_threadsafe(_resolve_future, future, None, e)
+                    return
+                logger.warning(f"Database write lock busy, retrying batch of {len(batch)} (attempt {attempt + 1})")
+                time.sleep(0.1 * 2 ** attempt)
+        for fn, args, name, loop, future in batch:
+            conn.execute('SAVEPOINT job')
+            self._local.hooks = hooks = []
+            started = time.perf_counter()
+            try:
+                result = fn(conn, *args)
+            except Exception as e:
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                outcomes.append((loop, future, None, e, ()))
+            else:
+                conn.execute('RELEASE job')
+                outcomes.append((loop, future, result, None, hooks))
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'write')
+        self._local.hooks = None
+        started = time.perf_counter()
+        try:
+            conn.execute('COMMIT')
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        except sqlite3.Error as e:
+            logger.error(f"Database commit failed: {e}")
+            conn.rollback()
+            outcomes = [(loop, future, None, e, ()) for loop, future, _, _, _ in outcomes]
+        for loop, future, result, error, hooks in outcomes:
+            loop.call_soon_threadsafe(_resolve_future, future, result, error, hooks)
+
+def _run_hooks(hooks):
+    for callback, args in hooks:
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"After-commit hook {callback.__qualname__} failed: {e}")
+
+def _resolve_future(future, result, error, hooks=()):
+    _run_hooks(hooks)
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+# PostgreSQL backend with the same interface as Database, on an asyncpg connection pool.
+# Data functions are written against sqlite3 connections, so write() and read() run them
+# in a worker thread over a thin sqlite3-style adapter whose statements are executed on
+# the event loop. Writes run as SERIALIZABLE transactions and are retried after a
+# serialization failure; single statements (fetchone, fetchall, execute) skip the thread.
+class PostgresDatabase:
+    def __init__(self, dsn: str, pool_size: int = 10, retries: int = DB_SERIALIZATION_RETRIES):
+        import asyncpg  # Only needed with DB_BACKEND=postgres
+        self.asyncpg = asyncpg
+        self.errors = (asyncpg.PostgresError, asyncpg.InterfaceError)
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.retries = retries
+        self._pool = None
+        self._threads = None
+        self._local = threading.local()
+
+    async def start(self):
+        self._pool = await self.asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        self._threads = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='db-postgres')
+
+    async def close(self):
+        await self._pool.close()
+        self._threads.shutdown(wait=True)
+
+    # Apply pending schema migrations, returns the resulting schema version
+    async def migrate(self):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+                # Worker processes starting together wait here for the first one's migration
+                await conn.execute('LOCK TABLE schema_version')
+                version = await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+                for number, statements in POSTGRES_MIGRATIONS:
+                    if number <= version:
+                        continue
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', number)
+                    logger.info(f"Applied PostgreSQL schema version {number}")
+                    version = number
+        return version
+
+    def _run_job(self, conn, fn, args, hooks):
+        self._local.hooks = hooks
+        try:
+            return fn(conn, *args)
+        finally:
+            self._local.hooks = None
+
+    # Run fn(conn, *args) in a read-only snapshot
+    async def read(self, fn, *args, name: str = None):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    return await loop.run_in_executor(
+                        self._threads, self._run_job, PostgresConnection(conn, loop), fn, args, None
+                    )
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name or fn.__name__.lstrip('_'), 'read')
+
+    # Run fn(conn, *args) inside a write transaction and wait for the commit.
+    # Like the SQLite writer, a write whose caller is cancelled still runs to completion.
+    async def write(self, fn, *args, name: str = None):
+        return await asyncio.shield(self._write(fn, args, name or fn.__name__.lstrip('_')))
+
+    async def _write(self, fn, args, name):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.retries + 1):
+            hooks = []
+            started = time.perf_counter()
+            try:
+                async with self._pool.acquire() as conn:
+                    async with conn.transaction(isolation='serializable'):
+                        result = await loop.run_in_executor(
+                            self._threads, self._run_job, PostgresConnection(conn, loop), fn, args, hooks
+                        )
+            except (self.asyncpg.SerializationError, self.asyncpg.DeadlockDetectedError):
+                if attempt == self.retries:
+                    raise
+                continue
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'write')
+            _run_hooks(hooks)
+            return result
+
+    # Same contract as Database.after_commit; hooks of a retried transaction are dropped with it
+    def after_commit(self, callback, *args):
+        hooks = getattr(self._local, 'hooks', None)
+        if hooks is None:
+            callback(*args)
+        else:
+            hooks.append((callback, args))
+
+    # The helpers below are timed under the data function that called them
+    async def fetchone(self, sql: str, params=()):
+        name = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            row = await self._pool.fetchrow(_postgres_sql(sql)[0], *params)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'read')
+        return None if row is None else tuple(row)
+
+    async def fetchall(self, sql: str, params=()):
+        name = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            rows = await self._pool.fetch(_postgres_sql(sql)[0], *params)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'read')
+        return [tuple(row) for row in rows]
+
+    # Execute a single write statement and return the number of affected rows
+    async def execute(self, sql: str, params=()):
+        name = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            status = await self._pool.execute(_postgres_sql(sql)[0], *params)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name, 'write')
+        return _status_rowcount(status)
+
+# sqlite3-style connection over an asyncpg connection, used from a worker thread
+class PostgresConnection:
+    def __init__(self, conn, loop):
+        self.conn = conn
+        self.loop = loop
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # Queries run through a server-side cursor, so a result that is iterated
+    # (like a whole-table scan) is only held POSTGRES_CURSOR_BATCH rows at a time
+    def execute(self, sql: str, params=()):
+        sql, returns_rows, is_query = _postgres_sql(sql)
+        if is_query:
+            cursor, rows = self._run(self._open_cursor(sql, params))
+            return PostgresCursor(self, cursor, rows)
+        if returns_rows:
+            rows = self._run(self.conn.fetch(sql, *params))
+            return PostgresCursor(self, None, rows, len(rows))
+        return PostgresCursor(self, None, [], _status_rowcount(self._run(self.conn.execute(sql, *params))))
+
+    def executemany(self, sql: str, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if seq_of_params:
+            self._run(self.conn.executemany(_postgres_sql(sql)[0], seq_of_params))
+        return PostgresCursor(self, None, [])
+
+    async def _open_cursor(self, sql: str, params):
+        cursor = await self.conn.cursor(sql, *params)
+        return cursor, await cursor.fetch(POSTGRES_CURSOR_BATCH)
+
+# Rows of a statement; the rest of a query's rows are fetched from its
+# server-side cursor as the current batch runs out
+class PostgresCursor:
+    def __init__(self, connection: PostgresConnection, cursor, rows: list, rowcount: int = -1):
+        self.connection = connection
+        self.cursor = cursor if len(rows) == POSTGRES_CURSOR_BATCH else None
+        self.rows = iter(rows)
+        self.rowcount = rowcount
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows, None)
+        if row is None and self.cursor is not None:
+            rows = self.connection._run(self.cursor.fetch(POSTGRES_CURSOR_BATCH))
+            if len(rows) < POSTGRES_CURSOR_BATCH:
+                self.cursor = None
+            self.rows = iter(rows)
+            row = next(self.rows, None)
+        if row is None:
+            raise StopIteration
+        return tuple(row)
+
+    def fetchone(self):
+        return next(self, None)
+
+    def fetchall(self):
+        return list(self)
+
+# What CURRENT_TIMESTAMP stores in SQLite: UTC as 'YYYY-MM-DD HH:MM:SS' text
+POSTGRES_NOW = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+
+# Translate a data function's SQLite statement for PostgreSQL: ? placeholders become $n
+# (outside string literals) and CURRENT_TIMESTAMP keeps SQLite's text format.
+# Returns (sql, whether it returns rows, whether it only reads).
+@functools.lru_cache(maxsize=1024)
+def _postgres_sql(sql: str):
+    parts = sql.replace('CURRENT_TIMESTAMP', POSTGRES_NOW).split("'")
+    numbers = itertools.count(1)
+    for i in range(0, len(parts), 2):
+        pieces = parts[i].split('?')
+        parts[i] = pieces[0] + ''.join(f'${next(numbers)}{piece}' for piece in pieces[1:])
+    upper = sql.lstrip().upper()
+    is_query = upper.startswith(('SELECT', 'WITH')) and re.search(r'\b(INSERT|UPDATE|DELETE)\b', upper) is None
+    return "'".join(parts), is_query or 'RETURNING' in upper, is_query
+
+# Affected rows from a command tag such as 'UPDATE 3' or 'INSERT 0 1'
+def _status_rowcount(status: str) -> int:
+    count = status.rpartition(' ')[2]
+    return int(count) if count.isdigit() else -1
+
+if DB_BACKEND == 'postgres':
+    db = PostgresDatabase(DATABASE_URL, pool_size=DB_POOL_SIZE)
+else:
+    db = Database(DB_PATH, readers=DB_READERS)
+
+# Database schema migrations, applied in order and tracked in PRAGMA user_version.
+# Never edit a released migration; append a new one instead.
+
+# Migration 1: base schema
+def _migration_base_schema(conn):
     # Create users table with upi_id
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -45,13 +642,12 @@ def init_db():
             upi_id TEXT
         )
     ''')
-    # Add upi_id column if it doesn't exist
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN upi_id TEXT')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
+    # Add upi_id column to databases created before it existed
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+    if 'upi_id' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN upi_id TEXT')
     # Create tasks table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS tasks (
             task_id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
@@ -61,7 +657,7 @@ def init_db():
         )
     ''')
     # Create user tasks completion table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS user_tasks (
             user_id INTEGER,
             task_id INTEGER,
@@ -71,7 +667,7 @@ def init_db():
         )
     ''')
     # Create task responses table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS task_responses (
             user_id INTEGER,
             task_id INTEGER,
@@ -80,7 +676,7 @@ def init_db():
         )
     ''')
     # Create announcements table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS announcements (
             announcement_id INTEGER PRIMARY KEY AUTOINCREMENT,
             message TEXT NOT NULL,
@@ -88,7 +684,7 @@ def init_db():
         )
     ''')
     # Create withdrawals table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS withdrawals (
             withdrawal_id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -98,351 +694,1657 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Create broadcasts table (delivery progress of each announcement)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            announcement_id INTEGER,
+            admin_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+    ''')
+
+# Migration 2: covering indexes for the hot lookups
+def _migration_hot_path_indexes(conn):
+    # get_referrals
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_referrer ON users (referrer_id, user_id, username)')
+    # get_pending_tasks / get_completed_tasks
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_tasks_user ON user_tasks (user_id, completed, pending, task_id)')
+    # get_withdrawal_history
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_user_time
+        ON withdrawals (user_id, timestamp, amount, upi_id, status)
+    ''')
+    # get_pending_withdrawals
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_status_time
+        ON withdrawals (status, timestamp, user_id, amount, upi_id)
+    ''')
+
+# Migration 3: join date and indexes for the admin user directory
+def _migration_user_directory(conn):
+    conn.execute('ALTER TABLE users ADD COLUMN joined_at DATETIME')
+    # Real join dates of existing users are unknown, stamp them with the migration time
+    conn.execute('UPDATE users SET joined_at = CURRENT_TIMESTAMP')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance, user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_joined ON users (joined_at, user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (lower(username))')
+
+# Migration 4: per-user counters kept up to date by the writes that change them
+def _migration_user_stats(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            completed_tasks INTEGER NOT NULL DEFAULT 0,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            referral_earnings INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO user_stats (user_id, completed_tasks)
+        SELECT user_id, COUNT(*) FROM user_tasks WHERE completed = 1 GROUP BY user_id
+    ''')
+    # Referral earnings before this migration weren't recorded, rebuild them from approved
+    # tasks; CAST truncates like the int() that credits each referrer bonus
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, referral_count, referral_earnings)
+        SELECT r.referrer_id, COUNT(DISTINCT r.user_id),
+               COALESCE(SUM(CAST(t.payment_price * {REFERRER_SHARE} AS INTEGER)), 0)
+        FROM users r
+        LEFT JOIN user_tasks ut ON ut.user_id = r.user_id AND ut.completed = 1
+        LEFT JOIN tasks t ON t.task_id = ut.task_id
+        WHERE r.referrer_id IS NOT NULL
+        GROUP BY r.referrer_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            referral_count = excluded.referral_count,
+            referral_earnings = excluded.referral_earnings
+    ''')
+
+# Migration 5: partial index over pending submissions for the review queue
+def _migration_review_queue(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_tasks_pending ON user_tasks (task_id, user_id) WHERE pending = 1')
+
+# Migration 6: append-only ledger behind users.balance
+def _migration_ledger(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reference TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger_entries (user_id, amount)')
+    for action in ('UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS ledger_entries_no_{action.lower()}
+            BEFORE {action} ON ledger_entries
+            BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END
+        ''')
+    # Existing balances become opening entries so the ledger reconciles from day one
+    conn.execute('''
+        INSERT INTO ledger_entries (user_id, amount, kind)
+        SELECT user_id, balance, 'opening' FROM users WHERE balance != 0
+    ''')
+
+# Migration 7: payout batches for bulk withdrawal approval
+def _migration_payout_batches(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payout_batches (
+            batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            withdrawals INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('ALTER TABLE withdrawals ADD COLUMN batch_id INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_batch ON withdrawals (batch_id, withdrawal_id) WHERE batch_id IS NOT NULL')
+
+# Migration 8: user_data/bot_data kept across restarts
+def _migration_conversation_state(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    ''')
+
+# Migration 9: users waiting to join the channel, re-checked in batches
+def _migration_pending_memberships(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_memberships (
+            user_id INTEGER PRIMARY KEY,
+            due_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_memberships_due ON pending_memberships (due_at, user_id, attempts)')
+
+# Migration 10: lifetime earnings and the indexes behind the leaderboards
+def _migration_leaderboard(conn):
+    conn.execute('ALTER TABLE user_stats ADD COLUMN total_earned INTEGER NOT NULL DEFAULT 0')
+    # Opening balances are the best record of what users earned before the ledger existed
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, total_earned)
+        SELECT user_id, SUM(amount) FROM ledger_entries
+        WHERE amount > 0 AND kind IN ({', '.join('?' * len(EARNING_KINDS))}, 'opening')
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET total_earned = excluded.total_earned
+    ''', EARNING_KINDS)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_earned ON user_stats (total_earned DESC, user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_referrals ON user_stats (referral_count DESC, user_id)')
+
+# Migration 11: key/value counters shared by the worker processes
+def _migration_meta(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0)")
+
+# Migration 12: keys of money-moving actions already done, to drop duplicate callbacks
+def _migration_idempotency_keys(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            action TEXT NOT NULL,
+            key TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (action, key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)')
+
+# Fill the referral index from users.referrer_id. Portable SQL, shared by both backends.
+# Chains are followed through existing users only, and stop at self-referrals and where
+# they loop back to the user they started from. Users below an older, longer ring see
+# its members repeated, at most down to REFERRAL_LEVELS.
+REFERRAL_BACKFILL = [
+    f'''
+    WITH RECURSIVE paths (descendant_id, depth, ancestor_id, visited) AS (
+        SELECT u.user_id, 1, u.referrer_id, ',' || u.user_id || ',' || u.referrer_id || ','
+        FROM users u
+        JOIN users r ON r.user_id = u.referrer_id
+        WHERE u.referrer_id != u.user_id
+        UNION ALL
+        SELECT p.descendant_id, p.depth + 1, a.referrer_id, p.visited || a.referrer_id || ','
+        FROM paths p
+        JOIN users a ON a.user_id = p.ancestor_id
+        JOIN users r ON r.user_id = a.referrer_id
+        WHERE p.depth < {REFERRAL_LEVELS} AND p.visited NOT LIKE '%,' || a.referrer_id || ',%'
+    )
+    INSERT INTO referral_paths (descendant_id, depth, ancestor_id)
+    SELECT descendant_id, depth, ancestor_id FROM paths
+    ''',
+    '''
+    INSERT INTO referral_levels (user_id, depth, members, earnings)
+    SELECT p.ancestor_id, p.depth, COUNT(*), COALESCE(SUM(s.total_earned), 0)
+    FROM referral_paths p
+    LEFT JOIN user_stats s ON s.user_id = p.descendant_id
+    GROUP BY p.ancestor_id, p.depth
+    ''',
+    '''
+    INSERT INTO user_stats (user_id, downline_size)
+    SELECT user_id, SUM(members) FROM referral_levels WHERE members > 0 GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET downline_size = excluded.downline_size
+    ''',
+]
+
+# Referral rings the backfill stopped at: users who are their own ancestor, with the
+# ring's length. Only legacy rows can form one (a referrer must exist before the user
+# does), and rings longer than REFERRAL_LEVELS + 1 aren't found.
+REFERRAL_RING_SCAN = '''
+    INSERT INTO referral_rings (user_id, length)
+    SELECT user_id, 1 FROM users WHERE referrer_id = user_id
+    UNION ALL
+    SELECT p.descendant_id, MIN(p.depth) + 1
+    FROM referral_paths p
+    JOIN users a ON a.user_id = p.ancestor_id
+    WHERE a.referrer_id = p.descendant_id
+    GROUP BY p.descendant_id
+'''
+
+# Migration 13: referral index, every user's ancestors and per-level downline totals
+def _migration_referral_index(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referral_paths (
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            ancestor_id INTEGER NOT NULL,
+            PRIMARY KEY (descendant_id, depth)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referral_levels (
+            user_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            members INTEGER NOT NULL DEFAULT 0,
+            earnings INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, depth)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('ALTER TABLE user_stats ADD COLUMN downline_size INTEGER NOT NULL DEFAULT 0')
+    for statement in REFERRAL_BACKFILL:
+        conn.execute(statement)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_downline ON user_stats (downline_size DESC, user_id)')
+
+# Rebuild the referral index, whose first backfill walked around rings
+REFERRAL_REBUILD = [
+    'DELETE FROM referral_paths',
+    'DELETE FROM referral_levels',
+    'UPDATE user_stats SET downline_size = 0 WHERE downline_size != 0',
+    *REFERRAL_BACKFILL,
+]
+
+# Migration 14: referral rings, found while rebuilding the referral index
+def _migration_referral_rings(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referral_rings (
+            user_id INTEGER PRIMARY KEY,
+            length INTEGER NOT NULL
+        )
+    ''')
+    for statement in REFERRAL_REBUILD:
+        conn.execute(statement)
+    conn.execute(REFERRAL_RING_SCAN)
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_hot_path_indexes,
+    _migration_user_directory,
+    _migration_user_stats,
+    _migration_review_queue,
+    _migration_ledger,
+    _migration_payout_batches,
+    _migration_conversation_state,
+    _migration_pending_memberships,
+    _migration_leaderboard,
+    _migration_meta,
+    _migration_idempotency_keys,
+    _migration_referral_index,
+    _migration_referral_rings,
+]
+
+# Apply pending migrations, returns the resulting schema version
+def migrate(conn, target: int = None):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    target = len(MIGRATIONS) if target is None else target
+    for number in range(version + 1, target + 1):
+        migration = MIGRATIONS[number - 1]
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        logger.info(f"Applied database migration {number}: {migration.__name__}")
+    return max(version, target)
+
+# PostgreSQL schema, tracked in the schema_version table. The first entry creates the
+# schema as of SQLite migration 11 in one go; every later SQLite migration needs a
+# matching (version, statements) entry here. Timestamps stay text in SQLite's format
+# and Telegram IDs are BIGINT.
+POSTGRES_SCHEMA = [
+    '''
+    CREATE TABLE users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT COLLATE "C",
+        joined_channel INTEGER DEFAULT 0,
+        balance INTEGER DEFAULT 0,
+        referrer_id BIGINT,
+        upi_id TEXT,
+        joined_at TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE tasks (
+        task_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        title TEXT NOT NULL,
+        description TEXT NOT NULL,
+        payment_price INTEGER NOT NULL,
+        question TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE user_tasks (
+        user_id BIGINT,
+        task_id INTEGER,
+        completed INTEGER DEFAULT 0,
+        pending INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, task_id)
+    )
+    ''',
+    '''
+    CREATE TABLE task_responses (
+        user_id BIGINT,
+        task_id INTEGER,
+        response TEXT,
+        PRIMARY KEY (user_id, task_id)
+    )
+    ''',
+    f'''
+    CREATE TABLE announcements (
+        announcement_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        message TEXT NOT NULL,
+        timestamp TEXT DEFAULT {POSTGRES_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE withdrawals (
+        withdrawal_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        amount INTEGER NOT NULL,
+        upi_id TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        timestamp TEXT DEFAULT {POSTGRES_NOW},
+        batch_id INTEGER
+    )
+    ''',
+    f'''
+    CREATE TABLE broadcasts (
+        broadcast_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        announcement_id INTEGER,
+        admin_id BIGINT NOT NULL,
+        message TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT DEFAULT {POSTGRES_NOW},
+        finished_at TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE user_stats (
+        user_id BIGINT PRIMARY KEY,
+        completed_tasks INTEGER NOT NULL DEFAULT 0,
+        referral_count INTEGER NOT NULL DEFAULT 0,
+        referral_earnings INTEGER NOT NULL DEFAULT 0,
+        total_earned INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    f'''
+    CREATE TABLE ledger_entries (
+        entry_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        amount INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        reference TEXT,
+        created_at TEXT DEFAULT {POSTGRES_NOW}
+    )
+    ''',
+    '''
+    CREATE FUNCTION ledger_entries_append_only() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN RAISE EXCEPTION 'ledger_entries is append-only'; END
+    $$
+    ''',
+    '''
+    CREATE TRIGGER ledger_entries_no_change BEFORE UPDATE OR DELETE ON ledger_entries
+    FOR EACH ROW EXECUTE FUNCTION ledger_entries_append_only()
+    ''',
+    f'''
+    CREATE TABLE payout_batches (
+        batch_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        admin_id BIGINT NOT NULL,
+        withdrawals INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT DEFAULT {POSTGRES_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE conversation_state (
+        kind TEXT NOT NULL,
+        key BIGINT NOT NULL,
+        data TEXT NOT NULL,
+        updated_at TEXT DEFAULT {POSTGRES_NOW},
+        PRIMARY KEY (kind, key)
+    )
+    ''',
+    '''
+    CREATE TABLE pending_memberships (
+        user_id BIGINT PRIMARY KEY,
+        due_at DOUBLE PRECISION NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''',
+    "INSERT INTO meta (key, value) VALUES ('catalog_version', 0)",
+    'CREATE INDEX idx_users_referrer ON users (referrer_id, user_id, username)',
+    'CREATE INDEX idx_users_balance ON users (balance, user_id)',
+    'CREATE INDEX idx_users_joined ON users (joined_at, user_id)',
+    'CREATE INDEX idx_users_username ON users (lower(username))',
+    'CREATE INDEX idx_user_tasks_user ON user_tasks (user_id, completed, pending, task_id)',
+    'CREATE INDEX idx_user_tasks_pending ON user_tasks (task_id, user_id) WHERE pending = 1',
+    'CREATE INDEX idx_withdrawals_user_time ON withdrawals (user_id, timestamp, amount, upi_id, status)',
+    'CREATE INDEX idx_withdrawals_status_time ON withdrawals (status, timestamp, user_id, amount, upi_id)',
+    'CREATE INDEX idx_withdrawals_batch ON withdrawals (batch_id, withdrawal_id) WHERE batch_id IS NOT NULL',
+    'CREATE INDEX idx_ledger_user ON ledger_entries (user_id, amount)',
+    'CREATE INDEX idx_pending_memberships_due ON pending_memberships (due_at, user_id, attempts)',
+    'CREATE INDEX idx_user_stats_earned ON user_stats (total_earned DESC, user_id)',
+    'CREATE INDEX idx_user_stats_referrals ON user_stats (referral_count DESC, user_id)',
+]
+
+POSTGRES_MIGRATIONS = [
+    (11, POSTGRES_SCHEMA),
+    (12, [
+        '''
+        CREATE TABLE idempotency_keys (
+            action TEXT NOT NULL,
+            key TEXT NOT NULL,
+            created_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (action, key)
+        )
+        ''',
+        'CREATE INDEX idx_idempotency_keys_created ON idempotency_keys (created_at)',
+    ]),
+    (13, [
+        '''
+        CREATE TABLE referral_paths (
+            descendant_id BIGINT NOT NULL,
+            depth INTEGER NOT NULL,
+            ancestor_id BIGINT NOT NULL,
+            PRIMARY KEY (descendant_id, depth)
+        )
+        ''',
+        '''
+        CREATE TABLE referral_levels (
+            user_id BIGINT NOT NULL,
+            depth INTEGER NOT NULL,
+            members INTEGER NOT NULL DEFAULT 0,
+            earnings INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, depth)
+        )
+        ''',
+        'ALTER TABLE user_stats ADD COLUMN downline_size INTEGER NOT NULL DEFAULT 0',
+        *REFERRAL_BACKFILL,
+        'CREATE INDEX idx_user_stats_downline ON user_stats (downline_size DESC, user_id)',
+    ]),
+    (14, [
+        '''
+        CREATE TABLE referral_rings (
+            user_id BIGINT PRIMARY KEY,
+            length INTEGER NOT NULL
+        )
+        ''',
+        *REFERRAL_REBUILD,
+        REFERRAL_RING_SCAN,
+    ]),
+]
+
+async def init_db():
+    version = await db.migrate()
+    logger.info(f"Database schema at version {version}")
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# Channel membership lookups: a TTL/LRU cache in front of get_chat_member,
+# written through to users.joined_channel, which is the fallback when the API fails
+class MembershipService:
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.cache = OrderedDict()  # user_id -> (is_member, expires_at)
+
+    def cached(self, user_id: int):
+        entry = self.cache.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        self.cache.move_to_end(user_id)
+        return entry[0]
+
+    def remember(self, user_id: int, is_member: bool):
+        self.cache[user_id] = (is_member, time.monotonic() + self.ttl)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def lookup(self, bot, user_id: int, fresh: bool = False) -> bool:
+        if not fresh:
+            is_member = self.cached(user_id)
+            if is_member is not None:
+                return is_member
+        try:
+            chat_member = await bot.get_chat_member(CHANNEL_ID, user_id)
+        except TelegramError as e:
+            logger.warning(f"Membership lookup for user {user_id} failed: {e}")
+            user = await get_user(user_id)
+            return bool(user and user[2])
+        is_member = chat_member.status in MEMBER_STATUSES
+        self.remember(user_id, is_member)
+        return is_member
+
+    # Store a known membership state, returns True if the user was waiting to join
+    async def record(self, user_id: int, is_member: bool) -> bool:
+        self.remember(user_id, is_member)
+        return await record_membership(user_id, is_member)
+
+membership = MembershipService(MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_SIZE)
 
 # Check if user is subscribed to the channel
 async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    try:
-        chat_member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
-    except TelegramError:
-        return False
+    return await membership.lookup(context.bot, user_id)
 
-# Save user to database
-def save_user(user_id: int, username: str, referrer_id: int = None):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-    existing_user = c.fetchone()
-    if existing_user:
-        c.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
-    else:
-        c.execute('''
-            INSERT INTO users (user_id, username, referrer_id)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, referrer_id))
-    conn.commit()
-    conn.close()
+# Adjust a user's counters in user_stats, moving them on the leaderboards once committed
+def _bump_stats(conn, user_id: int, completed_tasks: int = 0, referral_count: int = 0, referral_earnings: int = 0,
+                total_earned: int = 0):
+    referrals, earned = conn.execute('''
+        INSERT INTO user_stats (user_id, completed_tasks, referral_count, referral_earnings, total_earned)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            completed_tasks = user_stats.completed_tasks + excluded.completed_tasks,
+            referral_count = user_stats.referral_count + excluded.referral_count,
+            referral_earnings = user_stats.referral_earnings + excluded.referral_earnings,
+            total_earned = user_stats.total_earned + excluded.total_earned
+        RETURNING referral_count, total_earned
+    ''', (user_id, completed_tasks, referral_count, referral_earnings, total_earned)).fetchall()[0]
+    if referral_count or total_earned:
+        db.after_commit(leaderboard.moved, earned - total_earned, earned, referrals - referral_count, referrals)
+
+# Save user to database. A referrer is only set on a user's first save and must already
+# exist, so nobody can end up in their own upline: self-referrals and unknown referrers
+# (which could later close a ring) are dropped.
+def _save_user(conn, user_id: int, username: str, referrer_id: int = None):
+    inserted = conn.execute('''
+        INSERT INTO users (user_id, username, referrer_id, joined_at)
+        VALUES (?, ?, (SELECT user_id FROM users WHERE user_id = ? AND user_id != ?), CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING referrer_id
+    ''', (user_id, username, referrer_id, user_id)).fetchall()
+    if not inserted:
+        conn.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
+    elif inserted[0][0]:
+        _bump_stats(conn, referrer_id, referral_count=1)
+        _index_referral(conn, user_id, referrer_id)
+    elif referrer_id:
+        logger.info(f"Ignoring referrer {referrer_id} of user {user_id}")
+
+async def save_user(user_id: int, username: str, referrer_id: int = None):
+    await db.write(_save_user, user_id, username, referrer_id)
+
+# Add a new user to the referral index: their referrer's ancestors (up to REFERRAL_LEVELS)
+# shifted down a level, and one more member on each of those ancestors' levels
+def _index_referral(conn, user_id: int, referrer_id: int):
+    conn.execute('INSERT INTO referral_paths (descendant_id, depth, ancestor_id) VALUES (?, 1, ?)', (user_id, referrer_id))
+    conn.execute('''
+        INSERT INTO referral_paths (descendant_id, depth, ancestor_id)
+        SELECT CAST(? AS BIGINT), depth + 1, ancestor_id FROM referral_paths
+        WHERE descendant_id = ? AND depth < ?
+    ''', (user_id, referrer_id, REFERRAL_LEVELS))
+    conn.execute('''
+        INSERT INTO referral_levels (user_id, depth, members)
+        SELECT ancestor_id, depth, 1 FROM referral_paths WHERE descendant_id = ?
+        ON CONFLICT (user_id, depth) DO UPDATE SET members = referral_levels.members + 1
+    ''', (user_id,))
+    conn.execute('''
+        INSERT INTO user_stats (user_id, downline_size)
+        SELECT ancestor_id, 1 FROM referral_paths WHERE descendant_id = ?
+        ON CONFLICT (user_id) DO UPDATE SET downline_size = user_stats.downline_size + 1
+    ''', (user_id,))
 
 # Get user data
-def get_user(user_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id, username, joined_channel, balance, referrer_id, upi_id FROM users WHERE user_id = ?', (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return user
-
-# Update user channel join status
-def update_channel_status(user_id: int, joined: bool):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE users SET joined_channel = ? WHERE user_id = ?
-    ''', (1 if joined else 0, user_id))
-    conn.commit()
-    conn.close()
+async def get_user(user_id: int):
+    return await db.fetchone(
+        'SELECT user_id, username, joined_channel, balance, referrer_id, upi_id FROM users WHERE user_id = ?', (user_id,)
+    )
+
+# Store a user's channel membership, returns True if they were waiting to join
+def _record_membership(conn, user_id: int, joined: bool):
+    conn.execute('UPDATE users SET joined_channel = ? WHERE user_id = ?', (1 if joined else 0, user_id))
+    if not joined:
+        return False
+    return conn.execute('DELETE FROM pending_memberships WHERE user_id = ?', (user_id,)).rowcount > 0
+
+async def record_membership(user_id: int, joined: bool):
+    return await db.write(_record_membership, user_id, joined)
+
+# Queue a user for the membership re-check job
+async def add_pending_membership(user_id: int, due_at: float):
+    await db.execute('''
+        INSERT INTO pending_memberships (user_id, due_at) VALUES (?, ?)
+        ON CONFLICT (user_id) DO NOTHING
+    ''', (user_id, due_at))
+
+# Get users whose membership re-check is due, limited to one worker process's share of users
+async def get_due_memberships(now: float, limit: int, workers: int = 1, index: int = 0):
+    return await db.fetchall('''
+        SELECT user_id, attempts FROM pending_memberships
+        WHERE due_at <= ? AND user_id % ? = ?
+        ORDER BY due_at LIMIT ?
+    ''', (now, workers, index, limit))
+
+# Push a user's next membership re-check back
+async def reschedule_pending_membership(user_id: int, due_at: float):
+    await db.execute(
+        'UPDATE pending_memberships SET due_at = ?, attempts = attempts + 1 WHERE user_id = ?', (due_at, user_id)
+    )
+
+# Stop re-checking a user's membership
+async def remove_pending_membership(user_id: int):
+    await db.execute('DELETE FROM pending_memberships WHERE user_id = ?', (user_id,))
 
 # Set or update UPI ID
-def set_upi_id(user_id: int, upi_id: str):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('UPDATE users SET upi_id = ? WHERE user_id = ?', (upi_id, user_id))
-    conn.commit()
-    conn.close()
+async def set_upi_id(user_id: int, upi_id: str):
+    await db.execute('UPDATE users SET upi_id = ? WHERE user_id = ?', (upi_id, user_id))
+
+# Ledger: every balance change is an append-only ledger_entries row plus an update of the
+# cached users.balance, written in the same transaction as the business change behind it.
+
+# Post a ledger entry, returns False if the user doesn't exist or (with require_funds) can't cover it
+def _post_entry(conn, user_id: int, amount: int, kind: str, reference: str = None, require_funds: bool = False):
+    sql = 'UPDATE users SET balance = balance + ? WHERE user_id = ?'
+    params = (amount, user_id)
+    if require_funds:
+        sql += ' AND balance + ? >= 0'
+        params += (amount,)
+    if not conn.execute(sql, params).rowcount:
+        return False
+    conn.execute('''
+        INSERT INTO ledger_entries (user_id, amount, kind, reference)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, amount, kind, reference))
+    if amount > 0 and kind in EARNING_KINDS:
+        _bump_stats(conn, user_id, total_earned=amount)
+        conn.execute('''
+            UPDATE referral_levels SET earnings = earnings + ?
+            WHERE (user_id, depth) IN (SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = ?)
+        ''', (amount, user_id))
+    return True
 
 # Add bonus to user
-def add_bonus(user_id: int, amount: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE users SET balance = balance + ? WHERE user_id = ?
-    ''', (amount, user_id))
-    conn.commit()
-    conn.close()
+async def add_bonus(user_id: int, amount: int, kind: str = 'bonus', reference: str = None):
+    if not amount:
+        return
+    await db.write(_post_entry, user_id, amount, kind, reference)
+
+# Add referral bonus to referrer
+def _add_referral_bonus(conn, referrer_id: int, amount: int, reference: str = None):
+    if _post_entry(conn, referrer_id, amount, 'referral_bonus', reference):
+        _bump_stats(conn, referrer_id, referral_earnings=amount)
 
 # Deduct balance from user
-def deduct_balance(user_id: int, amount: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?
-    ''', (amount, user_id, amount))
-    rows_affected = c.rowcount
-    conn.commit()
-    conn.close()
-    return rows_affected > 0
+async def deduct_balance(user_id: int, amount: int, kind: str = 'admin_adjust', reference: str = None):
+    return await db.write(_post_entry, user_id, -amount, kind, reference, True)
 
 # Remove balance (admin action)
-def remove_balance(user_id: int, amount: int):
-    return deduct_balance(user_id, amount)
+async def remove_balance(user_id: int, amount: int):
+    return await deduct_balance(user_id, amount)
+
+# Set balance (admin action)
+def _set_balance_amount(conn, user_id: int, amount: int):
+    row = conn.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    if not row:
+        return False
+    if amount != row[0]:
+        _post_entry(conn, user_id, amount - row[0], 'admin_adjust', 'setbalance')
+    return True
+
+async def set_balance_amount(user_id: int, amount: int):
+    return await db.write(_set_balance_amount, user_id, amount)
+
+# Approve a pending task submission: complete it, pay the user and the referrer in one transaction.
+# Returns (referrer_id, referrer_bonus), or None if the submission isn't pending anymore.
+def _approve_task_submission(conn, user_id: int, task_id: int, price: int):
+    if not _mark_task_completed(conn, user_id, task_id):
+        return None
+    _post_entry(conn, user_id, price, 'task_reward', f'task:{task_id}')
+    referrer_id = conn.execute('SELECT referrer_id FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+    referrer_bonus = 0
+    if referrer_id:
+        referrer_bonus = int(price * REFERRER_SHARE)
+        if referrer_bonus:
+            _add_referral_bonus(conn, referrer_id, referrer_bonus, f'task:{task_id}:user:{user_id}')
+    return referrer_id, referrer_bonus
+
+# Approvals are keyed on the submission; submitting the task again forgets the key
+async def approve_task_submission(user_id: int, task_id: int, price: int):
+    return await idempotency.run('approve_task', f'{user_id}:{task_id}', _approve_task_submission, user_id, task_id, price)
+
+# Withdraw: debit the balance and create the pending withdrawal, returns its ID or None if funds are short
+def _create_withdrawal(conn, user_id: int, amount: int, upi_id: str):
+    row = conn.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    if not row or row[0] < amount:
+        return None
+    withdrawal_id = conn.execute('''
+        INSERT INTO withdrawals (user_id, amount, upi_id, status)
+        VALUES (?, ?, ?, 'pending')
+        RETURNING withdrawal_id
+    ''', (user_id, amount, upi_id)).fetchall()[0][0]
+    _post_entry(conn, user_id, -amount, 'withdrawal', f'withdrawal:{withdrawal_id}')
+    return withdrawal_id
+
+# A request is keyed on the user's latest withdrawal when the button was rendered,
+# so a repeated tap on the same button is a duplicate and a fresh menu isn't
+async def create_withdrawal(user_id: int, amount: int, upi_id: str, after_withdrawal_id: int = None):
+    key = None if after_withdrawal_id is None else f'{user_id}:{after_withdrawal_id}'
+    return await idempotency.run('request_withdrawal', key, _create_withdrawal, user_id, amount, upi_id)
+
+# Move a pending withdrawal to a final status, refunding it unless approved.
+# Returns (user_id, amount, upi_id, username), or None if it wasn't pending.
+def _close_withdrawal(conn, withdrawal_id: int, status: str, owner_id: int = None):
+    withdrawal = conn.execute('''
+        SELECT w.user_id, w.amount, w.upi_id, u.username
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.user_id
+        WHERE w.withdrawal_id = ? AND w.status = 'pending'
+    ''', (withdrawal_id,)).fetchone()
+    if not withdrawal or (owner_id is not None and withdrawal[0] != owner_id):
+        return None
+    conn.execute('UPDATE withdrawals SET status = ? WHERE withdrawal_id = ?', (status, withdrawal_id))
+    if status != 'approved':
+        _post_entry(conn, withdrawal[0], withdrawal[1], 'refund', f'withdrawal:{withdrawal_id}')
+    return withdrawal
+
+# Approve withdrawal
+async def approve_withdrawal(withdrawal_id: int):
+    return await db.write(_close_withdrawal, withdrawal_id, 'approved')
+
+# Decline withdrawal and refund it
+async def decline_withdrawal(withdrawal_id: int):
+    return await db.write(_close_withdrawal, withdrawal_id, 'declined')
+
+# Cancel a user's own pending withdrawal and refund it
+async def cancel_withdrawal(withdrawal_id: int, user_id: int):
+    return await db.write(_close_withdrawal, withdrawal_id, 'cancelled', user_id)
+
+# Get the ID of a user's latest withdrawal of any status, 0 if they have none
+async def get_latest_withdrawal_id(user_id: int):
+    row = await db.fetchone('SELECT MAX(withdrawal_id) FROM withdrawals WHERE user_id = ?', (user_id,))
+    return row[0] or 0
+
+# Get the ID of a user's latest pending withdrawal
+async def get_latest_pending_withdrawal_id(user_id: int):
+    row = await db.fetchone('''
+        SELECT withdrawal_id FROM withdrawals
+        WHERE user_id = ? AND status = 'pending'
+        ORDER BY withdrawal_id DESC LIMIT 1
+    ''', (user_id,))
+    return row[0] if row else None
+
+# Idempotency: a money-moving action runs at most once per (action, key), where the key
+# names the entity acted on. A duplicate arriving while the first is still running waits
+# for it (single flight); then, like one arriving later, it finds the key the first one's
+# transaction recorded, or runs itself if that transaction failed.
+DUPLICATE = object()  # Returned instead of a result for a duplicate action
+
+# Run fn(conn, *args) (if given) unless (action, key) is already recorded.
+# The key is written in the same transaction, so it only sticks if the action commits
+# and returned a result; inserting it first makes concurrent transactions wait on it.
+def _run_once(conn, action: str, key: str, fn, args: tuple):
+    if not conn.execute('''
+        INSERT INTO idempotency_keys (action, key, created_at) VALUES (?, ?, ?)
+        ON CONFLICT (action, key) DO NOTHING
+    ''', (action, key, time.time())).rowcount:
+        return DUPLICATE
+    result = fn(conn, *args) if fn else None
+    # An action that did nothing (e.g. not enough balance left) may be tried again
+    if fn and result is None:
+        _forget_key(conn, action, key)
+    return result
+
+# Forget a key, so the entity it names can be acted on again (e.g. a resubmitted task)
+def _forget_key(conn, action: str, key: str):
+    conn.execute('DELETE FROM idempotency_keys WHERE action = ? AND key = ?', (action, key))
+
+class Idempotency:
+    def __init__(self):
+        self.in_flight = {}  # (action, key) -> future resolved once its run has finished
+
+    # Run fn(conn, *args) in a write transaction as (action, key), returns its result or
+    # DUPLICATE. Without a key it's a plain write.
+    async def run(self, action: str, key: str, fn=None, *args):
+        if key is None:
+            return await db.write(fn, *args)
+        while (action, key) in self.in_flight:
+            await asyncio.shield(self.in_flight[(action, key)])
+        done = self.in_flight[(action, key)] = asyncio.get_running_loop().create_future()
+        try:
+            result = await db.write(_run_once, action, key, fn, args, name=action)
+        finally:
+            del self.in_flight[(action, key)]
+            done.set_result(None)
+        if result is DUPLICATE:
+            IDEMPOTENT_DUPLICATES.inc(action)
+        return result
+
+idempotency = Idempotency()
+
+# Forget keys recorded before the given time, returns how many were removed
+async def prune_idempotency_keys(before: float):
+    return await db.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (before,))
+
+# Rebuild cached balances from the ledger: merge users and per-user ledger sums,
+# both streamed in user_id order, and fix any balance that drifted.
+def _reconcile_balances(conn):
+    users = conn.execute('SELECT user_id, balance FROM users ORDER BY user_id')
+    totals = conn.execute('''
+        SELECT user_id, SUM(amount) FROM ledger_entries GROUP BY user_id ORDER BY user_id
+    ''')
+    total = next(totals, None)
+    checked, fixes = 0, []
+    for user_id, balance in users:
+        checked += 1
+        while total and total[0] < user_id:
+            total = next(totals, None)
+        expected = total[1] if total and total[0] == user_id else 0
+        if balance != expected:
+            fixes.append((expected, user_id, balance))
+    conn.executemany('UPDATE users SET balance = ? WHERE user_id = ?', [(expected, user_id) for expected, user_id, _ in fixes])
+    return checked, fixes
+
+async def reconcile_balances():
+    return await db.write(_reconcile_balances)
+
+# Get user counters (completed_tasks, referral_count, referral_earnings)
+async def get_user_stats(user_id: int):
+    stats = await db.fetchone(
+        'SELECT completed_tasks, referral_count, referral_earnings FROM user_stats WHERE user_id = ?', (user_id,)
+    )
+    return stats or (0, 0, 0)
+
+# Get referrals with their completed task counts, most active first
+async def get_referral_progress(user_id: int, limit: int = REFERRAL_LIST_LIMIT):
+    return await db.fetchall('''
+        SELECT u.username, COALESCE(s.completed_tasks, 0) AS completed
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.user_id
+        WHERE u.referrer_id = ?
+        ORDER BY completed DESC LIMIT ?
+    ''', (user_id, limit))
+
+# Get a user's downline per level as (depth, members, earnings)
+async def get_referral_levels(user_id: int):
+    return await db.fetchall(
+        'SELECT depth, members, earnings FROM referral_levels WHERE user_id = ? AND members > 0 ORDER BY depth', (user_id,)
+    )
+
+# Get users in referral rings as (user_id, username, length), shortest rings first
+async def get_referral_rings(limit: int):
+    return await db.fetchall('''
+        SELECT r.user_id, u.username, r.length
+        FROM referral_rings r
+        LEFT JOIN users u ON u.user_id = r.user_id
+        ORDER BY r.length, r.user_id LIMIT ?
+    ''', (limit,))
+
+async def get_referral_ring_count():
+    return (await db.fetchone('SELECT COUNT(*) FROM referral_rings'))[0]
+
+# Get the users with the largest downlines as (user_id, username, downline_size)
+async def get_top_downlines(limit: int):
+    return await db.fetchall('''
+        SELECT s.user_id, u.username, s.downline_size
+        FROM user_stats s
+        LEFT JOIN users u ON u.user_id = s.user_id
+        WHERE s.downline_size > 0
+        ORDER BY s.downline_size DESC, s.user_id LIMIT ?
+    ''', (limit,))
 
 # Get referrals
-def get_referrals(user_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id, username FROM users WHERE referrer_id = ?', (user_id,))
-    referrals = c.fetchall()
-    conn.close()
-    return referrals
+async def get_referrals(user_id: int):
+    return await db.fetchall('SELECT user_id, username FROM users WHERE referrer_id = ?', (user_id,))
+
+# Bump a counter in the meta table
+def _bump_meta(conn, key: str):
+    conn.execute('''
+        INSERT INTO meta (key, value) VALUES (?, 1)
+        ON CONFLICT (key) DO UPDATE SET value = meta.value + 1
+    ''', (key,))
+
+async def get_meta(key: str):
+    row = await db.fetchone('SELECT value FROM meta WHERE key = ?', (key,))
+    return row[0] if row else 0
 
 # Add task
-def add_task(title: str, description: str, payment_price: int, question: str):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO tasks (title, description, payment_price, question) VALUES (?, ?, ?, ?)', 
-              (title, description, payment_price, question))
-    conn.commit()
-    conn.close()
+def _add_task(conn, title: str, description: str, payment_price: int, question: str):
+    conn.execute('INSERT INTO tasks (title, description, payment_price, question) VALUES (?, ?, ?, ?)',
+                 (title, description, payment_price, question))
+    _bump_meta(conn, 'catalog_version')
+
+async def add_task(title: str, description: str, payment_price: int, question: str):
+    await db.write(_add_task, title, description, payment_price, question)
+    task_catalog.invalidate()
 
 # Remove task
-def remove_task(task_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
-    c.execute('DELETE FROM user_tasks WHERE task_id = ?', (task_id,))
-    c.execute('DELETE FROM task_responses WHERE task_id = ?', (task_id,))
-    conn.commit()
-    conn.close()
+def _remove_task(conn, task_id: int):
+    conn.execute('''
+        UPDATE user_stats SET completed_tasks = completed_tasks - 1
+        WHERE user_id IN (SELECT user_id FROM user_tasks WHERE task_id = ? AND completed = 1)
+    ''', (task_id,))
+    conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+    conn.execute('DELETE FROM user_tasks WHERE task_id = ?', (task_id,))
+    conn.execute('DELETE FROM task_responses WHERE task_id = ?', (task_id,))
+    _bump_meta(conn, 'catalog_version')
+
+async def remove_task(task_id: int):
+    await db.write(_remove_task, task_id)
+    task_catalog.invalidate()
 
 # Get tasks
-def get_tasks():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT task_id, title, description, payment_price, question FROM tasks')
-    tasks = c.fetchall()
-    conn.close()
-    return tasks
+async def get_tasks():
+    return await db.fetchall('SELECT task_id, title, description, payment_price, question FROM tasks')
+
+# In-memory copy of the tasks table and the task selection keyboard.
+# Tasks only change through add_task/remove_task, which invalidate it here and
+# bump meta.catalog_version so other worker processes notice within CATALOG_CHECK_INTERVAL.
+class TaskCatalog:
+    def __init__(self):
+        self.tasks = None
+        self.keyboard = None
+        self.catalog_version = None
+        self.checked_at = 0.0
+        self._version = 0
+
+    def invalidate(self):
+        self._version += 1
+        self.tasks = None
+        self.keyboard = None
+
+    async def _ensure_loaded(self):
+        if self.tasks is not None and time.monotonic() >= self.checked_at + CATALOG_CHECK_INTERVAL:
+            self.checked_at = time.monotonic()
+            if await get_meta('catalog_version') != self.catalog_version:
+                self.invalidate()
+        while self.tasks is None:
+            version = self._version
+            catalog_version = await get_meta('catalog_version')
+            rows = await get_tasks()
+            # Drop the result if a task was added or removed while loading
+            if version == self._version:
+                self.tasks = {row[0]: row for row in rows}
+                self.keyboard = build_task_selection_keyboard(rows)
+                self.catalog_version = catalog_version
+                self.checked_at = time.monotonic()
+
+    async def all(self):
+        await self._ensure_loaded()
+        return list(self.tasks.values())
+
+    async def get(self, task_id: int):
+        await self._ensure_loaded()
+        return self.tasks.get(task_id)
+
+    async def selection_keyboard(self):
+        await self._ensure_loaded()
+        return self.keyboard
+
+task_catalog = TaskCatalog()
+
+# Get a user's leaderboard scores (total_earned, referral_count)
+async def get_leaderboard_scores(user_id: int):
+    scores = await db.fetchone('SELECT total_earned, referral_count FROM user_stats WHERE user_id = ?', (user_id,))
+    return scores or (0, 0)
+
+# Count users per non-zero score of a leaderboard column, to build its rank index
+async def get_score_counts(column: str):
+    return await db.fetchall(f'SELECT {column}, COUNT(*) FROM user_stats WHERE {column} > 0 GROUP BY {column}')
+
+# Get the top users of a leaderboard column as (username, score)
+async def get_top_scores(column: str, limit: int):
+    return await db.fetchall(f'''
+        SELECT u.username, s.{column}
+        FROM user_stats s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.{column} > 0
+        ORDER BY s.{column} DESC, s.user_id LIMIT ?
+    ''', (limit,))
+
+# Multiset of scores that counts how many are higher than a given one in O(log M):
+# a Fenwick tree over score values, kept in a dict since few values ever occur.
+# Zero scores aren't stored, everyone with nothing yet shares the last rank.
+class RankIndex:
+    def __init__(self, bits: int = 32):
+        self.size = 1 << bits
+        self.tree = {}
+        self.total = 0
+
+    def add(self, score: int, count: int = 1):
+        self.total += count
+        i = score
+        while i <= self.size:
+            value = self.tree.get(i, 0) + count
+            if value:
+                self.tree[i] = value
+            else:
+                del self.tree[i]
+            i += i & -i
+
+    def move(self, old: int, new: int):
+        if old > 0:
+            self.add(old, -1)
+        if new > 0:
+            self.add(new)
+
+    def rank(self, score: int) -> int:
+        at_most = 0
+        i = min(max(score, 0), self.size)
+        while i > 0:
+            at_most += self.tree.get(i, 0)
+            i -= i & -i
+        return self.total - at_most + 1
+
+# Top earners and referrers. Ranks come from in-memory indexes moved by every
+# committed score change; the top lists are a snapshot re-read every refresh seconds.
+# With shared=True other processes change scores too, so the indexes are rebuilt
+# along with each snapshot.
+class Leaderboard:
+    def __init__(self, size: int, refresh: float, shared: bool = False):
+        self.size = size
+        self.refresh = refresh
+        self.shared = shared
+        self.earners = RankIndex()
+        self.referrers = RankIndex()
+        self.snapshot = None
+        self.expires_at = 0.0
+        self._loading = None
+
+    async def load(self):
+        earners, referrers = RankIndex(), RankIndex()
+        for score, count in await get_score_counts('total_earned'):
+            earners.add(score, count)
+        for score, count in await get_score_counts('referral_count'):
+            referrers.add(score, count)
+        self.earners, self.referrers = earners, referrers
+
+    def moved(self, earned_before: int, earned: int, referrals_before: int, referrals: int):
+        if earned != earned_before:
+            self.earners.move(earned_before, earned)
+        if referrals != referrals_before:
+            self.referrers.move(referrals_before, referrals)
+
+    # (earnings rank, referrals rank) for the given scores
+    def ranks(self, total_earned: int, referral_count: int):
+        return self.earners.rank(total_earned), self.referrers.rank(referral_count)
+
+    # Rendered top lists, shared by every view until the snapshot expires
+    async def top(self) -> str:
+        if self.snapshot is None or time.monotonic() >= self.expires_at:
+            if self._loading is None or self._loading.done():
+                self._loading = asyncio.create_task(self._load_top())
+            await asyncio.shield(self._loading)
+        return self.snapshot
+
+    async def _load_top(self):
+        if self.shared:
+            await self.load()
+        earners = await get_top_scores('total_earned', self.size)
+        referrers = await get_top_scores('referral_count', self.size)
+        message = "🏆 Leaderboard\n\n💰 Top Earners:\n"
+        message += "".join(f"{i}. @{username}: {score} points\n" for i, (username, score) in enumerate(earners, 1)) or "No earnings yet!\n"
+        message += "\n👥 Top Referrers:\n"
+        message += "".join(f"{i}. @{username}: {score} referrals\n" for i, (username, score) in enumerate(referrers, 1)) or "No referrals yet!\n"
+        self.snapshot = message
+        self.expires_at = time.monotonic() + self.refresh
+
+leaderboard = Leaderboard(LEADERBOARD_SIZE, LEADERBOARD_REFRESH, shared=WEBHOOK_WORKERS > 1)
+
+# Keep completed_tasks in step when a completed user_tasks row is replaced or deleted
+def _uncount_completed(conn, user_id: int, task_id: int):
+    row = conn.execute('SELECT completed FROM user_tasks WHERE user_id = ? AND task_id = ?', (user_id, task_id)).fetchone()
+    if row and row[0]:
+        _bump_stats(conn, user_id, completed_tasks=-1)
 
 # Mark task as pending
-def mark_task_pending(user_id: int, task_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO user_tasks (user_id, task_id, pending)
+def _mark_task_pending(conn, user_id: int, task_id: int):
+    _uncount_completed(conn, user_id, task_id)
+    _forget_key(conn, 'approve_task', f'{user_id}:{task_id}')
+    conn.execute('''
+        INSERT INTO user_tasks (user_id, task_id, pending)
         VALUES (?, ?, 1)
+        ON CONFLICT (user_id, task_id) DO UPDATE SET completed = 0, pending = 1
     ''', (user_id, task_id))
-    conn.commit()
-    conn.close()
-
-# Mark task as completed
-def mark_task_completed(user_id: int, task_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
+
+async def mark_task_pending(user_id: int, task_id: int):
+    await db.write(_mark_task_pending, user_id, task_id)
+
+# Mark a pending task as completed, returns False if it wasn't pending
+def _mark_task_completed(conn, user_id: int, task_id: int):
+    c = conn.execute('''
         UPDATE user_tasks SET completed = 1, pending = 0
-        WHERE user_id = ? AND task_id = ?
+        WHERE user_id = ? AND task_id = ? AND pending = 1
     ''', (user_id, task_id))
-    conn.commit()
-    conn.close()
+    if c.rowcount:
+        _bump_stats(conn, user_id, completed_tasks=1)
+    return c.rowcount > 0
 
 # Decline task
-def decline_task(user_id: int, task_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM user_tasks WHERE user_id = ? AND task_id = ?', (user_id, task_id))
-    c.execute('DELETE FROM task_responses WHERE user_id = ? AND task_id = ?', (user_id, task_id))
-    conn.commit()
-    conn.close()
+def _decline_task(conn, user_id: int, task_id: int):
+    _uncount_completed(conn, user_id, task_id)
+    conn.execute('DELETE FROM user_tasks WHERE user_id = ? AND task_id = ?', (user_id, task_id))
+    conn.execute('DELETE FROM task_responses WHERE user_id = ? AND task_id = ?', (user_id, task_id))
+
+async def decline_task(user_id: int, task_id: int):
+    await db.write(_decline_task, user_id, task_id)
 
 # Save task response
-def save_task_response(user_id: int, task_id: int, response: str):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO task_responses (user_id, task_id, response)
+async def save_task_response(user_id: int, task_id: int, response: str):
+    await db.execute('''
+        INSERT INTO task_responses (user_id, task_id, response)
         VALUES (?, ?, ?)
+        ON CONFLICT (user_id, task_id) DO UPDATE SET response = excluded.response
     ''', (user_id, task_id, response))
-    conn.commit()
-    conn.close()
 
 # Get pending tasks for user
-def get_pending_tasks(user_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
+async def get_pending_tasks(user_id: int):
+    return await db.fetchall('''
         SELECT t.task_id, t.title, t.description, t.payment_price
         FROM tasks t
         JOIN user_tasks ut ON t.task_id = ut.task_id
         WHERE ut.user_id = ? AND ut.pending = 1
     ''', (user_id,))
-    tasks = c.fetchall()
-    conn.close()
-    return tasks
 
 # Get completed tasks for user
-def get_completed_tasks(user_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
+async def get_completed_tasks(user_id: int):
+    return await db.fetchall('''
         SELECT t.task_id, t.title, t.description, t.payment_price
         FROM tasks t
         JOIN user_tasks ut ON t.task_id = ut.task_id
         WHERE ut.user_id = ? AND ut.completed = 1
     ''', (user_id,))
-    tasks = c.fetchall()
-    conn.close()
-    return tasks
 
 # Add announcement
-def add_announcement(message: str):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO announcements (message) VALUES (?)', (message,))
-    conn.commit()
-    conn.close()
+def _add_announcement(conn, message: str):
+    return conn.execute(
+        'INSERT INTO announcements (message) VALUES (?) RETURNING announcement_id', (message,)
+    ).fetchall()[0][0]
+
+async def add_announcement(message: str):
+    return await db.write(_add_announcement, message)
 
 # Delete announcement
-def delete_announcement(announcement_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM announcements WHERE announcement_id = ?', (announcement_id,))
-    conn.commit()
-    conn.close()
+async def delete_announcement(announcement_id: int):
+    await db.execute('DELETE FROM announcements WHERE announcement_id = ?', (announcement_id,))
 
 # Get announcements
-def get_announcements():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT announcement_id, message, timestamp FROM announcements ORDER BY TIMESTAMP DESC')
-    announcements = c.fetchall()
-    conn.close()
-    return announcements
+async def get_announcements():
+    return await db.fetchall('SELECT announcement_id, message, timestamp FROM announcements ORDER BY TIMESTAMP DESC')
 
 # Get all user IDs
-def get_all_users():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM users')
-    users = c.fetchall()
-    conn.close()
+async def get_all_users():
+    users = await db.fetchall('SELECT user_id FROM users')
+    return [user[0] for user in users]
+
+# Get a page of user IDs in primary key order, for resumable scans
+async def get_user_ids_after(after_user_id: int, limit: int):
+    users = await db.fetchall('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after_user_id, limit))
     return [user[0] for user in users]
 
 # Get total user count
-def get_user_count():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-# Add withdrawal request
-def add_withdrawal(user_id: int, amount: int, upi_id: str):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO withdrawals (user_id, amount, upi_id, status)
-        VALUES (?, ?, ?, 'pending')
-    ''', (user_id, amount, upi_id))
-    conn.commit()
-    conn.close()
+async def get_user_count():
+    row = await db.fetchone('SELECT COUNT(*) FROM users')
+    return row[0]
 
-# Approve withdrawal
-def approve_withdrawal(withdrawal_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE withdrawals SET status = 'approved'
-        WHERE withdrawal_id = ?
-    ''', (withdrawal_id,))
-    conn.commit()
-    conn.close()
-
-# Decline withdrawal
-def decline_withdrawal(withdrawal_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE withdrawals SET status = 'declined'
-        WHERE withdrawal_id = ?
-    ''', (withdrawal_id,))
-    conn.commit()
-    conn.close()
+# Sort orders of the admin user directory: key -> indexed column, newest/highest first
+USER_PAGE_ORDERS = {
+    'b': 'balance',
+    'j': 'joined_at',
+}
+
+# Get a page of users in directory order, starting after the (sort value, user_id) cursor
+async def get_user_page(order: str, cursor: tuple = None, limit: int = USER_PAGE_SIZE):
+    column = USER_PAGE_ORDERS[order]
+    where, params = '', ()
+    if cursor:
+        where, params = f'WHERE ({column}, user_id) < (?, ?)', tuple(cursor)
+    return await db.fetchall(f'''
+        SELECT user_id, username, balance, {column} FROM users {where}
+        ORDER BY {column} DESC, user_id DESC LIMIT ?
+    ''', params + (limit,))
+
+# Find users whose username starts with prefix (case-insensitive)
+async def search_users(prefix: str, limit: int = USER_PAGE_SIZE):
+    prefix = prefix.lower()
+    return await db.fetchall('''
+        SELECT user_id, username, balance FROM users
+        WHERE lower(username) >= ? AND lower(username) < ?
+        ORDER BY lower(username) LIMIT ?
+    ''', (prefix, prefix + '\U0010ffff', limit))
+
+# Get a user with referral and withdrawal summaries for the admin detail card
+def _get_user_details(conn, user_id: int):
+    user = conn.execute('''
+        SELECT user_id, username, joined_channel, balance, referrer_id, upi_id, joined_at
+        FROM users WHERE user_id = ?
+    ''', (user_id,)).fetchone()
+    if not user:
+        return None
+    referrals = conn.execute('SELECT COUNT(*) FROM users WHERE referrer_id = ?', (user_id,)).fetchone()[0]
+    withdrawals = conn.execute('''
+        SELECT status, COUNT(*), SUM(amount) FROM withdrawals
+        WHERE user_id = ? GROUP BY status
+    ''', (user_id,)).fetchall()
+    return user, referrals, withdrawals
+
+async def get_user_details(user_id: int):
+    return await db.read(_get_user_details, user_id)
+
+# Get a withdrawal with its owner's username
+async def get_withdrawal(withdrawal_id: int, pending_only: bool = False):
+    sql = '''
+        SELECT w.user_id, w.amount, w.upi_id, u.username
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.user_id
+        WHERE w.withdrawal_id = ?
+    '''
+    if pending_only:
+        sql += " AND w.status = 'pending'"
+    return await db.fetchone(sql, (withdrawal_id,))
 
 # Get withdrawal history
-def get_withdrawal_history(user_id: int):
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
+async def get_withdrawal_history(user_id: int):
+    return await db.fetchall('''
         SELECT withdrawal_id, amount, upi_id, status, timestamp
         FROM withdrawals WHERE user_id = ? ORDER BY timestamp DESC
     ''', (user_id,))
-    history = c.fetchall()
-    conn.close()
-    return history
-
-# Get pending withdrawals
-def get_pending_withdrawals():
-    conn = sqlite3.connect('bot.db')
-    c = conn.cursor()
-    c.execute('''
+
+# Get pending withdrawals, oldest first
+async def get_pending_withdrawals(limit: int = None):
+    sql = '''
         SELECT w.withdrawal_id, w.user_id, w.amount, w.upi_id, w.timestamp, u.username
         FROM withdrawals w
         JOIN users u ON w.user_id = u.user_id
-        WHERE w.status = 'pending' ORDER BY w.timestamp DESC
-    ''')
-    withdrawals = c.fetchall()
-    conn.close()
-    return withdrawals
+        WHERE w.status = 'pending' ORDER BY w.timestamp
+    '''
+    params = ()
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params = (limit,)
+    return await db.fetchall(sql, params)
 
-# Main menu keyboard
-def main_menu():
-    keyboard = [
-        [
-            InlineKeyboardButton("📣 Invite Friends", callback_data='refer'),
-            InlineKeyboardButton("📋 Start Tasks", callback_data='tasks'),
-        ],
-        [
-            InlineKeyboardButton("📊 Your Progress", callback_data='insights'),
-            InlineKeyboardButton("👤 My Account", callback_data='account'),
-        ],
-        [
-            InlineKeyboardButton("⏳ Task Status", callback_data='pending_completed'),
-            InlineKeyboardButton("📢 Updates", callback_data='announcements'),
-        ],
-        [
-            InlineKeyboardButton("💸 Cash Out", callback_data='withdraw'),
-            InlineKeyboardButton("ℹ️ About Us", callback_data='about'),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+# Count pending withdrawals and their total amount
+async def get_pending_withdrawal_totals():
+    return await db.fetchone("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'pending'")
 
-# Admin menu keyboard
-def admin_menu():
-    keyboard = [
-        [
-            InlineKeyboardButton("👥 Manage Users", callback_data='admin_users'),
-            InlineKeyboardButton("➕ Create Task", callback_data='admin_add_task'),
-        ],
-        [
-            InlineKeyboardButton("➖ Delete Task", callback_data='admin_remove_task'),
-            InlineKeyboardButton("📢 Post Update", callback_data='admin_announcement'),
-        ],
-        [
-            InlineKeyboardButton("💸 Adjust Balance", callback_data='admin_remove_balance'),
-            InlineKeyboardButton("🗑️ Clear Update", callback_data='admin_delete_announcement'),
-        ],
-        [
-            InlineKeyboardButton("📤 Withdrawal Requests", callback_data='admin_withdraw_requests'),
-            InlineKeyboardButton("📋 Task Approvals", callback_data='admin_task_requests'),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+# Approve up to `limit` of the oldest pending withdrawals as one payout batch.
+# Returns (batch_id, count, total), or None if nothing was pending.
+def _approve_pending_withdrawals(conn, admin_id: int, limit: int):
+    batch_id = conn.execute(
+        'INSERT INTO payout_batches (admin_id) VALUES (?) RETURNING batch_id', (admin_id,)
+    ).fetchall()[0][0]
+    approved = conn.execute('''
+        UPDATE withdrawals SET status = 'approved', batch_id = ?
+        WHERE withdrawal_id IN (
+            SELECT withdrawal_id FROM withdrawals
+            WHERE status = 'pending' ORDER BY timestamp LIMIT ?
+        )
+    ''', (batch_id, limit)).rowcount
+    if not approved:
+        conn.execute('DELETE FROM payout_batches WHERE batch_id = ?', (batch_id,))
+        return None
+    count, total = conn.execute(
+        'SELECT COUNT(*), SUM(amount) FROM withdrawals WHERE batch_id = ?', (batch_id,)
+    ).fetchone()
+    conn.execute('UPDATE payout_batches SET withdrawals = ?, total = ? WHERE batch_id = ?', (count, total, batch_id))
+    return batch_id, count, total
+
+# With a key (the batch the admin was shown), a repeated request returns DUPLICATE
+async def approve_pending_withdrawals(admin_id: int, limit: int = PAYOUT_BATCH_LIMIT, key: str = None):
+    return await idempotency.run('approve_all', key, _approve_pending_withdrawals, admin_id, limit)
+
+# Stream a payout batch into a CSV file, returns the number of rows written
+def _write_payout_csv(conn, batch_id: int, path: str):
+    rows = conn.execute('''
+        SELECT w.withdrawal_id, w.user_id, u.username, w.amount, w.upi_id, w.timestamp
+        FROM withdrawals w
+        LEFT JOIN users u ON u.user_id = w.user_id
+        WHERE w.batch_id = ? ORDER BY w.withdrawal_id
+    ''', (batch_id,))
+    written = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['withdrawal_id', 'user_id', 'username', 'amount', 'upi_id', 'requested_at'])
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    return written
+
+async def write_payout_csv(batch_id: int, path: str):
+    return await db.read(_write_payout_csv, batch_id, path)
+
+# Get a payout batch as (batch_id, withdrawals, total)
+async def get_payout_batch(batch_id: int):
+    return await db.fetchone('SELECT batch_id, withdrawals, total FROM payout_batches WHERE batch_id = ?', (batch_id,))
+
+# Get a page of a payout batch's withdrawals after the given withdrawal_id
+async def get_payout_batch_page(batch_id: int, after_withdrawal_id: int, limit: int):
+    return await db.fetchall('''
+        SELECT withdrawal_id, user_id, amount, upi_id FROM withdrawals
+        WHERE batch_id = ? AND withdrawal_id > ? ORDER BY withdrawal_id LIMIT ?
+    ''', (batch_id, after_withdrawal_id, limit))
+
+# Create broadcast
+def _create_broadcast(conn, admin_id: int, announcement_id: int, message: str):
+    return conn.execute('''
+        INSERT INTO broadcasts (admin_id, announcement_id, message)
+        VALUES (?, ?, ?)
+        RETURNING broadcast_id
+    ''', (admin_id, announcement_id, message)).fetchall()[0][0]
+
+async def create_broadcast(admin_id: int, announcement_id: int, message: str):
+    return await db.write(_create_broadcast, admin_id, announcement_id, message)
+
+# Get broadcast
+async def get_broadcast(broadcast_id: int):
+    return await db.fetchone('''
+        SELECT broadcast_id, admin_id, message, status, last_user_id, delivered, failed, blocked
+        FROM broadcasts WHERE broadcast_id = ?
+    ''', (broadcast_id,))
+
+# Get broadcasts interrupted before they finished
+async def get_running_broadcasts():
+    broadcasts = await db.fetchall("SELECT broadcast_id FROM broadcasts WHERE status = 'running'")
+    return [broadcast[0] for broadcast in broadcasts]
+
+# Record delivery progress for one batch of a broadcast
+async def record_broadcast_progress(broadcast_id: int, last_user_id: int, delivered: int, failed: int, blocked: int):
+    await db.execute('''
+        UPDATE broadcasts
+        SET last_user_id = ?, delivered = delivered + ?, failed = failed + ?, blocked = blocked + ?
+        WHERE broadcast_id = ?
+    ''', (last_user_id, delivered, failed, blocked, broadcast_id))
+
+# Mark broadcast as finished
+async def finish_broadcast(broadcast_id: int):
+    await db.execute('''
+        UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP
+        WHERE broadcast_id = ?
+    ''', (broadcast_id,))
+
+# Load persisted conversation state of one kind as {key: json}
+async def get_conversation_state(kind: str, workers: int = 1, index: int = 0):
+    return dict(await db.fetchall(
+        'SELECT key, data FROM conversation_state WHERE kind = ? AND key % ? = ?', (kind, workers, index)
+    ))
+
+# Write a batch of conversation state changes in one transaction
+def _save_conversation_state(conn, upserts, deletes):
+    conn.executemany('''
+        INSERT INTO conversation_state (kind, key, data) VALUES (?, ?, ?)
+        ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+    ''', upserts)
+    conn.executemany('DELETE FROM conversation_state WHERE kind = ? AND key = ?', deletes)
+
+async def save_conversation_state(upserts, deletes):
+    await db.write(_save_conversation_state, upserts, deletes)
+
+# Get the pending submission after (or before) the (task_id, user_id) cursor in review order
+async def get_review_item(cursor: tuple = (0, 0), backwards: bool = False):
+    op, order = ('<', 'DESC') if backwards else ('>', 'ASC')
+    return await db.fetchone(f'''
+        SELECT ut.task_id, ut.user_id, t.title, t.payment_price, t.question, tr.response, u.username
+        FROM user_tasks ut
+        JOIN tasks t ON t.task_id = ut.task_id
+        JOIN task_responses tr ON tr.user_id = ut.user_id AND tr.task_id = ut.task_id
+        JOIN users u ON u.user_id = ut.user_id
+        WHERE ut.pending = 1 AND (ut.task_id, ut.user_id) {op} (?, ?)
+        ORDER BY ut.task_id {order}, ut.user_id {order} LIMIT 1
+    ''', tuple(cursor))
+
+# Count pending task submissions
+async def count_pending_submissions():
+    row = await db.fetchone('SELECT COUNT(*) FROM user_tasks WHERE pending = 1')
+    return row[0]
+
+# Callback data is "<route>:<arg>:<arg>..." with integer arguments in base 36,
+# which keeps even 64-bit IDs well inside Telegram's 64-byte callback_data limit
+CALLBACK_DATA_LIMIT = 64
+SLOW_CALLBACK_SECONDS = 1.0  # Callbacks slower than this are logged
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def to_base36(n: int) -> str:
+    if n < 0:
+        return '-' + to_base36(-n)
+    digits = ''
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36_DIGITS[r] + digits
+        if not n:
+            return digits
+
+# Typed callback arguments as (encode, decode, decode_legacy) triples; the last
+# parses the argument as pre-codec buttons wrote it ("admin_users_b_-5_12")
+INT_ARG = (to_base36, lambda s: int(s, 36), int)
+TIMESTAMP_ARG = (  # SQLite CURRENT_TIMESTAMP text, sent as base 36 epoch seconds
+    lambda ts: to_base36(int(datetime.strptime(ts, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp())),
+    lambda s: datetime.fromtimestamp(int(s, 36), timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+    lambda s: datetime.strptime(s, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S'),
+)
+
+class CallbackRoute:
+    def __init__(self, name: str, handler, arg_types: tuple, admin: bool, budget: str):
+        self.name = name
+        self.handler = handler
+        self.arg_types = arg_types
+        self.admin = admin
+        self.budget = budget
+
+# Per-user token buckets, checked before a callback or message does any DB or API work.
+# Buckets live in an LRU keyed by (user_id, budget); one untouched for idle seconds
+# would be full again anyway, so it's dropped.
+class UserThrottle:
+    def __init__(self, budgets: dict, size: int, idle: float):
+        self.budgets = budgets
+        self.size = size
+        self.idle = idle
+        self.buckets = OrderedDict()  # (user_id, budget) -> (tokens, updated)
+
+    def allow(self, user_id: int, budget: str) -> bool:
+        rate, burst = self.budgets[budget]
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop((user_id, budget), (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        self.buckets[(user_id, budget)] = (tokens - 1 if allowed else tokens, now)
+        while len(self.buckets) > self.size or next(iter(self.buckets.values()))[1] < now - self.idle:
+            self.buckets.popitem(last=False)
+        return allowed
+
+user_throttle = UserThrottle(USER_THROTTLE_BUDGETS, USER_THROTTLE_TRACKED, USER_THROTTLE_IDLE)
+
+# Callback queries dispatched by route name with a single dict lookup.
+# Admin routes are only served to admins; other routes to channel members,
+# within their per-user budget (expensive=True for routes that move money)
+# and one at a time for the same button.
+# Payloads from before the codec ("approve_task_1_2") are mapped through
+# their old prefix so buttons already sitting in chats keep working.
+class CallbackRouter:
+    def __init__(self):
+        self.routes = {}
+        self.legacy = {}  # old prefix -> route name
+        self.in_flight = set()  # (user_id, callback data) being handled
+
+    def route(self, name: str, *arg_types, admin: bool = False, legacy: str = None, expensive: bool = False):
+        def register(handler):
+            self.routes[name] = CallbackRoute(name, handler, arg_types, admin, 'expensive' if expensive else 'cheap')
+            if legacy:
+                self.legacy[legacy] = name
+            return handler
+        return register
+
+    # Build the callback_data for a route; trailing arguments may be left out
+    def data(self, name: str, *args) -> str:
+        arg_types = self.routes[name].arg_types
+        data = ':'.join([name] + [arg_type[0](arg) for arg_type, arg in zip(arg_types, args)])
+        if len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"callback_data for route {name} is longer than {CALLBACK_DATA_LIMIT} bytes")
+        return data
+
+    # Returns (route, args), or None for unknown or malformed payloads
+    def decode(self, data: str):
+        name, *raw_args = data.split(':')
+        route = self.routes.get(name)
+        if route is None:
+            return self.decode_legacy(data)
+        if len(raw_args) > len(route.arg_types):
+            return None
+        try:
+            return route, tuple(arg_type[1](raw) for arg_type, raw in zip(route.arg_types, raw_args))
+        except ValueError:
+            return None
+
+    # Old payloads are "<prefix>_<arg>_<arg>"; prefixes contain underscores too,
+    # so the longest known one wins and the rest is split into arguments
+    def decode_legacy(self, data: str):
+        parts = data.split('_')
+        for end in range(len(parts), 0, -1):
+            route = self.routes.get(self.legacy.get('_'.join(parts[:end])))
+            if route is not None:
+                break
+        else:
+            return None
+        raw_args = parts[end:]
+        if len(raw_args) > len(route.arg_types):
+            return None
+        try:
+            return route, tuple(arg_type[2](raw) for arg_type, raw in zip(route.arg_types, raw_args))
+        except ValueError:
+            return None
+
+    def record(self, name: str, seconds: float):
+        CALLBACK_ROUTE_SECONDS.observe(seconds, name)
+        if seconds > SLOW_CALLBACK_SECONDS:
+            logger.warning(f"Slow callback route {name}: {seconds:.2f}s")
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        decoded = self.decode(query.data or '')
+        if decoded is None:
+            await query.answer()
+            logger.info(f"Ignoring unknown callback data {query.data!r}")
+            return
+        route, args = decoded
+        # Admins bypass all restrictions but only get admin routes
+        if route.admin != (query.from_user.id in ADMIN_IDS):
+            await query.answer()
+            return
+        if route.admin:
+            await query.answer()
+            await self.run(route, query, context, None, args)
+            return
+        # Repeated taps on a button still being handled are dropped, not queued
+        key = (query.from_user.id, query.data)
+        if key in self.in_flight:
+            USER_THROTTLED.inc('in_flight')
+            await query.answer(THROTTLED_TEXT)
+            return
+        if not user_throttle.allow(query.from_user.id, route.budget):
+            USER_THROTTLED.inc(route.budget)
+            await query.answer(THROTTLED_TEXT)
+            return
+        self.in_flight.add(key)
+        try:
+            await query.answer()
+            # Non-admins require channel join
+            user = await get_user(query.from_user.id)
+            if not user or not user[2]:
+                await query.message.edit_text(
+                    JOIN_CHANNEL_TEXT,
+                    reply_markup=JOIN_CHANNEL
+                )
+                return
+            await self.run(route, query, context, user, args)
+        finally:
+            self.in_flight.discard(key)
+
+    async def run(self, route: CallbackRoute, query, context, user, args: tuple):
+        started = time.perf_counter()
+        try:
+            await route.handler(query, context, user, *args)
+        finally:
+            self.record(route.name, time.perf_counter() - started)
+
+router = CallbackRouter()
+
+# Keyboard whose buttons never change: serialized once at startup instead of
+# on every request that carries it
+class StaticKeyboard(InlineKeyboardMarkup):
+    __slots__ = ('_serialized',)
+
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        self._serialized = super().to_dict()
+
+    def to_dict(self, recursive: bool = True):
+        return self._serialized
+
+MAIN_MENU = StaticKeyboard([
+    [
+        InlineKeyboardButton("📣 Invite Friends", callback_data='refer'),
+        InlineKeyboardButton("📋 Start Tasks", callback_data='tasks'),
+    ],
+    [
+        InlineKeyboardButton("📊 Your Progress", callback_data='insights'),
+        InlineKeyboardButton("👤 My Account", callback_data='account'),
+    ],
+    [
+        InlineKeyboardButton("⏳ Task Status", callback_data='pending_completed'),
+        InlineKeyboardButton("📢 Updates", callback_data='announcements'),
+    ],
+    [
+        InlineKeyboardButton("💸 Cash Out", callback_data='withdraw'),
+        InlineKeyboardButton("ℹ️ About Us", callback_data='about'),
+    ],
+    [InlineKeyboardButton("🏆 Leaderboard", callback_data='leaderboard')],
+])
+
+ADMIN_MENU = StaticKeyboard([
+    [
+        InlineKeyboardButton("👥 Manage Users", callback_data='admin_users'),
+        InlineKeyboardButton("➕ Create Task", callback_data='admin_add_task'),
+    ],
+    [
+        InlineKeyboardButton("➖ Delete Task", callback_data='admin_remove_task'),
+        InlineKeyboardButton("📢 Post Update", callback_data='admin_announcement'),
+    ],
+    [
+        InlineKeyboardButton("💸 Adjust Balance", callback_data='admin_remove_balance'),
+        InlineKeyboardButton("🗑️ Clear Update", callback_data='admin_delete_announcement'),
+    ],
+    [
+        InlineKeyboardButton("📤 Withdrawal Requests", callback_data='admin_withdraw_requests'),
+        InlineKeyboardButton("📋 Task Approvals", callback_data='admin_task_requests'),
+    ],
+])
+
+BACK_TO_ADMIN_BUTTON = InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')
+BACK_TO_ADMIN = StaticKeyboard([[BACK_TO_ADMIN_BUTTON]])
+BACK_TO_MENU = StaticKeyboard([[BACK_TO_MENU_BUTTON]])
+JOIN_CHANNEL = StaticKeyboard([[InlineKeyboardButton("📢 Join Channel Now", url=f"https://t.me/{CHANNEL_ID[1:]}")]])
+JOIN_CHANNEL_TEXT = f"🚀 Join {CHANNEL_ID} to unlock exciting rewards! Click below to join now! 🎉"
+ADMIN_PANEL_TEXT = "⚙️ Admin Panel: Manage users, tasks, and withdrawals with ease! Choose an option: 👇"
+THROTTLED_TEXT = "⏳ Slow down! Give it a moment before tapping again."
+MESSAGE_THROTTLED_TEXT = "⏳ Slow down! You're sending messages too fast, give it a moment and try again."
 
 # Task selection keyboard
-def task_selection_menu():
-    tasks = get_tasks()
-    keyboard = [[InlineKeyboardButton(f"🔹 {title} ({price} points)", callback_data=f'task_{task_id}')] for task_id, title, _, price, _ in tasks]
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')])
-    return InlineKeyboardMarkup(keyboard) if tasks else None
+def build_task_selection_keyboard(tasks):
+    keyboard = [[InlineKeyboardButton(f"🔹 {title} ({price} points)", callback_data=router.data('t', task_id))] for task_id, title, _, price, _ in tasks]
+    keyboard.append([BACK_TO_MENU_BUTTON])
+    return StaticKeyboard(keyboard) if tasks else None
+
+async def task_selection_menu():
+    return await task_catalog.selection_keyboard()
 
 # Task detail keyboard with submit button
 def task_complete_button(task_id: int):
     keyboard = [
-        [InlineKeyboardButton("✅ Start Task", callback_data=f'complete_{task_id}')],
-        [InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]
+        [InlineKeyboardButton("✅ Start Task", callback_data=router.data('c', task_id))],
+        [BACK_TO_MENU_BUTTON]
     ]
     return InlineKeyboardMarkup(keyboard)
 
@@ -450,28 +2352,56 @@ def task_complete_button(task_id: int):
 def task_action_buttons(user_id: int, task_id: int):
     keyboard = [
         [
-            InlineKeyboardButton("✅ Approve", callback_data=f'approve_task_{user_id}_{task_id}'),
-            InlineKeyboardButton("❌ Decline", callback_data=f'decline_task_{user_id}_{task_id}'),
+            InlineKeyboardButton("✅ Approve", callback_data=router.data('at', user_id, task_id)),
+            InlineKeyboardButton("❌ Decline", callback_data=router.data('dt', user_id, task_id)),
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-# Withdraw menu keyboard
-def withdraw_menu(upi_id: str = None):
+# Review queue keyboard: act on the submission or move through the queue
+def review_item_buttons(task_id: int, user_id: int):
     keyboard = [
-        [InlineKeyboardButton("💰 Request Cash Out", callback_data='request_withdrawal')],
-        [InlineKeyboardButton("📜 View History", callback_data='withdrawal_history')],
-        [InlineKeyboardButton(f"{'🔄 Update' if upi_id else '💳 Set'} UPI ID", callback_data='set_upi_id')],
-        [InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]
+        [
+            InlineKeyboardButton("✅ Approve", callback_data=router.data('at', user_id, task_id)),
+            InlineKeyboardButton("❌ Decline", callback_data=router.data('dt', user_id, task_id)),
+        ],
+        [
+            InlineKeyboardButton("◀️ Prev", callback_data=router.data('rp', task_id, user_id)),
+            InlineKeyboardButton("Next ▶️", callback_data=router.data('rn', task_id, user_id)),
+        ],
+        [BACK_TO_ADMIN_BUTTON]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Keyboard shown after approving/declining a submission
+def review_continue_buttons(task_id: int, user_id: int):
+    keyboard = [
+        [InlineKeyboardButton("📋 Next Submission ▶️", callback_data=router.data('rn', task_id, user_id))],
+        [BACK_TO_ADMIN_BUTTON]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Withdraw menu rows below the cash out button, with and without a UPI ID on file
+WITHDRAW_MENU_ROWS = {
+    has_upi_id: [
+        [InlineKeyboardButton("📜 View History", callback_data='withdrawal_history')],
+        [InlineKeyboardButton(f"{'🔄 Update' if has_upi_id else '💳 Set'} UPI ID", callback_data='set_upi_id')],
+        [BACK_TO_MENU_BUTTON]
+    ]
+    for has_upi_id in (False, True)
+}
+
+# The cash out button carries the user's latest withdrawal ID, which keys the request
+def withdraw_menu(upi_id: str, latest_withdrawal_id: int):
+    request = InlineKeyboardButton("💰 Request Cash Out", callback_data=router.data('request_withdrawal', latest_withdrawal_id))
+    return InlineKeyboardMarkup([[request]] + WITHDRAW_MENU_ROWS[bool(upi_id)])
+
 # Withdrawal confirmation keyboard
 def withdrawal_confirmation_buttons(withdrawal_id: int):
     keyboard = [
         [
-            InlineKeyboardButton("✅ Confirm", callback_data=f'confirm_withdrawal_{withdrawal_id}'),
-            InlineKeyboardButton("❌ Cancel", callback_data='cancel_withdrawal')
+            InlineKeyboardButton("✅ Confirm", callback_data=router.data('cw', withdrawal_id)),
+            InlineKeyboardButton("❌ Cancel", callback_data=router.data('xw', withdrawal_id))
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -480,8 +2410,8 @@ def withdrawal_confirmation_buttons(withdrawal_id: int):
 def withdrawal_action_buttons(withdrawal_id: int):
     keyboard = [
         [
-            InlineKeyboardButton("✅ Approve", callback_data=f'approve_withdrawal_{withdrawal_id}'),
-            InlineKeyboardButton("❌ Decline", callback_data=f'decline_withdrawal_{withdrawal_id}')
+            InlineKeyboardButton("✅ Approve", callback_data=router.data('aw', withdrawal_id)),
+            InlineKeyboardButton("❌ Decline", callback_data=router.data('dw', withdrawal_id))
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -493,14 +2423,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     referrer_id = int(args[0]) if args else None
 
     # Save user to database
-    save_user(user.id, user.username, referrer_id)
+    await save_user(user.id, user.username, referrer_id)
 
     # Notify referrer if exists and user is new
     if referrer_id:
-        referrer = get_user(referrer_id)
-        user_exists = get_user(user.id)
+        referrer = await get_user(referrer_id)
+        user_exists = await get_user(user.id)
         if referrer and user_exists[4] == referrer_id:
-            await context.bot.send_message(
+            outbox.send(
                 referrer_id,
                 f"🎉 Awesome! Your friend @{user.username} just joined via your referral link! 🚀"
             )
@@ -509,17 +2439,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id in ADMIN_IDS:
         await update.message.reply_text(
             "🎉 Welcome back, Admin! Take control with the admin panel below: ⚙️",
-            reply_markup=admin_menu()
+            reply_markup=ADMIN_MENU
         )
         return
 
     # Check channel subscription for non-admins
     if await is_user_subscribed(context, user.id):
-        update_channel_status(user.id, True)
-        user_data = get_user(user.id)
+        await membership.record(user.id, True)
+        user_data = await get_user(user.id)
         if user_data[4]:
-            add_bonus(user_data[4], 0)
-            await context.bot.send_message(
+            await add_bonus(user_data[4], 0)
+            outbox.send(
                 user_data[4],
                 f"🎊 Great news! Your referral @{user.username} joined {CHANNEL_ID}! Now you will recieve 50% of his earnings ! 💰 Keep inviting! 🚀"
             )
@@ -528,598 +2458,597 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Join {CHANNEL_ID} and start earning rewards with exciting tasks, referrals, and more! 💸\n"
             f"Let's dive in—choose an option below! 👇"
         )
-        await update.message.reply_text(welcome_message, reply_markup=main_menu())
+        await update.message.reply_text(welcome_message, reply_markup=MAIN_MENU)
     else:
-        keyboard = [[InlineKeyboardButton("📢 Join Channel Now", url=f"https://t.me/{CHANNEL_ID[1:]}")]]
         await update.message.reply_text(
             f"🚀 Unlock amazing rewards by joining {CHANNEL_ID}! Click below to get started! 🎉",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        context.job_queue.run_once(check_subscription, 30, data={'user_id': user.id})
-
-# Check subscription job
-async def check_subscription(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.data['user_id']
-    if await is_user_subscribed(context, user_id):
-        user = get_user(user_id)
-        update_channel_status(user_id, True)
-        if user[4]:
-            add_bonus(user[4], 0)
-            await context.bot.send_message(
-                user[4],
-                f"🎊 Your referral @{user[1]} just joined {CHANNEL_ID}! Now you will receive 50% of his earnings ! 💰 Keep spreading the word! 🚀"
-            )
-        welcome_message = (
-            f"🎉 Welcome aboard, @{user[1]}! 🎈\n"
-            f"You're now part of {CHANNEL_ID}! Start earning rewards with fun tasks and referrals! 💸\n"
-            f"Pick an option below to begin! 👇"
+            reply_markup=JOIN_CHANNEL
         )
-        await context.bot.send_message(user_id, welcome_message, reply_markup=main_menu())
-    else:
-        await context.bot.send_message(
-            user_id,
-            f"🚀 Join {CHANNEL_ID} to unlock exciting rewards! Click below to join now! 🎉",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📢 Join Channel Now", url=f"https://t.me/{CHANNEL_ID[1:]}")]])
+        await add_pending_membership(user.id, time.time() + MEMBERSHIP_RECHECK_INTERVAL)
+
+# Welcome a user who joined the channel after /start and tell their referrer
+async def welcome_member(user_id: int):
+    user = await get_user(user_id)
+    if not user:
+        return
+    if user[4]:
+        await add_bonus(user[4], 0)
+        outbox.send(
+            user[4],
+            f"🎊 Your referral @{user[1]} just joined {CHANNEL_ID}! Now you will receive 50% of his earnings ! 💰 Keep spreading the word! 🚀"
         )
+    welcome_message = (
+        f"🎉 Welcome aboard, @{user[1]}! 🎈\n"
+        f"You're now part of {CHANNEL_ID}! Start earning rewards with fun tasks and referrals! 💸\n"
+        f"Pick an option below to begin! 👇"
+    )
+    outbox.send(user_id, welcome_message, MAIN_MENU, PRIORITY_INTERACTIVE)
 
-# Callback query handler
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
+# Periodic job: re-check a batch of users who haven't joined the channel yet.
+# The job data is (workers, index), each worker process re-checks its own users.
+async def recheck_memberships(context: ContextTypes.DEFAULT_TYPE):
+    workers, index = context.job.data
+    for user_id, attempts in await get_due_memberships(time.time(), MEMBERSHIP_RECHECK_BATCH, workers, index):
+        await telegram_rate_limiter.acquire(PRIORITY_BROADCAST)
+        try:
+            if await membership.lookup(context.bot, user_id, fresh=True):
+                if await membership.record(user_id, True):
+                    await welcome_member(user_id)
+                continue
+            if attempts + 1 >= MEMBERSHIP_RECHECK_ATTEMPTS:
+                await remove_pending_membership(user_id)
+            else:
+                await reschedule_pending_membership(user_id, time.time() + MEMBERSHIP_RECHECK_INTERVAL * 2 ** (attempts + 1))
+            if attempts == 0:
+                outbox.send(
+                    user_id,
+                    JOIN_CHANNEL_TEXT,
+                    reply_markup=JOIN_CHANNEL
+                )
+        except TelegramError as e:
+            logger.warning(f"Membership re-check for user {user_id} failed: {e}")
 
-    # Admins bypass all restrictions
-    if user_id in ADMIN_IDS:
-        if query.data == 'admin_users':
-            conn = sqlite3.connect('bot.db')
-            c = conn.cursor()
-            c.execute('SELECT user_id, username, balance FROM users')
-            users = c.fetchall()
-            user_count = get_user_count()
-            conn.close()
-            message = f"👥 User Dashboard (Total: {user_count}):\n"
-            for uid, username, balance in users:
-                message += f"ID: {uid}, @{username}, Balance: {balance} points 💰\n"
-            message += "\n💡 Update balance: /setbalance <user_id> <amount>\n💡 Deduct balance: /removebalance <user_id> <amount>"
-            await query.message.edit_text(message, reply_markup=admin_menu())
+# Periodic job: drop idempotency keys old enough that no duplicate can still arrive
+async def expire_idempotency_keys(context: ContextTypes.DEFAULT_TYPE):
+    removed = await prune_idempotency_keys(time.time() - IDEMPOTENCY_KEY_TTL)
+    if removed:
+        logger.info(f"Removed {removed} expired idempotency keys")
 
-        elif query.data == 'admin_add_task':
-            await query.message.edit_text(
-                "➕ Ready to add a new task? Send: /add_task <title> | <description> | <payment_price> | <question>",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+# Channel join/leave events keep the membership cache and joined_channel current
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    if CHANNEL_ID not in (f"@{change.chat.username}", str(change.chat.id)):
+        return
+    user_id = change.new_chat_member.user.id
+    is_member = change.new_chat_member.status in MEMBER_STATUSES
+    if await membership.record(user_id, is_member) and is_member:
+        await welcome_member(user_id)
 
-        elif query.data == 'admin_remove_task':
-            tasks = get_tasks()
-            if not tasks:
-                await query.message.edit_text(
-                    "🚫 No tasks available to remove.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-                return
-            message = "📋 Available Tasks:\n"
-            for task_id, title, desc, price, question in tasks:
-                message += f"Task {task_id}: {title} ({price} points) 💸\n{desc}\n\n"
-            message += "💡 Send: /remove_task <task_id> to delete a task."
-            await query.message.edit_text(
-                message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+# Render one page of the admin user directory
+async def render_user_page(order: str, cursor: tuple = None):
+    rows = await get_user_page(order, cursor, USER_PAGE_SIZE + 1)
+    has_next = len(rows) > USER_PAGE_SIZE
+    rows = rows[:USER_PAGE_SIZE]
+    sort_name = 'balance' if order == 'b' else 'join date'
+    if cursor:
+        message = f"👥 User Dashboard (by {sort_name}, continued):\n"
+    else:
+        message = f"👥 User Dashboard (Total: {await get_user_count()}, by {sort_name}):\n"
+    for uid, username, balance, _ in rows:
+        message += f"ID: {uid}, @{username}, Balance: {balance} points 💰\n"
+    if not rows:
+        message += "🚫 No more users.\n"
+    message += (
+        "\n💡 User details: /user <user_id>\n💡 Search: /finduser <username prefix>"
+        "\n💡 Update balance: /setbalance <user_id> <amount>\n💡 Deduct balance: /removebalance <user_id> <amount>"
+    )
+    keyboard = []
+    if has_next:
+        _, _, _, last_key = rows[-1]
+        keyboard.append([InlineKeyboardButton("Next ▶️", callback_data=router.data('u' + order, last_key, rows[-1][0]))])
+    keyboard.append([
+        InlineKeyboardButton("💰 By Balance", callback_data='ub'),
+        InlineKeyboardButton("🕒 By Join Date", callback_data='uj'),
+    ])
+    keyboard.append([BACK_TO_ADMIN_BUTTON])
+    return message, InlineKeyboardMarkup(keyboard)
 
-        elif query.data == 'admin_announcement':
-            await query.message.edit_text(
-                "📢 Want to share an update? Send: /announcement <message>",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+REVIEW_QUEUE_END = StaticKeyboard([
+    [InlineKeyboardButton("⏮ Start Over", callback_data='admin_task_requests')],
+    [BACK_TO_ADMIN_BUTTON]
+])
 
-        elif query.data == 'admin_remove_balance':
-            await query.message.edit_text(
-                "💸 Adjust a user's balance: /removebalance <user_id> <amount>",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+# Render one submission of the task review queue
+async def render_review_item(cursor: tuple = (0, 0), backwards: bool = False):
+    item = await get_review_item(cursor, backwards)
+    if not item:
+        if not await count_pending_submissions():
+            return "🚫 No pending task submissions to review.", BACK_TO_ADMIN
+        return "✅ You've reached the end of the review queue.", REVIEW_QUEUE_END
+    task_id, task_user_id, title, price, question, response, username = item
+    message = (
+        f"📋 Task Submission ({await count_pending_submissions()} pending):\n"
+        f"User: @{username} (ID: {task_user_id})\n"
+        f"Task {task_id}: {title} ({price} points) 💸\n"
+        f"Question: {question}\n"
+        f"Response: {response}\n"
+        f"Take action below! 👇"
+    )
+    return message, review_item_buttons(task_id, task_user_id)
 
-        elif query.data == 'admin_delete_announcement':
-            announcements = get_announcements()
-            if not announcements:
-                await query.message.edit_text(
-                    "🚫 No announcements to delete.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-                return
-            message = "📢 Current Announcements:\n"
-            for ann_id, msg, timestamp in announcements:
-                message += f"ID: {ann_id}\n{msg}\n📅 Posted: {timestamp}\n\n"
-            message += "💡 Send: /deleteannouncement <announcement_id> to remove."
-            await query.message.edit_text(
-                message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
 
-        elif query.data == 'admin_withdraw_requests':
-            withdrawals = get_pending_withdrawals()
-            if not withdrawals:
-                await query.message.edit_text(
-                    "🚫 No pending withdrawal requests.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-                return
-            message = "💸 Pending Withdrawal Requests:\n"
-            for wid, uid, amount, upi_id, timestamp, username in withdrawals:
-                message += f"ID: {wid}, User: @{username} (ID: {uid})\n💰 Amount: {amount} Rs\n💳 UPI ID: {upi_id}\n📅 Posted: {timestamp}\n\n"
-                keyboard = withdrawal_action_buttons(wid)
-                await context.bot.send_message(
-                    user_id,
-                    f"💸 New Withdrawal Request:\nUser: @{username} (ID: {uid})\nAmount: {amount} Rs\nUPI ID: {upi_id}\n📅 Posted: {timestamp}\nTake action below! 👇",
-                    reply_markup=keyboard
-                )
-            await query.message.edit_text(
-                message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+# Admin callbacks
+@router.route('admin_users', admin=True)
+async def show_users(query, context, user):
+    message, keyboard = await render_user_page('b')
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-        elif query.data == 'admin_task_requests':
-            tasks = get_tasks()
-            pending_tasks = []
-            for task in tasks:
-                task_id = task[0]
-                c = sqlite3.connect('bot.db').cursor()
-                c.execute('''
-                    SELECT ut.user_id, tr.response, u.username
-                    FROM user_tasks ut
-                    JOIN task_responses tr ON ut.user_id = tr.user_id AND ut.task_id = tr.task_id
-                    JOIN users u ON ut.user_id = u.user_id
-                    WHERE ut.task_id = ? AND ut.pending = 1
-                ''', (task_id,))
-                pending_tasks.extend([(task_id, task[1], task[3], task[4], user_id, response, username) 
-                                     for user_id, response, username in c.fetchall()])
-                c.close()
-            if not pending_tasks:
-                await query.message.edit_text(
-                    "🚫 No pending task submissions to review.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-                return
-            message = "📋 Pending Task Submissions:\n"
-            for task_id, title, price, question, task_user_id, response, username in pending_tasks:
-                message += f"Task {task_id}: {title} ({price} points) 💸\nUser: @{username} (ID: {task_user_id})\nResponse: {response}\n\n"
-                keyboard = task_action_buttons(task_user_id, task_id)
-                await context.bot.send_message(
-                    query.from_user.id,
-                    f"📋 New Task Submission:\nUser: @{username} (ID: {task_user_id})\nTask {task_id}: {title} ({price} points)\nResponse: {response}\nTake action below! 👇",
-                    reply_markup=keyboard
-                )
-            await query.message.edit_text(
-                message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-            )
+@router.route('ub', INT_ARG, INT_ARG, admin=True, legacy='admin_users_b')
+async def show_users_by_balance(query, context, user, *cursor):
+    message, keyboard = await render_user_page('b', cursor if len(cursor) == 2 else None)
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-        elif query.data.startswith('approve_withdrawal_'):
-            try:
-                withdrawal_id = int(query.data.replace('approve_withdrawal_', ''))
-                conn = sqlite3.connect('bot.db')
-                c = conn.cursor()
-                c.execute('''
-                    SELECT w.user_id, w.amount, w.upi_id, u.username
-                    FROM withdrawals w
-                    JOIN users u ON w.user_id = u.user_id
-                    WHERE w.withdrawal_id = ? AND w.status = 'pending'
-                ''', (withdrawal_id,))
-                withdrawal = c.fetchone()
-                conn.close()
-                if not withdrawal:
-                    await query.message.edit_text(
-                        "🚫 No pending withdrawal request found for this ID.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                    )
-                    return
-                user_id, amount, upi_id, username = withdrawal
-                approve_withdrawal(withdrawal_id)
-                await context.bot.send_message(
-                    user_id,
-                    f"🎉 Your withdrawal request (ID: {withdrawal_id}) of {amount} Rs to {upi_id} has been approved! 🎊 Funds are on their way! 🚀"
-                )
-                await query.message.edit_text(
-                    f"✅ Withdrawal ID {withdrawal_id} of {amount} Rs approved for @{username} (UPI: {upi_id}).",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-            except (ValueError, sqlite3.Error) as e:
-                logger.error(f"Error approving withdrawal: {e}")
-                await query.message.edit_text(
-                    "❌ Error processing withdrawal. Please try again or contact support.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
+@router.route('uj', TIMESTAMP_ARG, INT_ARG, admin=True, legacy='admin_users_j')
+async def show_users_by_join_date(query, context, user, *cursor):
+    message, keyboard = await render_user_page('j', cursor if len(cursor) == 2 else None)
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-        elif query.data.startswith('decline_withdrawal_'):
-            try:
-                withdrawal_id = int(query.data.replace('decline_withdrawal_', ''))
-                conn = sqlite3.connect('bot.db')
-                c = conn.cursor()
-                c.execute('''
-                    SELECT w.user_id, w.amount, w.upi_id, u.username
-                    FROM withdrawals w
-                    JOIN users u ON w.user_id = u.user_id
-                    WHERE w.withdrawal_id = ? AND w.status = 'pending'
-                ''', (withdrawal_id,))
-                withdrawal = c.fetchone()
-                conn.close()
-                if not withdrawal:
-                    await query.message.edit_text(
-                        "🚫 No pending withdrawal request found for this ID.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                    )
-                    return
-                user_id, amount, upi_id, username = withdrawal
-                decline_withdrawal(withdrawal_id)
-                add_bonus(user_id, amount)
-                await context.bot.send_message(
-                    user_id,
-                    f"⚠️ Your withdrawal request (ID: {withdrawal_id}) of {amount} Rs to {upi_id} was declined. {amount} points have been refunded to your balance. Try again or contact support! 📞"
-                )
-                await query.message.edit_text(
-                    f"❌ Withdrawal ID {withdrawal_id} of {amount} Rs declined for @{username} (UPI: {upi_id}). Points refunded.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-            except (ValueError, sqlite3.Error) as e:
-                logger.error(f"Error declining withdrawal: {e}")
-                await query.message.edit_text(
-                    "❌ Error processing withdrawal. Please try again or contact support.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
+@router.route('admin_add_task', admin=True)
+async def show_add_task_help(query, context, user):
+    await query.message.edit_text(
+        "➕ Ready to add a new task? Send: /add_task <title> | <description> | <payment_price> | <question>",
+        reply_markup=BACK_TO_ADMIN
+    )
 
-        elif query.data.startswith('approve_task_'):
-            try:
-                parts = query.data.replace('approve_task_', '').split('_')
-                task_user_id = int(parts[0])
-                task_id = int(parts[1])
-                tasks = get_tasks()
-                task = next((t for t in tasks if t[0] == task_id), None)
-                if not task:
-                    await query.message.edit_text(
-                        "🚫 Task not found.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                    )
-                    return
-                user = get_user(task_user_id)
-                mark_task_completed(task_user_id, task_id)
-                task_price = task[3]
-                add_bonus(task_user_id, task_price)
-                task_title = task[1]
-                await context.bot.send_message(
-                    task_user_id,
-                    f"🎉 Woohoo! Your submission for Task {task_id}: {task_title} has been approved! 🎊 +{task_price} points added to your balance! Keep rocking it! 🚀"
-                )
-                referrer_id = user[4]
-                if referrer_id:
-                    referrer_bonus = int(task_price * 0.5)  # Changed from 0.2 to 0.5 for 50% bonus
-                    add_bonus(referrer_id, referrer_bonus)
-                    referrer = get_user(referrer_id)
-                    await context.bot.send_message(
-                        referrer_id,
-                        f"🎊 Your referral @{user[1]} smashed Task {task_id}: {task_title}! You earned {referrer_bonus} points (50% of task reward)! 💰 Keep inviting! 🚀"
-                    )
-                await query.message.edit_text(
-                    f"✅ Task {task_id}: {task_title} approved for @{user[1]}. +{task_price} points awarded.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-            except (ValueError, sqlite3.Error) as e:
-                logger.error(f"Error approving task: {e}")
-                await query.message.edit_text(
-                    "❌ Error processing task approval. Please try again or contact support.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
+@router.route('admin_remove_task', admin=True)
+async def show_remove_task_help(query, context, user):
+    tasks = await task_catalog.all()
+    if not tasks:
+        await query.message.edit_text("🚫 No tasks available to remove.", reply_markup=BACK_TO_ADMIN)
+        return
+    message = "📋 Available Tasks:\n"
+    for task_id, title, desc, price, question in tasks:
+        message += f"Task {task_id}: {title} ({price} points) 💸\n{desc}\n\n"
+    message += "💡 Send: /remove_task <task_id> to delete a task."
+    await query.message.edit_text(message, reply_markup=BACK_TO_ADMIN)
 
-        elif query.data.startswith('decline_task_'):
-            try:
-                parts = query.data.replace('decline_task_', '').split('_')
-                task_user_id = int(parts[0])
-                task_id = int(parts[1])
-                tasks = get_tasks()
-                task = next((t for t in tasks if t[0] == task_id), None)
-                if not task:
-                    await query.message.edit_text(
-                        "🚫 Task not found.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                    )
-                    return
-                user = get_user(task_user_id)
-                task_title = task[1]
-                decline_task(task_user_id, task_id)
-                await context.bot.send_message(
-                    task_user_id,
-                    f"⚠️ Your submission for Task {task_id}: {task_title} was declined. Please review the requirements and try again! 📝 Contact support if you need help."
-                )
-                await query.message.edit_text(
-                    f"❌ Task {task_id}: {task_title} declined for @{user[1]}.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
-            except (ValueError, sqlite3.Error) as e:
-                logger.error(f"Error declining task: {e}")
-                await query.message.edit_text(
-                    "❌ Error processing task decline. Please try again or contact support.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin", callback_data='back_admin')]])
-                )
+@router.route('admin_announcement', admin=True)
+async def show_announcement_help(query, context, user):
+    await query.message.edit_text("📢 Want to share an update? Send: /announcement <message>", reply_markup=BACK_TO_ADMIN)
 
-        elif query.data == 'back_admin':
-            await query.message.edit_text(
-                "⚙️ Admin Panel: Manage users, tasks, and withdrawals with ease! Choose an option: 👇",
-                reply_markup=admin_menu()
-            )
-        return
+@router.route('admin_remove_balance', admin=True)
+async def show_remove_balance_help(query, context, user):
+    await query.message.edit_text("💸 Adjust a user's balance: /removebalance <user_id> <amount>", reply_markup=BACK_TO_ADMIN)
 
-    # Non-admins require channel join
-    user = get_user(user_id)
-    if not user or not user[2]:
-        await query.message.edit_text(
-            f"🚀 Join {CHANNEL_ID} to unlock exciting rewards! Click below to join now! 🎉",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📢 Join Channel Now", url=f"https://t.me/{CHANNEL_ID[1:]}")]])
-        )
+@router.route('admin_delete_announcement', admin=True)
+async def show_delete_announcement_help(query, context, user):
+    announcements = await get_announcements()
+    if not announcements:
+        await query.message.edit_text("🚫 No announcements to delete.", reply_markup=BACK_TO_ADMIN)
         return
+    message = "📢 Current Announcements:\n"
+    for ann_id, msg, timestamp in announcements:
+        message += f"ID: {ann_id}\n{msg}\n📅 Posted: {timestamp}\n\n"
+    message += "💡 Send: /deleteannouncement <announcement_id> to remove."
+    await query.message.edit_text(message, reply_markup=BACK_TO_ADMIN)
 
-    if query.data == 'refer':
-        referral_link = f"https://t.me/{context.bot.username}?start={user_id}"
-        await query.message.edit_text(
-            f"🎉 Invite your friends and earn big! Share this link and earn 50% of his earnings:\n{referral_link}\n"
-            f"💰 Get lifetime rewards per friend who joins {CHANNEL_ID} and 50% of their task rewards! 🚀 Start sharing now!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
+@router.route('admin_withdraw_requests', admin=True)
+async def show_withdraw_requests(query, context, user):
+    pending_count, pending_total = await get_pending_withdrawal_totals()
+    if not pending_count:
+        await query.message.edit_text("🚫 No pending withdrawal requests.", reply_markup=BACK_TO_ADMIN)
+        return
+    withdrawals = await get_pending_withdrawals(PENDING_WITHDRAWALS_SHOWN)
+    message = f"💸 Pending Withdrawal Requests ({pending_count}, {pending_total} Rs total), oldest first:\n"
+    keyboard = []
+    for wid, uid, amount, upi_id, timestamp, username in withdrawals:
+        message += f"ID: {wid}, User: @{username} (ID: {uid})\n💰 Amount: {amount} Rs\n💳 UPI ID: {upi_id}\n📅 Posted: {timestamp}\n\n"
+        keyboard.append([
+            InlineKeyboardButton(f"✅ #{wid}", callback_data=router.data('aw', wid)),
+            InlineKeyboardButton(f"❌ #{wid}", callback_data=router.data('dw', wid)),
+        ])
+    if pending_count > len(withdrawals):
+        message += f"...and {pending_count - len(withdrawals)} more.\n"
+    batch_size = min(pending_count, PAYOUT_BATCH_LIMIT)
+    keyboard.append([InlineKeyboardButton(f"✅ Approve {batch_size} Oldest + Export CSV", callback_data=router.data('approve_all_withdrawals', withdrawals[0][0]))])
+    keyboard.append([BACK_TO_ADMIN_BUTTON])
+    await query.message.edit_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    elif query.data == 'tasks':
-        keyboard = task_selection_menu()
-        if not keyboard:
-            await query.message.edit_text(
-                "🚫 No tasks available right now. Check back soon for exciting opportunities! 🎉",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-            return
-        await query.message.edit_text("📋 Choose a task to start earning rewards! 💸", reply_markup=keyboard)
+# Keyed on the oldest withdrawal shown, so repeated taps approve one batch
+@router.route('approve_all_withdrawals', INT_ARG, admin=True)
+async def approve_all_withdrawals(query, context, user, oldest_withdrawal_id: int = None):
+    if oldest_withdrawal_id is None:
+        await show_withdraw_requests(query, context, user)
+        return
+    result = await process_payout_batch(context, query.from_user.id, PAYOUT_BATCH_LIMIT, str(oldest_withdrawal_id))
+    # The first tap's message stays; a reply says why this one did nothing
+    if result is DUPLICATE:
+        await query.message.reply_text("ℹ️ This payout batch was already approved. Open Withdraw Requests for anything still pending.")
+        return
+    if not result:
+        message = "🚫 No pending withdrawal requests."
+    else:
+        batch_id, count, total, exported = result
+        message = f"✅ Payout batch #{batch_id}: approved {count} withdrawals ({total} Rs). Users are being notified! 🚀\n"
+        message += "📤 The payout file is above." if exported else PAYOUT_EXPORT_FAILED_TEXT.format(batch_id=batch_id)
+    await query.message.edit_text(message, reply_markup=BACK_TO_ADMIN)
 
-    elif query.data.startswith('task_'):
-        task_id = int(query.data.split('_')[1])
-        tasks = get_tasks()
-        task = next((t for t in tasks if t[0] == task_id), None)
-        if not task:
-            await query.message.edit_text(
-                "🚫 Task not found. Try another one! 📝",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-            return
-        task_id, title, desc, price, _ = task
-        message = (
-            f"📋 Task {task_id}: {title}\n"
-            f"📝 Description: {desc}\n"
-            f"💰 Reward: {price} points\n"
-            f"Ready to start? Click below! 👇"
-        )
-        await query.message.edit_text(message, reply_markup=task_complete_button(task_id))
+@router.route('admin_task_requests', admin=True)
+async def show_review_queue(query, context, user):
+    message, keyboard = await render_review_item()
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-    elif query.data.startswith('complete_'):
-        task_id = int(query.data.split('_')[1])
-        tasks = get_tasks()
-        task = next((t for t in tasks if t[0] == task_id), None)
-        if not task:
-            await query.message.edit_text(
-                "🚫 Task not found. Try another one! 📝",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-            return
-        context.user_data['awaiting_response'] = task_id
-        await query.message.edit_text(
-            f"📝 Task Question: {task[4]}\n"
-            f"Please send your response as a text message to submit! 🚀",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
+@router.route('rn', INT_ARG, INT_ARG, admin=True, legacy='review_next')
+async def show_next_review_item(query, context, user, task_id: int, task_user_id: int):
+    message, keyboard = await render_review_item((task_id, task_user_id))
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-    elif query.data == 'insights':
-        referrals = get_referrals(user_id)
-        completed_tasks = get_completed_tasks(user_id)
-        message = "📊 Your Progress Snapshot:\n"
-        message += f"👥 Total Referrals: {len(referrals)}\n"
-        if referrals:
-            message += "Your Referrals:\n"
-            for ref_id, ref_username in referrals:
-                ref_tasks = get_completed_tasks(ref_id)
-                message += f"@{ref_username}: {len(ref_tasks)} tasks completed 🎉\n"
-        message += f"\n✅ Completed Tasks: {len(completed_tasks)}\n"
-        message += "Keep earning and inviting to climb the leaderboard! 🚀"
-        await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
+@router.route('rp', INT_ARG, INT_ARG, admin=True, legacy='review_prev')
+async def show_previous_review_item(query, context, user, task_id: int, task_user_id: int):
+    message, keyboard = await render_review_item((task_id, task_user_id), True)
+    await query.message.edit_text(message, reply_markup=keyboard)
 
-    elif query.data == 'account':
-        user = get_user(user_id)
-        referrals = get_referrals(user_id)
-        completed_tasks = get_completed_tasks(user_id)
-        message = (
-            f"👤 Your Account Overview:\n"
-            f"💼 Username: @{user[1]}\n"
-            f"💰 Balance: {user[3]} points\n"
-            f"💳 UPI ID: {user[5] if user[5] else 'Not set'}\n"
-            f"👥 Referrals: {len(referrals)}\n"
-            f"✅ Completed Tasks: {len(completed_tasks)}\n"
-            f"Keep rocking it! 🚀 Check your options below:"
+@router.route('aw', INT_ARG, admin=True, legacy='approve_withdrawal')
+async def approve_withdrawal_button(query, context, user, withdrawal_id: int):
+    try:
+        withdrawal = await approve_withdrawal(withdrawal_id)
+        if not withdrawal:
+            await query.message.edit_text("🚫 No pending withdrawal request found for this ID.", reply_markup=BACK_TO_ADMIN)
+            return
+        user_id, amount, upi_id, username = withdrawal
+        outbox.send(
+            user_id,
+            f"🎉 Your withdrawal request (ID: {withdrawal_id}) of {amount} Rs to {upi_id} has been approved! 🎊 Funds are on their way! 🚀"
         )
         await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+            f"✅ Withdrawal ID {withdrawal_id} of {amount} Rs approved for @{username} (UPI: {upi_id}).",
+            reply_markup=BACK_TO_ADMIN
         )
+    except db.errors as e:
+        logger.error(f"Error approving withdrawal: {e}")
+        await query.message.edit_text("❌ Error processing withdrawal. Please try again or contact support.", reply_markup=BACK_TO_ADMIN)
 
-    elif query.data == 'pending_completed':
-        pending_tasks = get_pending_tasks(user_id)
-        completed_tasks = get_completed_tasks(user_id)
-        message = "⏳ Your Task Status:\n"
-        if pending_tasks:
-            message += "\n🔄 Pending Tasks:\n"
-            for task_id, title, desc, price in pending_tasks:
-                message += f"Task {task_id}: {title} ({price} points) 💸\n{desc}\n\n"
-        else:
-            message += "\n🔄 No Pending Tasks.\n"
-        if completed_tasks:
-            message += "\n✅ Completed Tasks:\n"
-            for task_id, title, desc, price in completed_tasks:
-                message += f"Task {task_id}: {title} ({price} points) 🎉\n{desc}\n\n"
-        else:
-            message += "\n✅ No Completed Tasks."
-        message += "Ready for more? Check tasks now! 👇"
-        await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
-
-    elif query.data == 'announcements':
-        announcements = get_announcements()
-        if not announcements:
-            await query.message.edit_text(
-                "🚫 No updates right now. Stay tuned for exciting news! 📢",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
+@router.route('dw', INT_ARG, admin=True, legacy='decline_withdrawal')
+async def decline_withdrawal_button(query, context, user, withdrawal_id: int):
+    try:
+        withdrawal = await decline_withdrawal(withdrawal_id)
+        if not withdrawal:
+            await query.message.edit_text("🚫 No pending withdrawal request found for this ID.", reply_markup=BACK_TO_ADMIN)
             return
-        message = "📢 Latest Updates:\n"
-        for ann_id, msg, timestamp in announcements:
-            message += f"ID: {ann_id}\n{msg}\n📅 Posted: {timestamp}\n\n"
-        message += "Stay in the loop! Check back for more updates! 🚀"
-        await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
-
-    elif query.data == 'withdraw':
-        user = get_user(user_id)
-        message = (
-            f"💸 Cash Out Your Earnings:\n"
-            f"💰 Minimum withdrawal: 15 Rs\n"
-            f"📈 Current balance: {user[3]} points\n"
-            f"💳 UPI ID: {user[5] if user[5] else 'Not set'}\n"
-            f"Ready to withdraw? Choose an option below! 👇"
+        user_id, amount, upi_id, username = withdrawal
+        outbox.send(
+            user_id,
+            f"⚠️ Your withdrawal request (ID: {withdrawal_id}) of {amount} Rs to {upi_id} was declined. {amount} points have been refunded to your balance. Try again or contact support! 📞"
         )
         await query.message.edit_text(
-            message,
-            reply_markup=withdraw_menu(user[5])
+            f"❌ Withdrawal ID {withdrawal_id} of {amount} Rs declined for @{username} (UPI: {upi_id}). Points refunded.",
+            reply_markup=BACK_TO_ADMIN
         )
-
-    elif query.data == 'set_upi_id':
-        context.user_data['awaiting_upi_id'] = True
-        await query.message.edit_text(
-            f"💳 Please provide your {'updated ' if user[5] else ''}UPI ID to cash out! 🚀",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-        )
-
-    elif query.data == 'request_withdrawal':
-        user = get_user(user_id)
-        if user[3] < 15:
-            await query.message.edit_text(
-                "⚠️ Not enough points! You need at least 15 points to withdraw. Keep earning! 💪",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-            return
-        if not user[5]:
-            await query.message.edit_text(
-                "💳 Please set your UPI ID to proceed with withdrawals.",
-                reply_markup=withdraw_menu(user[5])
-            )
-            return
-        amount = 15
-        if deduct_balance(user_id, amount):
-            add_withdrawal(user_id, amount, user[5])
-            conn = sqlite3.connect('bot.db')
-            c = conn.cursor()
-            c.execute('SELECT withdrawal_id FROM withdrawals WHERE user_id = ? AND upi_id = ? AND amount = ?', 
-                     (user_id, user[5], amount))
-            withdrawal_id = c.fetchone()[0]
-            conn.close()
-            await query.message.edit_text(
-                f"💸 Confirm Your Withdrawal:\n"
-                f"💰 Amount: {amount} Rs\n"
-                f"💳 UPI ID: {user[5]}\n"
-                f"Please confirm or cancel below! 👇",
-                reply_markup=withdrawal_confirmation_buttons(withdrawal_id)
-            )
-        else:
-            await query.message.edit_text(
-                "⚠️ Insufficient balance for withdrawal. Earn more points! 💪",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-
-    elif query.data.startswith('confirm_withdrawal_'):
-        withdrawal_id = int(query.data.replace('confirm_withdrawal_', ''))
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT w.user_id, w.amount, w.upi_id, u.username
-            FROM withdrawals w
-            JOIN users u ON w.user_id = u.user_id
-            WHERE w.withdrawal_id = ?
-        ''', (withdrawal_id,))
-        withdrawal = c.fetchone()
-        conn.close()
-        if not withdrawal:
+    except db.errors as e:
+        logger.error(f"Error declining withdrawal: {e}")
+        await query.message.edit_text("❌ Error processing withdrawal. Please try again or contact support.", reply_markup=BACK_TO_ADMIN)
+
+@router.route('at', INT_ARG, INT_ARG, admin=True, legacy='approve_task')
+async def approve_task_button(query, context, user, task_user_id: int, task_id: int):
+    try:
+        task = await task_catalog.get(task_id)
+        if not task:
+            await query.message.edit_text("🚫 Task not found.", reply_markup=BACK_TO_ADMIN)
+            return
+        task_title, task_price = task[1], task[3]
+        result = await approve_task_submission(task_user_id, task_id, task_price)
+        if result is DUPLICATE:
+            await query.message.reply_text(f"ℹ️ This submission for Task {task_id}: {task_title} was already approved.")
+            return
+        if result is None:
             await query.message.edit_text(
-                "🚫 Withdrawal request not found.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+                f"⚠️ This submission for Task {task_id}: {task_title} was already processed.",
+                reply_markup=review_continue_buttons(task_id, task_user_id)
             )
             return
-        user_id, amount, upi_id, username = withdrawal
-        for admin_id in ADMIN_IDS:
-            await context.bot.send_message(
-                admin_id,
-                f"💸 New Withdrawal Request:\nUser: @{username} (ID: {user_id})\nAmount: {amount} Rs\nUPI ID: {upi_id}\nTake action below! 👇",
-                reply_markup=withdrawal_action_buttons(withdrawal_id)
+        referrer_id, referrer_bonus = result
+        task_user = await get_user(task_user_id)
+        outbox.send(
+            task_user_id,
+            f"🎉 Woohoo! Your submission for Task {task_id}: {task_title} has been approved! 🎊 +{task_price} points added to your balance! Keep rocking it! 🚀"
+        )
+        if referrer_id:
+            outbox.send(
+                referrer_id,
+                f"🎊 Your referral @{task_user[1]} smashed Task {task_id}: {task_title}! You earned {referrer_bonus} points (50% of task reward)! 💰 Keep inviting! 🚀"
             )
         await query.message.edit_text(
-            f"🎉 Your withdrawal request for {amount} Rs to {upi_id} has been submitted! We'll notify you once it's approved! 🚀",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+            f"✅ Task {task_id}: {task_title} approved for @{task_user[1]}. +{task_price} points awarded.",
+            reply_markup=review_continue_buttons(task_id, task_user_id)
         )
+    except db.errors as e:
+        logger.error(f"Error approving task: {e}")
+        await query.message.edit_text("❌ Error processing task approval. Please try again or contact support.", reply_markup=BACK_TO_ADMIN)
 
-    elif query.data == 'cancel_withdrawal':
-        user = get_user(user_id)
-        add_bonus(user_id, 15)
+@router.route('dt', INT_ARG, INT_ARG, admin=True, legacy='decline_task')
+async def decline_task_button(query, context, user, task_user_id: int, task_id: int):
+    try:
+        task = await task_catalog.get(task_id)
+        if not task:
+            await query.message.edit_text("🚫 Task not found.", reply_markup=BACK_TO_ADMIN)
+            return
+        task_user = await get_user(task_user_id)
+        task_title = task[1]
+        await decline_task(task_user_id, task_id)
+        outbox.send(
+            task_user_id,
+            f"⚠️ Your submission for Task {task_id}: {task_title} was declined. Please review the requirements and try again! 📝 Contact support if you need help."
+        )
         await query.message.edit_text(
-            f"⚠️ Withdrawal cancelled. 15 points have been refunded to your balance! 💰 Try again anytime!",
-            reply_markup=withdraw_menu(user[5])
+            f"❌ Task {task_id}: {task_title} declined for @{task_user[1]}.",
+            reply_markup=review_continue_buttons(task_id, task_user_id)
         )
+    except db.errors as e:
+        logger.error(f"Error declining task: {e}")
+        await query.message.edit_text("❌ Error processing task decline. Please try again or contact support.", reply_markup=BACK_TO_ADMIN)
 
-    elif query.data == 'withdrawal_history':
-        history = get_withdrawal_history(user_id)
-        if not history:
-            await query.message.edit_text(
-                "🚫 No withdrawal history yet. Start earning and cash out! 💸",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
-            )
-            return
-        message = "📜 Your Withdrawal History:\n"
-        for wid, amount, upi_id, status, timestamp in history:
-            message += f"ID: {wid}\n💰 Amount: {amount} Rs\n💳 UPI ID: {upi_id}\n📅 Posted: {timestamp}\n📌 Status: {status.capitalize()}\n\n"
-        message += "Ready to cash out more? Head to Withdraw! 👇"
+@router.route('back_admin', admin=True)
+async def show_admin_panel(query, context, user):
+    await query.message.edit_text(
+        ADMIN_PANEL_TEXT,
+        reply_markup=ADMIN_MENU
+    )
+
+# Member callbacks
+@router.route('refer')
+async def show_referral_link(query, context, user):
+    referral_link = f"https://t.me/{context.bot.username}?start={user[0]}"
+    await query.message.edit_text(
+        f"🎉 Invite your friends and earn big! Share this link and earn 50% of his earnings:\n{referral_link}\n"
+        f"💰 Get lifetime rewards per friend who joins {CHANNEL_ID} and 50% of their task rewards! 🚀 Start sharing now!",
+        reply_markup=BACK_TO_MENU
+    )
+
+@router.route('tasks')
+async def show_tasks(query, context, user):
+    keyboard = await task_selection_menu()
+    if not keyboard:
         await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+            "🚫 No tasks available right now. Check back soon for exciting opportunities! 🎉",
+            reply_markup=BACK_TO_MENU
         )
+        return
+    await query.message.edit_text("📋 Choose a task to start earning rewards! 💸", reply_markup=keyboard)
+
+@router.route('t', INT_ARG, legacy='task')
+async def show_task(query, context, user, task_id: int):
+    task = await task_catalog.get(task_id)
+    if not task:
+        await query.message.edit_text("🚫 Task not found. Try another one! 📝", reply_markup=BACK_TO_MENU)
+        return
+    task_id, title, desc, price, _ = task
+    message = (
+        f"📋 Task {task_id}: {title}\n"
+        f"📝 Description: {desc}\n"
+        f"💰 Reward: {price} points\n"
+        f"Ready to start? Click below! 👇"
+    )
+    await query.message.edit_text(message, reply_markup=task_complete_button(task_id))
+
+@router.route('c', INT_ARG, legacy='complete')
+async def start_task(query, context, user, task_id: int):
+    task = await task_catalog.get(task_id)
+    if not task:
+        await query.message.edit_text("🚫 Task not found. Try another one! 📝", reply_markup=BACK_TO_MENU)
+        return
+    context.user_data['awaiting_response'] = task_id
+    await query.message.edit_text(
+        f"📝 Task Question: {task[4]}\n"
+        f"Please send your response as a text message to submit! 🚀",
+        reply_markup=BACK_TO_MENU
+    )
+
+@router.route('insights')
+async def show_insights(query, context, user):
+    completed_tasks, referral_count, referral_earnings = await get_user_stats(user[0])
+    message = "📊 Your Progress Snapshot:\n"
+    message += f"👥 Total Referrals: {referral_count}\n"
+    message += f"💰 Referral Earnings: {referral_earnings} points\n"
+    if referral_count:
+        referrals = await get_referral_progress(user[0])
+        message += "Your Referrals:\n"
+        for ref_username, ref_completed in referrals:
+            message += f"@{ref_username}: {ref_completed} tasks completed 🎉\n"
+        if referral_count > len(referrals):
+            message += f"...and {referral_count - len(referrals)} more! 🙌\n"
+    message += f"\n✅ Completed Tasks: {completed_tasks}\n"
+    message += "Keep earning and inviting to climb the leaderboard! 🚀"
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+@router.route('leaderboard')
+async def show_leaderboard(query, context, user):
+    top = await leaderboard.top()
+    total_earned, referral_count = await get_leaderboard_scores(user[0])
+    earned_rank, referrals_rank = leaderboard.ranks(total_earned, referral_count)
+    message = (
+        f"{top}\n"
+        f"📈 Your Rank:\n"
+        f"💰 #{earned_rank} by earnings ({total_earned} points)\n"
+        f"👥 #{referrals_rank} by referrals ({referral_count})\n"
+        f"Keep going to climb higher! 🚀"
+    )
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+@router.route('account')
+async def show_account(query, context, user):
+    completed_tasks, referral_count, _ = await get_user_stats(user[0])
+    message = (
+        f"👤 Your Account Overview:\n"
+        f"💼 Username: @{user[1]}\n"
+        f"💰 Balance: {user[3]} points\n"
+        f"💳 UPI ID: {user[5] if user[5] else 'Not set'}\n"
+        f"👥 Referrals: {referral_count}\n"
+        f"✅ Completed Tasks: {completed_tasks}\n"
+        f"Keep rocking it! 🚀 Check your options below:"
+    )
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+@router.route('pending_completed')
+async def show_task_status(query, context, user):
+    pending_tasks = await get_pending_tasks(user[0])
+    completed_tasks = await get_completed_tasks(user[0])
+    message = "⏳ Your Task Status:\n"
+    if pending_tasks:
+        message += "\n🔄 Pending Tasks:\n"
+        for task_id, title, desc, price in pending_tasks:
+            message += f"Task {task_id}: {title} ({price} points) 💸\n{desc}\n\n"
+    else:
+        message += "\n🔄 No Pending Tasks.\n"
+    if completed_tasks:
+        message += "\n✅ Completed Tasks:\n"
+        for task_id, title, desc, price in completed_tasks:
+            message += f"Task {task_id}: {title} ({price} points) 🎉\n{desc}\n\n"
+    else:
+        message += "\n✅ No Completed Tasks."
+    message += "Ready for more? Check tasks now! 👇"
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+@router.route('announcements')
+async def show_announcements(query, context, user):
+    announcements = await get_announcements()
+    if not announcements:
+        await query.message.edit_text("🚫 No updates right now. Stay tuned for exciting news! 📢", reply_markup=BACK_TO_MENU)
+        return
+    message = "📢 Latest Updates:\n"
+    for ann_id, msg, timestamp in announcements:
+        message += f"ID: {ann_id}\n{msg}\n📅 Posted: {timestamp}\n\n"
+    message += "Stay in the loop! Check back for more updates! 🚀"
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+@router.route('withdraw')
+async def show_withdraw(query, context, user):
+    message = (
+        f"💸 Cash Out Your Earnings:\n"
+        f"💰 Minimum withdrawal: 15 Rs\n"
+        f"📈 Current balance: {user[3]} points\n"
+        f"💳 UPI ID: {user[5] if user[5] else 'Not set'}\n"
+        f"Ready to withdraw? Choose an option below! 👇"
+    )
+    await query.message.edit_text(message, reply_markup=withdraw_menu(user[5], await get_latest_withdrawal_id(user[0])))
 
-    elif query.data == 'about':
-        message = (
-            f"ℹ️ About Us:\n"
-            f"Welcome to our awesome bot! 🚀 Earn rewards by completing fun tasks and inviting friends to join {CHANNEL_ID}! 🎉\n"
-            f"Key Features:\n"
-            f"📢 Join {CHANNEL_ID} to unlock all features.\n"
-            f"💰 Earn 50% of their task rewards who joined via your link!\n"
-            f"📋 Complete tasks to earn points, pending admin approval.\n"
-            f"💸 Withdraw earnings (min. 15 Rs) via UPI after setting your UPI ID.\n"
-            f"📊 Track your progress, withdrawals, and more!\n"
-            f"📢 Stay updated with the latest announcements.\n"
-            f"Start exploring now! 👇"
+@router.route('set_upi_id')
+async def ask_upi_id(query, context, user):
+    context.user_data['awaiting_upi_id'] = True
+    await query.message.edit_text(
+        f"💳 Please provide your {'updated ' if user[5] else ''}UPI ID to cash out! 🚀",
+        reply_markup=BACK_TO_MENU
+    )
+
+@router.route('request_withdrawal', INT_ARG, expensive=True)
+async def request_withdrawal(query, context, user, latest_withdrawal_id: int = None):
+    if user[3] < 15:
+        await query.message.edit_text(
+            "⚠️ Not enough points! You need at least 15 points to withdraw. Keep earning! 💪",
+            reply_markup=BACK_TO_MENU
         )
+        return
+    if not user[5]:
         await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+            "💳 Please set your UPI ID to proceed with withdrawals.",
+            reply_markup=withdraw_menu(user[5], await get_latest_withdrawal_id(user[0]))
         )
-
-    elif query.data == 'back':
-        user = get_user(user_id)
+        return
+    # Buttons rendered before the ID was added are keyed on the latest withdrawal now
+    if latest_withdrawal_id is None:
+        latest_withdrawal_id = await get_latest_withdrawal_id(user[0])
+    amount = 15
+    withdrawal_id = await create_withdrawal(user[0], amount, user[5], latest_withdrawal_id)
+    if withdrawal_id is DUPLICATE:
+        await query.message.reply_text("ℹ️ This cash out button was already used. Check your withdrawal history, or open Withdraw again for a new request.")
+        return
+    if withdrawal_id:
+        await query.message.edit_text(
+            f"💸 Confirm Your Withdrawal:\n"
+            f"💰 Amount: {amount} Rs\n"
+            f"💳 UPI ID: {user[5]}\n"
+            f"Please confirm or cancel below! 👇",
+            reply_markup=withdrawal_confirmation_buttons(withdrawal_id)
+        )
+    else:
         await query.message.edit_text(
-            f"🎉 Hey @{user[1]}, ready to earn more? Pick an option below! 👇",
-            reply_markup=main_menu()
+            "⚠️ Insufficient balance for withdrawal. Earn more points! 💪",
+            reply_markup=BACK_TO_MENU
         )
 
+@router.route('cw', INT_ARG, legacy='confirm_withdrawal', expensive=True)
+async def confirm_withdrawal(query, context, user, withdrawal_id: int):
+    withdrawal = await get_withdrawal(withdrawal_id, pending_only=True)
+    if not withdrawal:
+        await query.message.edit_text("🚫 Withdrawal request not found.", reply_markup=BACK_TO_MENU)
+        return
+    # Admins hear about each withdrawal once, however often it's confirmed
+    if await idempotency.run('confirm_withdrawal', str(withdrawal_id)) is DUPLICATE:
+        return
+    user_id, amount, upi_id, username = withdrawal
+    admin_digest.notify(
+        'withdrawal',
+        f"@{username}: {amount} Rs to {upi_id}",
+        f"💸 New Withdrawal Request:\nUser: @{username} (ID: {user_id})\nAmount: {amount} Rs\nUPI ID: {upi_id}\nTake action below! 👇",
+        withdrawal_action_buttons(withdrawal_id),
+        amount=amount,
+        urgent=amount >= URGENT_WITHDRAWAL_AMOUNT,
+    )
+    await query.message.edit_text(
+        f"🎉 Your withdrawal request for {amount} Rs to {upi_id} has been submitted! We'll notify you once it's approved! 🚀",
+        reply_markup=BACK_TO_MENU
+    )
+
+@router.route('xw', INT_ARG, legacy='cancel_withdrawal', expensive=True)
+async def cancel_withdrawal_button(query, context, user, withdrawal_id: int = None):
+    # Buttons sent before withdrawal IDs were added cancel the latest pending withdrawal
+    if withdrawal_id is None:
+        withdrawal_id = await get_latest_pending_withdrawal_id(user[0])
+    withdrawal = await cancel_withdrawal(withdrawal_id, user[0]) if withdrawal_id else None
+    menu = withdraw_menu(user[5], await get_latest_withdrawal_id(user[0]))
+    if not withdrawal:
+        await query.message.edit_text("🚫 No pending withdrawal to cancel.", reply_markup=menu)
+        return
+    await query.message.edit_text(
+        f"⚠️ Withdrawal cancelled. {withdrawal[1]} points have been refunded to your balance! 💰 Try again anytime!",
+        reply_markup=menu
+    )
+
+@router.route('withdrawal_history')
+async def show_withdrawal_history(query, context, user):
+    history = await get_withdrawal_history(user[0])
+    if not history:
+        await query.message.edit_text("🚫 No withdrawal history yet. Start earning and cash out! 💸", reply_markup=BACK_TO_MENU)
+        return
+    message = "📜 Your Withdrawal History:\n"
+    for wid, amount, upi_id, status, timestamp in history:
+        message += f"ID: {wid}\n💰 Amount: {amount} Rs\n💳 UPI ID: {upi_id}\n📅 Posted: {timestamp}\n📌 Status: {status.capitalize()}\n\n"
+    message += "Ready to cash out more? Head to Withdraw! 👇"
+    await query.message.edit_text(message, reply_markup=BACK_TO_MENU)
+
+ABOUT_TEXT = (
+    f"ℹ️ About Us:\n"
+    f"Welcome to our awesome bot! 🚀 Earn rewards by completing fun tasks and inviting friends to join {CHANNEL_ID}! 🎉\n"
+    f"Key Features:\n"
+    f"📢 Join {CHANNEL_ID} to unlock all features.\n"
+    f"💰 Earn 50% of their task rewards who joined via your link!\n"
+    f"📋 Complete tasks to earn points, pending admin approval.\n"
+    f"💸 Withdraw earnings (min. 15 Rs) via UPI after setting your UPI ID.\n"
+    f"📊 Track your progress, withdrawals, and more!\n"
+    f"📢 Stay updated with the latest announcements.\n"
+    f"Start exploring now! 👇"
+)
+
+@router.route('about')
+async def show_about(query, context, user):
+    await query.message.edit_text(ABOUT_TEXT, reply_markup=BACK_TO_MENU)
+
+@router.route('back')
+async def show_main_menu(query, context, user):
+    await query.message.edit_text(
+        f"🎉 Hey @{user[1]}, ready to earn more? Pick an option below! 👇",
+        reply_markup=MAIN_MENU
+    )
+
 # Add task command (admin only)
 async def add_task_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -1130,13 +3059,498 @@ async def add_task_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             raise ValueError
         title, description, payment_price, question = [arg.strip() for arg in args]
         payment_price = int(payment_price)
-        add_task(title, description, payment_price, question)
+        await add_task(title, description, payment_price, question)
         await update.message.reply_text(f"🎉 Task '{title}' added successfully! Users can start earning now! 🚀")
     except (ValueError, IndexError):
         await update.message.reply_text(
             "💡 Usage: /add_task <title> | <description> | <payment_price> | <question>"
         )
 
+# Token bucket limiting how fast we call the Bot API. Waiters are served in
+# priority order (lower values first), so a broadcast backlog never delays
+# replies to users who are actively tapping buttons.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump = None
+
+    # Change the rate and capacity (one second's worth by default). Tokens saved up
+    # under the old settings are capped to the new capacity.
+    def set_rate(self, rate: float, capacity: float = None):
+        self._refill(time.monotonic())
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = min(self._tokens, self.capacity)
+
+    # Stop handing out tokens for a while, e.g. after a RetryAfter
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = 0):
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until:
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._hand_out())
+        await future
+
+    async def _hand_out(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():  # skip waiters that were cancelled
+                self._tokens -= 1
+                future.set_result(None)
+
+# Per-chat send budgets. Each send reserves a token up front and gets back how
+# long it has to wait, so concurrent sends to one chat space themselves out.
+class ChatRateLimits:
+    def __init__(self, rate: float, burst: float, size: int):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.chats = OrderedDict()  # chat_id -> (tokens, updated)
+
+    # Seconds until a send to this chat would go out without waiting
+    def ready_in(self, chat_id) -> float:
+        if chat_id not in self.chats:
+            return 0.0
+        tokens, updated = self.chats[chat_id]
+        tokens = min(self.burst, tokens + (time.monotonic() - updated) * self.rate)
+        return max(0.0, (1 - tokens) / self.rate)
+
+    def pause(self, chat_id, seconds: float):
+        self.chats.pop(chat_id, None)
+        self.chats[chat_id] = (1 - seconds * self.rate, time.monotonic())
+
+    def reserve(self, chat_id) -> float:
+        now = time.monotonic()
+        tokens, updated = self.chats.pop(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        self.chats[chat_id] = (tokens, now)
+        if len(self.chats) > self.size:
+            self.chats.popitem(last=False)
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+# Rate limiter plugged into the bot, so every Bot API call goes through it.
+# Pass the priority as rate_limit_args; calls without one count as interactive.
+# It only paces requests: a RetryAfter holds back the chat (or everything) and
+# is re-raised, and the outbox decides whether to try again.
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, bucket: TokenBucket, chats: ChatRateLimits):
+        self.bucket = bucket
+        self.chats = chats
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        if endpoint in RATE_LIMITED_ENDPOINTS:
+            await self.bucket.acquire(priority)
+            if endpoint in PER_CHAT_ENDPOINTS and data.get('chat_id') is not None:
+                delay = self.chats.reserve(data['chat_id'])
+                if delay:
+                    await asyncio.sleep(delay)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood control hit on {endpoint}, holding back for {e.retry_after}s")
+            # Most floods are per chat, so only hold back the chat that hit one
+            if data.get('chat_id') is not None:
+                self.chats.pause(data['chat_id'], e.retry_after)
+            else:
+                self.bucket.pause(e.retry_after)
+            raise
+
+telegram_rate_limiter = TokenBucket(TELEGRAM_RATE_LIMIT)
+chat_rate_limits = ChatRateLimits(PER_CHAT_RATE_LIMIT, PER_CHAT_BURST, PER_CHAT_TRACKED)
+active_broadcasts = set()
+
+# Outbound messages nobody is waiting on (notifications, broadcasts), delivered
+# by a pool of workers in priority order so handlers never block on them.
+class Outbox:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = []
+        self.bot = None
+        self.chats = None
+        self._seq = itertools.count()
+
+    def start(self, bot, chats: ChatRateLimits):
+        self.bot = bot
+        self.chats = chats
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Let queued messages go out (up to timeout seconds), then stop the workers
+    async def stop(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.queue.qsize()} queued outbound messages")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    # Queue a message; the returned future resolves to 'delivered', 'blocked'
+    # or 'failed' and can simply be ignored when the outcome doesn't matter
+    def send(self, chat_id: int, text: str, reply_markup=None, priority: int = PRIORITY_NOTIFICATION):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self._seq), chat_id, text, reply_markup, future, 0))
+        return future
+
+    # Put a deferred message back; it stays unfinished for queue.join() meanwhile
+    def _requeue(self, item):
+        self.queue.put_nowait(item)
+        self.queue.task_done()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            priority, seq, chat_id, text, reply_markup, future, attempt = item
+            # A chat that is out of budget goes back in the queue instead of
+            # holding up a worker that could be serving other chats
+            delay = self.chats.ready_in(chat_id)
+            if delay:
+                loop.call_later(delay, self._requeue, item)
+                continue
+            try:
+                outcome = await self._deliver(chat_id, text, reply_markup, priority)
+            except (RetryAfter, NetworkError) as e:
+                if attempt + 1 < SEND_MAX_ATTEMPTS:
+                    # The rate limiter has paused the chat (deferred above when it
+                    # comes round again) or, for a bot-wide flood, every send
+                    if isinstance(e, RetryAfter):
+                        delay = 0 if self.chats.ready_in(chat_id) else e.retry_after
+                    else:
+                        logger.warning(f"Network error sending message to {chat_id}: {e}")
+                        delay = 2 ** attempt
+                    loop.call_later(delay, self._requeue, (priority, seq, chat_id, text, reply_markup, future, attempt + 1))
+                    continue
+                logger.warning(f"Giving up on message to {chat_id} after {SEND_MAX_ATTEMPTS} attempts: {e}")
+                outcome = 'failed'
+            except Exception as e:
+                logger.error(f"Failed to send message to {chat_id}: {e}")
+                outcome = 'failed'
+            self.queue.task_done()
+            if not future.done():
+                future.set_result(outcome)
+
+    # One delivery attempt; RetryAfter and network errors are raised for the worker to re-queue
+    async def _deliver(self, chat_id: int, text: str, reply_markup, priority: int):
+        try:
+            await self.bot.send_message(chat_id, text, reply_markup=reply_markup, rate_limit_args=priority)
+            return 'delivered'
+        except Forbidden:
+            return 'blocked'
+        except BadRequest as e:
+            logger.warning(f"Failed to send message to {chat_id}: {e}")
+            return 'failed'
+        except (RetryAfter, NetworkError):
+            raise
+        except TelegramError as e:
+            logger.warning(f"Failed to send message to {chat_id}: {e}")
+            return 'failed'
+
+outbox = Outbox(OUTBOX_WORKERS)
+
+# The worker processes, reached over their unix sockets. Work that must happen
+# once per bot (admin digests, broadcasts) is handed to worker 0; a single process
+# (no sockets) owns everything itself.
+class WorkerPeers:
+    def __init__(self):
+        self.index = 0
+        self.sockets = []
+        self.sessions = {}
+        self.tasks = set()
+
+    def configure(self, index: int, sockets: list):
+        self.index = index
+        self.sockets = sockets
+
+    def owns(self, index: int) -> bool:
+        return not self.sockets or index == self.index
+
+    # POST a JSON payload to another worker in the background
+    def send(self, index: int, path: str, payload: dict):
+        task = asyncio.create_task(self._post(index, path, payload))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _post(self, index: int, path: str, payload: dict):
+        session = self.sessions.get(index)
+        if session is None:
+            session = self.sessions[index] = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.sockets[index]))
+        try:
+            async with session.post(f'http://worker{path}', json=payload) as response:
+                if response.status != 200:
+                    logger.warning(f"Worker {index} answered {response.status} to {path}")
+        except aiohttp.ClientError as e:
+            logger.warning(f"Failed to reach worker {index} at {path}: {e}")
+
+    # Set every worker's share of the send budget for a broadcast starting or ending,
+    # lowering shares before raising them so the total stays within the limit
+    async def lend_rate(self, broadcasting: bool):
+        if not self.sockets:
+            return
+        others = [index for index in range(len(self.sockets)) if index != self.index]
+        if not broadcasting:
+            telegram_rate_limiter.set_rate(worker_rate(self.index, len(self.sockets), broadcasting))
+        await asyncio.gather(*(self._post(index, '/internal/rate', {'broadcasting': broadcasting}) for index in others))
+        if broadcasting:
+            telegram_rate_limiter.set_rate(worker_rate(self.index, len(self.sockets), broadcasting))
+
+    async def close(self):
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+peers = WorkerPeers()
+
+# A worker's share of Telegram's global limit. Broadcasts run in worker 0, which is
+# lent most of the other workers' budget meanwhile; the shares always add up to the limit.
+def worker_rate(index: int, workers: int, broadcasting: bool) -> float:
+    if not broadcasting:
+        return TELEGRAM_RATE_LIMIT / workers
+    interactive = TELEGRAM_RATE_LIMIT * (1 - BROADCAST_RATE_SHARE) / workers
+    return interactive + (TELEGRAM_RATE_LIMIT * BROADCAST_RATE_SHARE if index == 0 else 0)
+
+# Admin notifications collected over a window and sent as one summary per admin.
+# Urgent events (and every event when the window is 0) are sent straight away.
+class AdminDigest:
+    KINDS = {
+        'task': ("📋 New task submissions", 'admin_task_requests', "📋 Review Submissions"),
+        'withdrawal': ("💸 New withdrawal requests", 'admin_withdraw_requests', "💸 Withdrawal Requests"),
+    }
+
+    def __init__(self, window: float):
+        self.window = window
+        self.counts = {}
+        self.amounts = {}
+        self.previews = {}
+        self.flush_task = None
+
+    def notify(self, kind: str, preview: str, text: str, reply_markup=None, amount: int = 0, urgent: bool = False):
+        # Worker 0 collects every worker's events, so admins get one digest per window
+        if not peers.owns(0):
+            peers.send(0, '/internal/digest', {
+                'kind': kind, 'preview': preview, 'text': text, 'amount': amount, 'urgent': urgent,
+                'reply_markup': reply_markup.to_dict() if reply_markup else None,
+            })
+            return
+        if urgent or not self.window:
+            for admin_id in ADMIN_IDS:
+                outbox.send(admin_id, text, reply_markup)
+            return
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.amounts[kind] = self.amounts.get(kind, 0) + amount
+        previews = self.previews.setdefault(kind, [])
+        if len(previews) < ADMIN_DIGEST_PREVIEWS:
+            previews.append(preview)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        counts, amounts, previews = self.counts, self.amounts, self.previews
+        self.counts, self.amounts, self.previews = {}, {}, {}
+        if not counts:
+            return
+        message = f"🔔 Admin digest for the last {self.window:g}s:\n"
+        keyboard = []
+        for kind, (title, route, button_text) in self.KINDS.items():
+            count = counts.get(kind)
+            if not count:
+                continue
+            message += f"\n{title}: {count}" + (f" ({amounts[kind]} Rs)" if amounts[kind] else "") + "\n"
+            for preview in previews[kind]:
+                message += f"• {preview}\n"
+            if count > len(previews[kind]):
+                message += f"...and {count - len(previews[kind])} more.\n"
+            keyboard.append([InlineKeyboardButton(f"{button_text} 👉", callback_data=route)])
+        message += "\nTake action below! 👇"
+        for admin_id in ADMIN_IDS:
+            outbox.send(admin_id, message, InlineKeyboardMarkup(keyboard))
+
+admin_digest = AdminDigest(ADMIN_DIGEST_SECONDS)
+
+# Send a broadcast to every user, checkpointing progress so it resumes after a restart
+async def run_broadcast(broadcast_id: int):
+    if broadcast_id in active_broadcasts:
+        return
+    active_broadcasts.add(broadcast_id)
+    try:
+        if len(active_broadcasts) == 1:
+            await peers.lend_rate(True)
+        _, admin_id, text, status, last_user_id, *_ = await get_broadcast(broadcast_id)
+        if status != 'running':
+            return
+        while True:
+            user_ids = await get_user_ids_after(last_user_id, BROADCAST_BATCH_SIZE)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(outbox.send(user_id, text, priority=PRIORITY_BROADCAST) for user_id in user_ids))
+            last_user_id = user_ids[-1]
+            await record_broadcast_progress(
+                broadcast_id, last_user_id,
+                results.count('delivered'), results.count('failed'), results.count('blocked')
+            )
+        await finish_broadcast(broadcast_id)
+        _, _, _, _, _, delivered, failed, blocked = await get_broadcast(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} finished: {delivered} delivered, {failed} failed, {blocked} blocked")
+        outbox.send(
+            admin_id,
+            f"📢 Broadcast #{broadcast_id} finished!\n"
+            f"✅ Delivered: {delivered}\n"
+            f"❌ Failed: {failed}\n"
+            f"🚫 Blocked the bot: {blocked}"
+        )
+    except Exception as e:
+        logger.error(f"Broadcast {broadcast_id} stopped: {e}")
+    finally:
+        active_broadcasts.discard(broadcast_id)
+        if not active_broadcasts:
+            await peers.lend_rate(False)
+
+# Broadcasts run in worker 0, so they share one send budget and never overlap
+def start_broadcast(application, broadcast_id: int):
+    if peers.owns(0):
+        application.create_task(run_broadcast(broadcast_id))
+    else:
+        peers.send(0, '/internal/broadcast', {'broadcast_id': broadcast_id})
+
+# Tell every user in a payout batch that their withdrawal was approved
+async def notify_payout_batch(batch_id: int):
+    after_withdrawal_id = 0
+
+    def notify(withdrawal_id, user_id, amount, upi_id):
+        return outbox.send(
+            user_id,
+            f"🎉 Your withdrawal request (ID: {withdrawal_id}) of {amount} Rs to {upi_id} has been approved! 🎊 Funds are on their way! 🚀"
+        )
+
+    try:
+        while True:
+            page = await get_payout_batch_page(batch_id, after_withdrawal_id, BROADCAST_BATCH_SIZE)
+            if not page:
+                break
+            await asyncio.gather(*(notify(*row) for row in page))
+            after_withdrawal_id = page[-1][0]
+        logger.info(f"Payout batch {batch_id} notifications sent")
+    except Exception as e:
+        logger.error(f"Payout batch {batch_id} notifications stopped: {e}")
+
+# Send a payout batch's CSV to an admin, returns whether it was sent
+async def export_payout_batch(context: ContextTypes.DEFAULT_TYPE, admin_id: int, batch_id: int, count: int, total: int):
+    try:
+        fd, path = tempfile.mkstemp(prefix=f'payout_batch_{batch_id}_', suffix='.csv')
+        os.close(fd)
+        try:
+            await write_payout_csv(batch_id, path)
+            with open(path, 'rb') as f:
+                await context.bot.send_document(
+                    admin_id, f, filename=f'payout_batch_{batch_id}.csv',
+                    caption=f"📤 Payout batch #{batch_id}: {count} withdrawals, {total} Rs total."
+                )
+        finally:
+            os.remove(path)
+    except (TelegramError, OSError, *db.errors) as e:
+        logger.error(f"Payout batch {batch_id} export failed: {e}")
+        return False
+    return True
+
+# Approve pending withdrawals in bulk, queue user notifications and send the payout file.
+# Returns (batch_id, count, total, exported); the batch stands even if the export failed.
+async def process_payout_batch(context: ContextTypes.DEFAULT_TYPE, admin_id: int, limit: int, key: str):
+    result = await approve_pending_withdrawals(admin_id, limit, key)
+    if not result or result is DUPLICATE:
+        return result
+    batch_id, count, total = result
+    context.application.create_task(notify_payout_batch(batch_id))
+    return batch_id, count, total, await export_payout_batch(context, admin_id, batch_id, count, total)
+
+# Payout file of a batch that failed to export the first time
+PAYOUT_EXPORT_FAILED_TEXT = "⚠️ The payout file couldn't be sent. Re-export it with /exportbatch {batch_id}."
+
+# Bulk approve command (admin only)
+async def approve_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        limit = int(context.args[0]) if context.args else PAYOUT_BATCH_LIMIT
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("💡 Usage: /approveall [max_withdrawals]")
+        return
+    # A redelivered command message approves nothing more
+    message = update.message
+    result = await process_payout_batch(context, update.effective_user.id, limit, f'{message.chat_id}:{message.message_id}')
+    if result is DUPLICATE:
+        return
+    if not result:
+        await message.reply_text("🚫 No pending withdrawal requests.")
+        return
+    batch_id, count, total, exported = result
+    text = f"✅ Payout batch #{batch_id}: approved {count} withdrawals ({total} Rs). Users are being notified! 🚀"
+    if not exported:
+        text += "\n" + PAYOUT_EXPORT_FAILED_TEXT.format(batch_id=batch_id)
+    await message.reply_text(text)
+
+# Re-export a payout batch's CSV (admin only)
+async def export_batch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        batch = await get_payout_batch(int(context.args[0]))
+    except (IndexError, ValueError):
+        await update.message.reply_text("💡 Usage: /exportbatch <batch_id>")
+        return
+    if not batch:
+        await update.message.reply_text("🚫 Payout batch not found.")
+        return
+    if not await export_payout_batch(context, update.effective_user.id, *batch):
+        await update.message.reply_text(PAYOUT_EXPORT_FAILED_TEXT.format(batch_id=batch[0]))
+
 # Add announcement command (admin only)
 async def announcement_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -1145,18 +3559,18 @@ async def announcement_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = ' '.join(context.args)
         if not message:
             raise ValueError
-        add_announcement(message)
-        user_ids = get_all_users()
+        announcement_id = await add_announcement(message)
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        for user_id in user_ids:
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    f"📢 Big Update!\n{message}\n📅 Posted: {current_time}\nStay tuned for more! 🚀"
-                )
-            except TelegramError:
-                logger.warning(f"Failed to send announcement to user {user_id}")
-        await update.message.reply_text("🎉 Announcement posted and sent to all users! 🚀")
+        broadcast_id = await create_broadcast(
+            update.effective_user.id,
+            announcement_id,
+            f"📢 Big Update!\n{message}\n📅 Posted: {current_time}\nStay tuned for more! 🚀"
+        )
+        start_broadcast(context.application, broadcast_id)
+        user_count = await get_user_count()
+        await update.message.reply_text(
+            f"🎉 Announcement posted! Sending it to {user_count} users now — you'll get a delivery report when it's done! 🚀"
+        )
     except ValueError:
         await update.message.reply_text("💡 Usage: /announcement <message>")
 
@@ -1166,7 +3580,7 @@ async def delete_announcement_cmd(update: Update, context: ContextTypes.DEFAULT_
         return
     try:
         announcement_id = int(context.args[0])
-        delete_announcement(announcement_id)
+        await delete_announcement(announcement_id)
         await update.message.reply_text(f"✅ Announcement {announcement_id} deleted successfully!")
     except (IndexError, ValueError):
         await update.message.reply_text("💡 Usage: /deleteannouncement <announcement_id>")
@@ -1178,7 +3592,7 @@ async def remove_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        if remove_balance(user_id, amount):
+        if await remove_balance(user_id, amount):
             await update.message.reply_text(f"✅ {amount} points deducted from user {user_id}'s balance.")
         else:
             await update.message.reply_text(f"⚠️ Failed: User {user_id} has insufficient balance.")
@@ -1188,50 +3602,57 @@ async def remove_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # Complete task response and UPI ID handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
-    
+
     # Admin-specific handling
     if user_id in ADMIN_IDS:
         await update.message.reply_text(
-            "⚙️ Admin Panel: Use /add_task, /remove_task, /setbalance, /removebalance, /announcement, or /deleteannouncement to manage the bot! 👇",
-            reply_markup=admin_menu()
+            "⚙️ Admin Panel: Use /add_task, /remove_task, /setbalance, /removebalance, /user, /finduser, /referrals, /reconcile, /approveall, /exportbatch, /announcement, or /deleteannouncement to manage the bot! 👇",
+            reply_markup=ADMIN_MENU
         )
         return
 
+    # Messages over the user's budget aren't processed; the user is told so at
+    # most once per notice budget, so a flood of messages doesn't become a flood of replies
+    if not user_throttle.allow(user_id, 'cheap'):
+        USER_THROTTLED.inc('message')
+        if user_throttle.allow(user_id, 'notice'):
+            await update.message.reply_text(MESSAGE_THROTTLED_TEXT)
+        return
+    user = await get_user(user_id)
+
     # Non-admins require channel join
     if not user or not user[2]:
         await update.message.reply_text(
-            f"🚀 Join {CHANNEL_ID} to unlock exciting rewards! Click below to join now! 🎉",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📢 Join Channel Now", url=f"https://t.me/{CHANNEL_ID[1:]}")]])
+            JOIN_CHANNEL_TEXT,
+            reply_markup=JOIN_CHANNEL
         )
         return
 
     # Handle task response
     if 'awaiting_response' in context.user_data:
         task_id = context.user_data['awaiting_response']
-        tasks = get_tasks()
-        task = next((t for t in tasks if t[0] == task_id), None)
+        task = await task_catalog.get(task_id)
         if not task:
             await update.message.reply_text(
                 "🚫 Task not found. Try another one! 📝",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+                reply_markup=BACK_TO_MENU
             )
             del context.user_data['awaiting_response']
             return
 
         response = update.message.text
-        save_task_response(user_id, task_id, response)
-        mark_task_pending(user_id, task_id)
+        await save_task_response(user_id, task_id, response)
+        await mark_task_pending(user_id, task_id)
         task_title, task_desc, task_price, task_question = task[1], task[2], task[3], task[4]
-        for admin_id in ADMIN_IDS:
-            await context.bot.send_message(
-                admin_id,
-                f"📋 New Task Submission:\nUser: @{user[1]} (ID: {user_id})\nTask {task_id}: {task_title} ({task_price} points) 💸\nQuestion: {task_question}\nResponse: {response}\nTake action below! 👇",
-                reply_markup=task_action_buttons(user_id, task_id)
-            )
+        admin_digest.notify(
+            'task',
+            f"@{user[1]}: Task {task_id}: {task_title}",
+            f"📋 New Task Submission:\nUser: @{user[1]} (ID: {user_id})\nTask {task_id}: {task_title} ({task_price} points) 💸\nQuestion: {task_question}\nResponse: {response}\nTake action below! 👇",
+            task_action_buttons(user_id, task_id),
+        )
         await update.message.reply_text(
             f"🎉 Your submission for Task {task_id}: {task_title} has been sent for review! We'll notify you once it's approved! 🚀",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+            reply_markup=BACK_TO_MENU
         )
         del context.user_data['awaiting_response']
         return
@@ -1242,13 +3663,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not upi_id:
             await update.message.reply_text(
                 "⚠️ Invalid UPI ID! Please provide a valid UPI ID to cash out. 💳",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Menu", callback_data='back')]])
+                reply_markup=BACK_TO_MENU
             )
             return
-        set_upi_id(user_id, upi_id)
+        await set_upi_id(user_id, upi_id)
         await update.message.reply_text(
             f"🎉 UPI ID set to {upi_id}! You're ready to cash out your earnings! 💸 Choose an option below:",
-            reply_markup=withdraw_menu(upi_id)
+            reply_markup=withdraw_menu(upi_id, await get_latest_withdrawal_id(user_id))
         )
         del context.user_data['awaiting_upi_id']
 
@@ -1259,22 +3680,127 @@ async def set_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        c.execute('UPDATE users SET balance = ? WHERE user_id = ?', (amount, user_id))
-        conn.commit()
-        conn.close()
-        await update.message.reply_text(f"✅ Balance updated for user {user_id} to {amount} points! 💰")
+        if await set_balance_amount(user_id, amount):
+            await update.message.reply_text(f"✅ Balance updated for user {user_id} to {amount} points! 💰")
+        else:
+            await update.message.reply_text(f"🚫 User {user_id} not found.")
     except (IndexError, ValueError):
         await update.message.reply_text("💡 Usage: /setbalance <user_id> <amount>")
 
+# Reconcile cached balances against the ledger (admin only)
+async def reconcile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    started = time.monotonic()
+    checked, fixes = await reconcile_balances()
+    message = f"🧮 Reconciled {checked} balances against the ledger in {time.monotonic() - started:.2f}s.\n"
+    if not fixes:
+        message += "✅ Every balance matches the ledger."
+    else:
+        message += f"⚠️ Fixed {len(fixes)} drifted balances:\n"
+        for expected, user_id, balance in fixes[:20]:
+            message += f"User {user_id}: {balance} → {expected} points\n"
+        if len(fixes) > 20:
+            message += f"...and {len(fixes) - 20} more."
+        logger.warning(f"Reconciliation fixed {len(fixes)} balances")
+    await update.message.reply_text(message)
+
+# Referral analytics (admin only): a user's downline per level, or the largest downlines
+async def referrals_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not context.args:
+        top = await get_top_downlines(REFERRAL_TOP_SIZE)
+        rings = await get_referral_rings(REFERRAL_TOP_SIZE)
+        if not top and not rings:
+            await update.message.reply_text("🚫 Nobody has referred anyone yet.")
+            return
+        message = f"🌳 Largest Downlines (up to {REFERRAL_LEVELS} levels):\n"
+        for i, (uid, username, downline_size) in enumerate(top, 1):
+            message += f"{i}. @{username} (ID: {uid}): {downline_size} users\n"
+        if rings:
+            message += "\n🔁 Referral Rings (users referred back by their own downline):\n"
+            for uid, username, length in rings:
+                message += f"@{username} (ID: {uid}): ring of {length}\n"
+            ring_count = await get_referral_ring_count()
+            if ring_count > len(rings):
+                message += f"...and {ring_count - len(rings)} more.\n"
+        message += "\n💡 /referrals <user_id> shows one user's levels."
+        await update.message.reply_text(message)
+        return
+    try:
+        user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("💡 Usage: /referrals [user_id]")
+        return
+    levels = await get_referral_levels(user_id)
+    if not levels:
+        await update.message.reply_text(f"🚫 User {user_id} has no referrals.")
+        return
+    message = (
+        f"🌳 Downline of user {user_id}\n"
+        f"👥 Size: {sum(members for _, members, _ in levels)} users\n"
+        f"📏 Depth: {levels[-1][0]} levels\n"
+    )
+    for depth, members, earnings in levels:
+        message += f"  Level {depth}: {members} users, {earnings} points earned\n"
+    await update.message.reply_text(message)
+
+# User detail command (admin only)
+async def user_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        details = await get_user_details(int(context.args[0]))
+    except (IndexError, ValueError):
+        await update.message.reply_text("💡 Usage: /user <user_id>")
+        return
+    if not details:
+        await update.message.reply_text("🚫 User not found.")
+        return
+    (uid, username, joined_channel, balance, referrer_id, upi_id, joined_at), referrals, withdrawals = details
+    message = (
+        f"👤 User {uid} (@{username})\n"
+        f"📅 Joined: {joined_at}\n"
+        f"📢 Channel member: {'Yes' if joined_channel else 'No'}\n"
+        f"💰 Balance: {balance} points\n"
+        f"💳 UPI ID: {upi_id if upi_id else 'Not set'}\n"
+        f"🤝 Referred by: {referrer_id if referrer_id else 'Nobody'}\n"
+        f"👥 Referrals: {referrals}\n"
+    )
+    if withdrawals:
+        message += "💸 Withdrawals:\n"
+        for status, count, total in withdrawals:
+            message += f"  {status.capitalize()}: {count} ({total} Rs)\n"
+    else:
+        message += "💸 Withdrawals: None\n"
+    await update.message.reply_text(message)
+
+# Find users by username prefix (admin only)
+async def find_user_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    prefix = context.args[0].lstrip('@') if context.args else ''
+    if not prefix:
+        await update.message.reply_text("💡 Usage: /finduser <username prefix>")
+        return
+    users = await search_users(prefix)
+    if not users:
+        await update.message.reply_text(f"🚫 No users found starting with @{prefix}.")
+        return
+    message = f"🔍 Users starting with @{prefix}:\n"
+    for uid, username, balance in users:
+        message += f"ID: {uid}, @{username}, Balance: {balance} points 💰\n"
+    message += "\n💡 User details: /user <user_id>"
+    await update.message.reply_text(message)
+
 # Remove task command (admin only)
 async def remove_task_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
     try:
         task_id = int(context.args[0])
-        remove_task(task_id)
+        await remove_task(task_id)
         await update.message.reply_text(f"✅ Task {task_id} removed successfully! 🚀")
     except (IndexError, ValueError):
         await update.message.reply_text("💡 Usage: /remove_task <task_id>")
@@ -1285,7 +3811,7 @@ async def delete_announcement_cmd(update: Update, context: ContextTypes.DEFAULT_
         return
     try:
         announcement_id = int(context.args[0])
-        delete_announcement(announcement_id)
+        await delete_announcement(announcement_id)
         await update.message.reply_text(f"✅ Announcement {announcement_id} deleted successfully! 🚀")
     except (IndexError, ValueError):
         await update.message.reply_text("💡 Usage: /deleteannouncement <announcement_id>")
@@ -1297,7 +3823,7 @@ async def remove_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        if remove_balance(user_id, amount):
+        if await remove_balance(user_id, amount):
             await update.message.reply_text(f"✅ {amount} points deducted from user {user_id}'s balance! 💰")
         else:
             await update.message.reply_text(f"⚠️ Failed: User {user_id} has insufficient balance.")
@@ -1308,53 +3834,528 @@ async def remove_balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
 
-# Webhook handler
+# user_data/bot_data stored in SQLite. PTB hands us changed entries every
+# update_interval; they are buffered and written in a single transaction per
+# round (and at shutdown), skipping entries whose contents didn't change.
+# A worker process (index of workers) only loads and writes its own users'
+# user_data, and bot_data belongs to worker 0.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, index: int = 0, workers: int = 1, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=index == 0, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.index = index
+        self.workers = workers
+        self.stored = {}  # (kind, key) -> json of every non-empty entry written (or being written)
+        self.dirty = {}  # (kind, key) -> json waiting for the next flush
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+
+    async def _load(self, kind: str, workers: int = 1, index: int = 0):
+        rows = await get_conversation_state(kind, workers, index)
+        for key, data in rows.items():
+            self.stored[(kind, key)] = data
+        return {key: json.loads(data) for key, data in rows.items()}
+
+    def _mark(self, kind: str, key: int, data):
+        encoded = json.dumps(data, sort_keys=True) if data else None
+        if (kind, key) not in self.dirty and self.stored.get((kind, key)) == encoded:
+            return
+        self.dirty[(kind, key)] = encoded
+        # PTB gathers all update_* calls of a round; a task created now runs
+        # after all of them, so one flush covers the whole round
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def get_user_data(self):
+        return await self._load('user', self.workers, self.index)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return (await self._load('bot')).get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        if worker_index(user_id, self.workers) == self.index:
+            self._mark('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        self._mark('bot', 0, data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        if worker_index(user_id, self.workers) == self.index:
+            self._mark('user', user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        async with self.flush_lock:
+            self.flush_task = None
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            upserts = []
+            deletes = []
+            for (kind, key), data in dirty.items():
+                if data is None:
+                    deletes.append((kind, key))
+                    self.stored.pop((kind, key), None)
+                else:
+                    upserts.append((kind, key, data))
+                    self.stored[(kind, key)] = data
+            try:
+                await save_conversation_state(upserts, deletes)
+            except Exception as e:
+                # Keep the entries dirty so the next round writes them again
+                logger.error(f"Failed to persist conversation state: {e}")
+                dirty.update(self.dirty)
+                self.dirty = dirty
+
+# Wrap a handler callback so its latency and errors are recorded under name
+def observed(name: str, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+# Bot API transport recording per-method latency, status codes and flood waits
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, api_method)
+            TELEGRAM_API_RESPONSES.inc(api_method, str(status))
+            if status == 429:
+                TELEGRAM_FLOOD_WAITS.inc(api_method)
+
+# Find the user an incoming update belongs to, without decoding the whole update.
+# A chat_member update is about the member, whoever (an admin, an invite link) made the change.
+def update_user_id(data: dict) -> int:
+    for key, value in data.items():
+        if key != 'update_id' and isinstance(value, dict):
+            member = value.get('new_chat_member')
+            if isinstance(member, dict) and isinstance(member.get('user'), dict):
+                return member['user'].get('id', 0)
+            sender = value.get('from') or value.get('user') or value.get('chat') or {}
+            return sender.get('id', 0)
+    return 0
+
+# Bounded update queue drained by workers sharded by user_id:
+# one user's updates are processed in order, different users in parallel
+class UpdateDispatcher:
+    def __init__(self, application, workers: int, queue_size: int, seen_size: int = 10000):
+        self.application = application
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.seen_size = seen_size
+        self.in_flight = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+        self._seen = OrderedDict()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # Queue a raw update; returns False if the queue stayed full
+    async def submit(self, data: dict) -> bool:
+        update_id = data['update_id']
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[update_id] = None
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+        # This process only sees users with the same user_id % WEBHOOK_WORKERS, spread them by the rest
+        shard = self.queues[(update_user_id(data) // WEBHOOK_WORKERS) % len(self.queues)]
+        try:
+            await asyncio.wait_for(shard.put((time.monotonic(), data)), UPDATE_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Forget it so Telegram's redelivery isn't dropped as a duplicate
+            self._seen.pop(update_id, None)
+            self.rejected += 1
+            return False
+        return True
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            enqueued_at, data = await q.get()
+            self.last_lag = time.monotonic() - enqueued_at
+            self.in_flight += 1
+            try:
+                update = Update.de_json(data, self.application.bot)
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Failed to process update {data.get('update_id')}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+                q.task_done()
+
+    def stats(self):
+        return {
+            'depth': sum(q.qsize() for q in self.queues),
+            'capacity': sum(q.maxsize for q in self.queues),
+            'in_flight': self.in_flight,
+            'lag_seconds': round(self.last_lag, 3),
+            'processed': self.processed,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+        }
+
+# Webhook handler: validate, enqueue and ack straight away
 async def webhook(request):
-    app = request.app['telegram_app']
-    update = Update.de_json(await request.json(), app.bot)
-    await app.process_update(update)
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        return web.Response(status=400)
+    if not await request.app['dispatcher'].submit(data):
+        return web.Response(status=503)
     return web.Response()
 
-async def main():
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+# Update queue stats
+async def queue_status(request):
+    return web.json_response(request.app['dispatcher'].stats())
+
+# Worker-to-worker calls, only served on a worker's unix socket
+async def internal_digest(request):
+    data = await request.json()
+    reply_markup = data.pop('reply_markup')
+    if reply_markup:
+        reply_markup = InlineKeyboardMarkup.de_json(reply_markup, request.app['telegram_app'].bot)
+    admin_digest.notify(reply_markup=reply_markup, **data)
+    return web.Response()
+
+async def internal_broadcast(request):
+    data = await request.json()
+    start_broadcast(request.app['telegram_app'], data['broadcast_id'])
+    return web.Response()
+
+async def internal_rate(request):
+    data = await request.json()
+    telegram_rate_limiter.set_rate(worker_rate(peers.index, len(peers.sockets), data['broadcasting']))
+    return web.Response()
+
+# Prometheus metrics
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
-    # Initialize the application
+# Run the bot. worker is None for a single process serving Telegram directly, or
+# (index, sockets) for a worker process behind the front process.
+async def run_bot(worker: tuple = None):
+    index, sockets = worker or (0, [])
+    workers = len(sockets) or 1
+    peers.configure(index, sockets)
+    await db.start()
+    if worker is None:
+        await init_db()
+    await leaderboard.load()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .persistence(SQLitePersistence(index, workers))
+        .rate_limiter(OutboundRateLimiter(telegram_rate_limiter, chat_rate_limits))
+        .build()
+    )
+
+    # Initialize the application and start its background tasks (persistence flushes, jobs)
     await application.initialize()
+    await application.start()
+    outbox.start(application.bot, chat_rate_limits)
+
+    # Resume broadcasts interrupted by a restart (in one worker only)
+    for broadcast_id in await get_running_broadcasts() if index == 0 else ():
+        logger.info(f"Resuming broadcast {broadcast_id}")
+        application.create_task(run_broadcast(broadcast_id))
 
     # Handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(CommandHandler("add_task", add_task_cmd))
-    application.add_handler(CommandHandler("announcement", announcement_cmd))
-    application.add_handler(CommandHandler("deleteannouncement", delete_announcement_cmd))
-    application.add_handler(CommandHandler("setbalance", set_balance))
-    application.add_handler(CommandHandler("remove_task", remove_task_cmd))
-    application.add_handler(CommandHandler("removebalance", remove_balance_cmd))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("start", observed("start", start)))
+    application.add_handler(CallbackQueryHandler(observed('callback', router.dispatch)))
+    application.add_handler(CommandHandler("add_task", observed("add_task", add_task_cmd)))
+    application.add_handler(CommandHandler("announcement", observed("announcement", announcement_cmd)))
+    application.add_handler(CommandHandler("deleteannouncement", observed("deleteannouncement", delete_announcement_cmd)))
+    application.add_handler(CommandHandler("setbalance", observed("setbalance", set_balance)))
+    application.add_handler(CommandHandler("remove_task", observed("remove_task", remove_task_cmd)))
+    application.add_handler(CommandHandler("removebalance", observed("removebalance", remove_balance_cmd)))
+    application.add_handler(CommandHandler("user", observed("user", user_cmd)))
+    application.add_handler(CommandHandler("finduser", observed("finduser", find_user_cmd)))
+    application.add_handler(CommandHandler("referrals", observed("referrals", referrals_cmd)))
+    application.add_handler(CommandHandler("reconcile", observed("reconcile", reconcile_cmd)))
+    application.add_handler(CommandHandler("approveall", observed("approveall", approve_all_cmd)))
+    application.add_handler(CommandHandler("exportbatch", observed("exportbatch", export_batch_cmd)))
+    application.add_handler(ChatMemberHandler(observed('chat_member', channel_member_update), ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, observed('message', handle_message)))
     application.add_error_handler(error_handler)
+    application.job_queue.run_repeating(
+        recheck_memberships, MEMBERSHIP_RECHECK_INTERVAL, first=MEMBERSHIP_RECHECK_INTERVAL, data=(workers, index)
+    )
+    if index == 0:
+        application.job_queue.run_repeating(expire_idempotency_keys, IDEMPOTENCY_PRUNE_INTERVAL, first=IDEMPOTENCY_PRUNE_INTERVAL)
 
-    # Set up webhook
-    if not WEBHOOK_URL:
-        logger.error("WEBHOOK_URL environment variable not set")
-        return
-    await application.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook")
-    logger.info(f"Webhook set to {WEBHOOK_URL}/webhook")
+    # Set up webhook (the front process does it for its workers)
+    if worker is None:
+        if not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL environment variable not set")
+            return
+        await set_webhook(application.bot)
+
+    # Start update workers
+    dispatcher = UpdateDispatcher(application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    dispatcher.start()
 
     # Set up web server
     web_app = web.Application()
     web_app['telegram_app'] = application
+    web_app['dispatcher'] = dispatcher
     web_app.router.add_post('/webhook', webhook)
-    
+    web_app.router.add_get('/queue', queue_status)
+    web_app.router.add_get('/metrics', metrics_endpoint)
+    if worker is not None:
+        web_app.router.add_post('/internal/digest', internal_digest)
+        web_app.router.add_post('/internal/broadcast', internal_broadcast)
+        web_app.router.add_post('/internal/rate', internal_rate)
+    metrics.gauge('bot_updates_in_flight', 'Updates being processed', lambda: dispatcher.in_flight)
+    metrics.gauge('bot_update_queue_depth', 'Updates waiting in the dispatcher queue', lambda: dispatcher.stats()['depth'])
+    metrics.gauge('bot_updates_processed_total', 'Updates processed', lambda: dispatcher.processed, 'counter')
+    metrics.gauge('bot_updates_rejected_total', 'Updates rejected because the queue was full', lambda: dispatcher.rejected, 'counter')
+    metrics.gauge('bot_outbox_queue_depth', 'Outbound messages waiting to be sent', lambda: outbox.queue.qsize())
+    metrics.gauge('bot_rate_limiter_waiting', 'Bot API calls waiting for a rate limiter token', lambda: telegram_rate_limiter.waiting())
+    metrics.gauge('bot_job_queue_jobs', 'Jobs scheduled in the job queue', lambda: len(application.job_queue.jobs()))
+
     # Start web server
     runner = web.AppRunner(web_app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
-    await site.start()
-    logger.info(f"Web server started on port {PORT}")
+    if worker is None:
+        site = web.TCPSite(runner, '0.0.0.0', PORT)
+        await site.start()
+        logger.info(f"Web server started on port {PORT}")
+    else:
+        site = web.UnixSite(runner, sockets[index])
+        await site.start()
+        logger.info(f"Worker {index} listening on {sockets[index]}")
 
     # Keep the application running
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dispatcher.stop()
+        admin_digest.flush()
+        await peers.close()
+        await outbox.stop()
+        await application.stop()
+        await application.shutdown()
+        await db.close()
+        await runner.cleanup()
+
+async def set_webhook(bot):
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL}/webhook",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER],
+    )
+    logger.info(f"Webhook set to {WEBHOOK_URL}/webhook")
+
+# Worker process that owns a user's updates and user_data. Plain modulo so the
+# persistence query can select the same users in SQL.
+def worker_index(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+# Entry point of a worker process. The front process stops workers with SIGTERM,
+# Ctrl+C is left to the front so workers don't shut down before it stops forwarding.
+def run_worker(index: int, sockets: list):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Telegram's global limit is per bot, so the workers split it
+    telegram_rate_limiter.set_rate(worker_rate(index, len(sockets), False))
+    try:
+        asyncio.run(_serve_worker(index, sockets))
+    except asyncio.CancelledError:
+        pass
+
+async def _serve_worker(index: int, sockets: list):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await run_bot((index, sockets))
+
+# Worker processes behind the front process, each serving the webhook on a unix socket
+class WorkerPool:
+    def __init__(self, workers: int, socket_dir: str):
+        self.sockets = [os.path.join(socket_dir, f'bot-{os.getpid()}-worker-{i}.sock') for i in range(workers)]
+        self.processes = []
+        self.sessions = []
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        for index in range(len(self.sockets)):
+            process = context.Process(target=run_worker, args=(index, self.sockets), name=f'bot-worker-{index}')
+            process.start()
+            self.processes.append(process)
+        self.sessions = [aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=path)) for path in self.sockets]
+
+    # Wait until every worker answers on its socket
+    async def wait_ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        for index, session in enumerate(self.sessions):
+            while True:
+                if not self.processes[index].is_alive():
+                    raise RuntimeError(f"Worker {index} exited with code {self.processes[index].exitcode}")
+                try:
+                    async with session.get('http://worker/queue') as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Worker {index} did not start within {timeout}s")
+                await asyncio.sleep(0.2)
+
+    # Hand a raw update to the worker owning its user, returns the HTTP status for Telegram
+    async def forward(self, user_id: int, body: bytes) -> int:
+        session = self.sessions[worker_index(user_id, len(self.sessions))]
+        headers = {'Content-Type': 'application/json'}
+        if WEBHOOK_SECRET:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = WEBHOOK_SECRET
+        try:
+            async with session.post('http://worker/webhook', data=body, headers=headers) as response:
+                return response.status
+        except aiohttp.ClientError as e:
+            logger.warning(f"Failed to forward an update to a worker: {e}")
+            return 503
+
+    async def get(self, index: int, path: str):
+        async with self.sessions[index].get(f'http://worker{path}') as response:
+            return response.status, await response.read()
+
+    # Stop the workers, giving them time to flush their state
+    async def stop(self, timeout: float = 30):
+        for session in self.sessions:
+            await session.close()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.kill()
+        for path in self.sockets:
+            if os.path.exists(path):
+                os.remove(path)
+
+# Front process webhook: validate, then forward to the worker owning the user
+async def front_webhook(request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    body = await request.read()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        return web.Response(status=400)
+    return web.Response(status=await request.app['pool'].forward(update_user_id(data), body))
+
+# Update queue stats of every worker
+async def front_queue_status(request):
+    pool = request.app['pool']
+    stats = []
+    for index in range(len(pool.sessions)):
+        _, body = await pool.get(index, '/queue')
+        stats.append(json.loads(body))
+    return web.json_response(stats)
+
+# Prometheus metrics of one worker, scrape /metrics/0 ... /metrics/N-1
+async def front_metrics(request):
+    pool = request.app['pool']
+    index = int(request.match_info['index'])
+    if index >= len(pool.sessions):
+        return web.Response(status=404)
+    status, body = await pool.get(index, '/metrics')
+    return web.Response(status=status, body=body, headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+# Front process: migrate the database, start the workers, set the webhook and forward updates
+async def run_front(workers: int):
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL environment variable not set")
+        return
+    await db.start()
+    await init_db()
+    await db.close()
+
+    pool = WorkerPool(workers, WORKER_SOCKET_DIR)
+    pool.start()
+    try:
+        await pool.wait_ready(WORKER_START_TIMEOUT)
+        bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL)
+        async with bot:
+            await set_webhook(bot)
+
+        web_app = web.Application()
+        web_app['pool'] = pool
+        web_app.router.add_post('/webhook', front_webhook)
+        web_app.router.add_get('/queue', front_queue_status)
+        web_app.router.add_get(r'/metrics/{index:\d+}', front_metrics)
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', PORT)
+        await site.start()
+        logger.info(f"Front process started on port {PORT} with {workers} workers")
+        await asyncio.Event().wait()
+    finally:
+        await pool.stop()
+
+async def main():
+    if WEBHOOK_WORKERS > 1:
+        await run_front(WEBHOOK_WORKERS)
+    else:
+        await run_bot()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,64 @@
+# Storage tests, run against every backend:
+#
+#   python -m pytest -q tests
+#   TEST_DATABASE_URL=postgresql://localhost/bot_test python -m pytest -q tests
+#
+# SQLite always runs on a fresh file. PostgreSQL runs when TEST_DATABASE_URL points
+# at a local server; each test gets its own schema, dropped afterwards.
+import asyncio
+import inspect
+import os
+import uuid
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+import telegram_bot  # noqa: E402
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def backend(request, tmp_path):
+    if request.param == 'postgres':
+        url = os.getenv('TEST_DATABASE_URL')
+        if not url:
+            pytest.skip('TEST_DATABASE_URL not set')
+        pytest.importorskip('asyncpg')
+        return 'postgres', url
+    return 'sqlite', str(tmp_path / 'bot.db')
+
+
+# Point telegram_bot.db at a started, migrated database for the duration of test
+async def _with_database(backend, test):
+    kind, target = backend
+    schema = None
+    if kind == 'postgres':
+        import asyncpg
+        schema = f'test_{uuid.uuid4().hex}'
+        admin = await asyncpg.connect(target)
+        await admin.execute(f'CREATE SCHEMA {schema}')
+        # asyncpg passes unknown DSN parameters on as server settings
+        database = telegram_bot.PostgresDatabase(f"{target}{'&' if '?' in target else '?'}search_path={schema}")
+    else:
+        database = telegram_bot.Database(target)
+    telegram_bot.db = database
+    await database.start()
+    try:
+        await database.migrate()
+        await telegram_bot.leaderboard.load()
+        await test
+    finally:
+        await database.close()
+        if schema:
+            await admin.execute(f'DROP SCHEMA {schema} CASCADE')
+            await admin.close()
+
+
+# async def tests run on their own event loop, with the database the backend fixture selected
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    funcargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(_with_database(pyfuncitem.funcargs['backend'], pyfuncitem.obj(**funcargs)))
+    return True
@@ -0,0 +1,17 @@
+import telegram_bot as bot
+
+
+def test_worker_rates_add_up_to_the_limit():
+    for broadcasting in (False, True):
+        shares = [bot.worker_rate(index, 8, broadcasting) for index in range(8)]
+        assert abs(sum(shares) - bot.TELEGRAM_RATE_LIMIT) < 1e-9
+    # Worker 0 broadcasts with most of the budget
+    assert bot.worker_rate(0, 8, True) > bot.TELEGRAM_RATE_LIMIT * bot.BROADCAST_RATE_SHARE
+    assert bot.worker_rate(0, 1, True) == bot.TELEGRAM_RATE_LIMIT
+
+
+def test_set_rate_caps_saved_tokens():
+    bucket = bot.TokenBucket(30)
+    bucket.set_rate(3.75)
+    assert (bucket.rate, bucket.capacity) == (3.75, 3.75)
+    assert bucket._tokens <= 3.75
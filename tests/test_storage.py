@@ -0,0 +1,230 @@
+import asyncio
+import csv
+import sqlite3
+
+import pytest
+from telegram.error import NetworkError
+
+import telegram_bot as bot
+
+
+async def test_save_user_sets_referrer_once(backend):
+    await bot.save_user(1, 'alice')
+    await bot.save_user(2, 'bob', 1)
+    await bot.save_user(2, 'bobby', 3)
+    assert await bot.get_user(2) == (2, 'bobby', 0, 0, 1, None)
+    # Self-referrals and unknown referrers are dropped
+    await bot.save_user(3, 'carol', 3)
+    await bot.save_user(4, 'dave', 999)
+    assert (await bot.get_user(3))[4] is None
+    assert (await bot.get_user(4))[4] is None
+    assert await bot.get_referrals(1) == [(2, 'bobby')]
+    assert await bot.get_user_count() == 4
+
+
+async def test_referral_index_tracks_levels_and_earnings(backend):
+    await bot.save_user(1, 'root')
+    await bot.save_user(2, 'child', 1)
+    await bot.save_user(3, 'grandchild', 2)
+    await bot.add_bonus(3, 10, 'task_reward')
+    assert await bot.get_referral_levels(1) == [(1, 1, 0), (2, 1, 10)]
+    assert await bot.get_referral_levels(2) == [(1, 1, 10)]
+    assert await bot.get_top_downlines(10) == [(1, 'root', 2), (2, 'child', 1)]
+
+
+def test_user_stats_backfill_matches_referrer_bonus(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'legacy.db', isolation_level=None)
+    bot.migrate(conn, target=3)
+    conn.executemany('INSERT INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)', [(1, 'r', None), (2, 'u', 1)])
+    conn.executemany(
+        "INSERT INTO tasks (task_id, title, description, payment_price, question) VALUES (?, 't', 'd', ?, 'q')",
+        [(1, 15), (2, 7)]
+    )
+    conn.executemany('INSERT INTO user_tasks (user_id, task_id, completed) VALUES (2, ?, 1)', [(1,), (2,)])
+    bot.migrate(conn, target=4)
+    expected = int(15 * bot.REFERRER_SHARE) + int(7 * bot.REFERRER_SHARE)
+    assert conn.execute('SELECT referral_earnings FROM user_stats WHERE user_id = 1').fetchone() == (expected,)
+    conn.close()
+
+
+async def test_ledger_keeps_balances_reconciled(backend):
+    await bot.save_user(1, 'alice')
+    await bot.add_bonus(1, 50)
+    assert await bot.deduct_balance(1, 20)
+    assert not await bot.deduct_balance(1, 100)
+    assert await bot.set_balance_amount(1, 45)
+    assert (await bot.get_user(1))[3] == 45
+    checked, fixes = await bot.reconcile_balances()
+    assert (checked, fixes) == (1, [])
+
+
+async def test_reconcile_streams_large_tables(backend):
+    users = bot.POSTGRES_CURSOR_BATCH * 2 + 500
+
+    def seed(conn):
+        conn.executemany(
+            'INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)',
+            [(user_id, f'user{user_id}', 0) for user_id in range(1, users + 1)]
+        )
+        conn.execute('UPDATE users SET balance = 7 WHERE user_id = ?', (users - 1,))
+
+    await bot.db.write(seed)
+    checked, fixes = await bot.reconcile_balances()
+    assert checked == users
+    assert fixes == [(0, users - 1, 7)]
+    assert (await bot.get_user(users - 1))[3] == 0
+
+
+async def test_task_submission_pays_user_and_referrer(backend):
+    await bot.save_user(1, 'referrer')
+    await bot.save_user(2, 'worker', 1)
+    await bot.add_task('Follow', 'Follow the page', 20, 'Your handle?')
+    task_id = (await bot.get_tasks())[0][0]
+    await bot.save_task_response(2, task_id, '@worker')
+    await bot.save_task_response(2, task_id, '@worker2')
+    await bot.mark_task_pending(2, task_id)
+    assert [task[0] for task in await bot.get_pending_tasks(2)] == [task_id]
+    assert await bot.get_review_item() is not None
+
+    first, second = await asyncio.gather(
+        bot.approve_task_submission(2, task_id, 20), bot.approve_task_submission(2, task_id, 20)
+    )
+    assert (first, second) == ((1, int(20 * bot.REFERRER_SHARE)), bot.DUPLICATE)
+    assert await bot.approve_task_submission(2, task_id, 20) is bot.DUPLICATE
+    assert [task[0] for task in await bot.get_completed_tasks(2)] == [task_id]
+    assert (await bot.get_user(2))[3] == 20
+    assert (await bot.get_user(1))[3] == int(20 * bot.REFERRER_SHARE)
+    assert (await bot.get_user_stats(2))[0] == 1
+
+    # A resubmission can be approved again
+    await bot.mark_task_pending(2, task_id)
+    assert await bot.approve_task_submission(2, task_id, 20) == (1, int(20 * bot.REFERRER_SHARE))
+
+
+async def test_withdrawals_debit_refund_and_batch(backend, tmp_path):
+    for user_id in (1, 2, 3):
+        await bot.save_user(user_id, f'user{user_id}')
+        await bot.add_bonus(user_id, 30)
+    assert await bot.create_withdrawal(1, 100, 'a@upi') is None
+    first = await bot.create_withdrawal(1, 15, 'a@upi')
+    second = await bot.create_withdrawal(2, 20, 'b@upi')
+    third = await bot.create_withdrawal(3, 25, 'c@upi')
+    assert (await bot.get_user(1))[3] == 15
+    assert [row[0] for row in await bot.get_pending_withdrawals()] == [first, second, third]
+    assert len(await bot.get_pending_withdrawals(1)) == 1
+
+    assert await bot.cancel_withdrawal(second, 1) is None
+    assert (await bot.cancel_withdrawal(second, 2))[1] == 20
+    assert (await bot.get_user(2))[3] == 30
+    assert await bot.get_withdrawal(second, pending_only=True) is None
+
+    batch_id, count, total = await bot.approve_pending_withdrawals(admin_id=99, limit=10, key=str(first))
+    assert (count, total) == (2, 40)
+    assert await bot.approve_pending_withdrawals(admin_id=99, limit=10, key=str(first)) is bot.DUPLICATE
+    path = tmp_path / 'payout.csv'
+    assert await bot.write_payout_csv(batch_id, str(path)) == 2
+    with open(path, newline='') as f:
+        assert [row[0] for row in csv.reader(f)][1:] == [str(first), str(third)]
+    assert await bot.approve_pending_withdrawals(admin_id=99, limit=10) is None
+    assert await bot.get_pending_withdrawal_totals() == (0, 0)
+
+
+class FakeBot:
+    def __init__(self, fail):
+        self.fail = fail
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename, caption):
+        if self.fail:
+            raise NetworkError('upload failed')
+        self.documents.append((chat_id, filename, document.read()))
+
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine):
+        self.tasks.append(coroutine.__qualname__)
+        coroutine.close()
+
+
+class FakeContext:
+    def __init__(self, fail=False):
+        self.bot = FakeBot(fail)
+        self.application = FakeApplication()
+
+
+async def test_payout_batch_notifies_even_if_export_fails(backend):
+    await bot.save_user(1, 'alice')
+    await bot.add_bonus(1, 30)
+    await bot.create_withdrawal(1, 15, 'a@upi')
+    context = FakeContext(fail=True)
+    batch_id, count, total, exported = await bot.process_payout_batch(context, 99, 10, 'batch')
+    assert (count, total, exported) == (1, 15, False)
+    assert context.application.tasks == ['notify_payout_batch']
+
+    context = FakeContext()
+    assert await bot.export_payout_batch(context, 99, *await bot.get_payout_batch(batch_id))
+    (chat_id, filename, data), = context.bot.documents
+    assert (chat_id, filename) == (99, f'payout_batch_{batch_id}.csv')
+    assert b'a@upi' in data
+
+
+async def test_announcements(backend):
+    first = await bot.add_announcement('Hello')
+    second = await bot.add_announcement('World')
+    assert {row[0] for row in await bot.get_announcements()} == {first, second}
+    await bot.delete_announcement(first)
+    assert [row[1] for row in await bot.get_announcements()] == ['World']
+
+
+async def test_withdrawal_request_keyed_on_latest_withdrawal(backend):
+    await bot.save_user(1, 'alice')
+    await bot.add_bonus(1, 50)
+    assert await bot.get_latest_withdrawal_id(1) == 0
+    first, second = await asyncio.gather(
+        bot.create_withdrawal(1, 15, 'a@upi', 0), bot.create_withdrawal(1, 15, 'a@upi', 0)
+    )
+    assert second is bot.DUPLICATE
+    assert await bot.get_latest_withdrawal_id(1) == first
+    assert await bot.create_withdrawal(1, 15, 'a@upi', first) > first
+    assert (await bot.get_user(1))[3] == 20
+    # Failing for lack of funds doesn't use up the key
+    latest = await bot.get_latest_withdrawal_id(1)
+    assert await bot.create_withdrawal(1, 25, 'a@upi', latest) is None
+    assert await bot.create_withdrawal(1, 20, 'a@upi', latest) > latest
+
+
+async def test_referral_backfill_finds_rings(backend):
+    # Legacy rows: 1 -> 2 -> 3 -> 1 is a ring, 4 referred itself, 5 hangs off the ring
+    def seed(conn):
+        conn.executemany(
+            'INSERT INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)',
+            [(1, 'a', 3), (2, 'b', 1), (3, 'c', 2), (4, 'd', 4), (5, 'e', 1)]
+        )
+        for statement in bot.REFERRAL_REBUILD:
+            conn.execute(statement)
+        conn.execute(bot.REFERRAL_RING_SCAN)
+
+    await bot.db.write(seed)
+    assert await bot.get_referral_rings(10) == [(4, 'd', 1), (1, 'a', 3), (2, 'b', 3), (3, 'c', 3)]
+    assert await bot.get_referral_ring_count() == 4
+    # The walk stops where it meets a user already on the path
+    assert await bot.get_referral_levels(1) == [(1, 2, 0), (2, 1, 0)]
+    assert await bot.get_referral_levels(2) == [(1, 1, 0), (2, 1, 0), (3, 1, 0)]
+    assert await bot.get_top_downlines(1) == [(1, 'a', 3)]
+
+
+async def test_writer_survives_failed_batch(backend):
+    if backend[0] != 'sqlite':
+        return
+
+    # Releasing the job's savepoint makes the writer's own RELEASE fail
+    def broken(conn):
+        conn.execute('RELEASE job')
+
+    with pytest.raises(sqlite3.OperationalError):
+        await bot.db.write(broken)
+    await bot.save_user(1, 'alice')
+    assert (await bot.get_user(1))[1] == 'alice'